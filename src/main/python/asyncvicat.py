@@ -0,0 +1,290 @@
+'''
+An asyncio version of the VICAT client.
+
+AsyncVICAT wraps a VICAT instance and runs its blocking ICAT calls in an executor,
+so that they can be awaited from an asyncio application. Lookups that are independent
+of each other are run concurrently, subject to a configurable limit.
+'''
+import asyncio
+import functools
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+from vicat import VICAT, VicatException
+
+
+class AsyncVICAT(object):
+    '''
+    An asyncio ICAT client that supports versioning of datasets.
+    Provides the methods of VICAT as coroutines.
+    '''
+
+    def __init__(self, vicat, concurrency = 8, executor = None):
+        '''
+        Constructor; takes a VICAT instance, the maximum number of ICAT calls to have in progress at
+        once, and an optional concurrent.futures Executor in which to run them (by default, a thread
+        pool with one thread per concurrent call is created, and shut down by close()).
+        The session used by the VICAT must be safe to use from several threads at once if
+        concurrency is greater than 1.
+        Use create() to construct the VICAT instance without blocking.
+        '''
+        self.vicat = vicat
+        self.concurrency = concurrency
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._ownExecutor = executor is None
+        if executor is None:
+            executor = ThreadPoolExecutor(concurrency)
+        self._executor = executor
+
+    @classmethod
+    async def create(cls, session, facilityId = None, branching = False, cache = None, server = None, concurrency = 8, executor = None, instrumentation = None):
+        '''
+        Construct a VICAT with the given arguments (see VICAT) in the executor, and return an AsyncVICAT that uses it.
+        '''
+        client = cls(None, concurrency, executor)
+        client.vicat = await client._run(VICAT, session, facilityId, branching, cache, server, instrumentation)
+        return client
+
+    def close(self):
+        '''
+        Shut down the executor, if it was created by this instance
+        '''
+        if self._ownExecutor:
+            self._executor.shutdown(wait=False)
+
+    async def refreshParameterTypes(self):
+        """
+        Look up the ids of the versioning ParameterTypes again; see VICAT.refreshParameterTypes
+        """
+        return await self._run(self.vicat.refreshParameterTypes)
+
+    async def _run(self, fn, *args):
+        """
+        Run fn(*args) in the executor, waiting for a free slot first
+        """
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, functools.partial(fn, *args))
+
+    async def _gatherChunks(self, fn, datasetIds, *args):
+        """
+        Call fn(chunk, *args) concurrently for chunks of the datasetIds, and merge the resulting dicts
+        """
+        results = {}
+        for result in await asyncio.gather(*[self._run(fn, chunk, *args) for chunk in self.vicat._chunks(list(datasetIds))]):
+            results.update(result)
+        return results
+
+    async def createVersion(self, datasetId, newName, versionComment = None):
+        """
+        Create a new version of the given dataset, using the new name.
+        Returns the id of the new dataset.
+        versionComment can be used to document the reason for the new version.
+        """
+        return await self._run(self.vicat.createVersion, datasetId, newName, versionComment)
+
+    async def createVersions(self, versions):
+        """
+        Create new versions of many datasets, as VICAT.createVersions, running up to concurrency
+        VICAT.createVersions calls at once. Returns a list with either the id of the new dataset or
+        the exception that prevented its creation, for each (datasetId, newName, versionComment) tuple.
+        The tuples for the same dataset are always given to the same call, so that it can reject
+        those that would branch when branching is not allowed.
+        """
+        groups = {}
+        for i, version in enumerate(versions):
+            groups.setdefault(int(version[0]) % self.concurrency, []).append(i)
+        groups = list(groups.values())
+        results = [None] * len(versions)
+        for (group, groupResults) in zip(groups, await asyncio.gather(*[self._run(self.vicat.createVersions, [versions[i] for i in group]) for group in groups])):
+            for (i, result) in zip(group, groupResults):
+                results[i] = result
+        return results
+
+    async def createLargeVersion(self, datasetId, newName, versionComment = None, batchSize = 1000, progress = None):
+        """
+        Create a new version of a dataset with very many datafiles; see VICAT.createLargeVersion.
+        progress, if given, is called in the executor thread, not the event loop.
+        """
+        return await self._run(self.vicat.createLargeVersion, datasetId, newName, versionComment, batchSize, progress)
+
+    async def isSuperseded(self, datasetId):
+        '''
+        True if one or more new versions have been created from this Dataset
+        '''
+        return await self._run(self.vicat.isSuperseded, datasetId)
+
+    async def superseded(self, datasetId):
+        """
+        Return the dataset id of the dataset, if any, that is the next newest version of the given dataset.
+        See VICAT.superseded.
+        """
+        return await self._run(self.vicat.superseded, datasetId)
+
+    async def supersedes(self, datasetId):
+        '''
+        If this dataset is a new version, return the datasetId of the dataset it (immediately) supersedes.
+        If it is not a version, return None
+        '''
+        return await self._run(self.vicat.supersedes, datasetId)
+
+    async def ancestors(self, datasetId):
+        """
+        Returns a list of ancestors (previous versions) of the given datasetId.
+        """
+        return await self._run(self.vicat.ancestors, datasetId)
+
+    async def descendants(self, datasetId):
+        """
+        Returns a list of descendants (newer versions) of the given datasetId.
+        This operation is not permitted when branching is in effect.
+        """
+        return await self._run(self.vicat.descendants, datasetId)
+
+    async def versionComment(self, datasetId):
+        """
+        Return the version comment for the given datasetId, if it has one
+        """
+        return await self._run(self.vicat.versionComment, datasetId)
+
+    async def origin(self, datasetId):
+        """
+        Return the id of the original dataset from which the given dataset was (ultimately) versioned
+        """
+        return await self._run(self.vicat.origin, datasetId)
+
+    async def backfillOrigins(self):
+        """
+        Record the origin of every version that lacks a correct one; see VICAT.backfillOrigins
+        """
+        return await self._run(self.vicat.backfillOrigins)
+
+    async def lineage(self, datasetId):
+        """
+        Return a list of all the datasets in the version history of the given dataset; see VICAT.lineage
+        """
+        return await self._run(self.vicat.lineage, datasetId)
+
+    async def latest(self, datasetId):
+        """
+        Return the latest version of the given dataset (or, if branching is permitted, a list of them); see VICAT.latest
+        """
+        return await self._run(self.vicat.latest, datasetId)
+
+    async def children(self, datasetId):
+        """
+        Return a list of the ids of the datasets that are direct versions of the given dataset
+        """
+        return await self._run(self.vicat.children, datasetId)
+
+    async def descendantTree(self, datasetId):
+        """
+        Return a VersionTree of the given dataset and all the versions created from it; see VICAT.descendantTree
+        """
+        return await self._run(self.vicat.descendantTree, datasetId)
+
+    async def diffVersions(self, datasetId, otherId = None):
+        """
+        Return a VersionDiff of the two datasets (or of datasetId and the version it supersedes); see VICAT.diffVersions
+        """
+        return await self._run(self.vicat.diffVersions, datasetId, otherId)
+
+    async def isSupersededMany(self, datasetIds):
+        """
+        Batch form of isSuperseded; chunks of the datasetIds are looked up concurrently
+        """
+        sdVals = await self._gatherChunks(self.vicat._paramValues, datasetIds, self.vicat.supersededPT, "numericValue")
+        return dict((dsid, sdVal is not None) for (dsid, sdVal) in sdVals.items())
+
+    async def supersededMany(self, datasetIds):
+        """
+        Batch form of superseded; chunks of the datasetIds are looked up concurrently.
+        Raises the same exceptions as VICAT.supersededMany.
+        """
+        if self.vicat.branching:
+            raise VicatException(VicatException.BRANCHING_PERMITTED,"Attempt to obtain single descendants from datasets when branching is permitted")
+        sdVals = await self._gatherChunks(self.vicat._paramValues, datasetIds, self.vicat.supersededPT, "numericValue")
+        for dsid in datasetIds:
+            if sdVals[dsid] == 0:
+                raise VicatException(VicatException.BRANCHING_PERMITTED,"Attempt to obtain single descendant from dataset " + str(dsid) + " that was superseded when branching was permitted")
+        return sdVals
+
+    async def supersedesMany(self, datasetIds):
+        """
+        Batch form of supersedes; chunks of the datasetIds are looked up concurrently
+        """
+        return await self._gatherChunks(self.vicat._paramValues, datasetIds, self.vicat.supersedesPT, "numericValue")
+
+    async def versionCommentMany(self, datasetIds):
+        """
+        Batch form of versionComment; chunks of the datasetIds are looked up concurrently
+        """
+        return await self._gatherChunks(self.vicat._paramValues, datasetIds, self.vicat.commentPT, "stringValue")
+
+    async def _iterate(self, iterator):
+        """
+        Asynchronously generate the items of the (blocking) iterator, advancing it in the executor
+        a page of MAX_RESULTS_PER_QUERY items at a time
+        """
+        while True:
+            items = await self._run(list, itertools.islice(iterator, self.vicat.MAX_RESULTS_PER_QUERY))
+            for item in items:
+                yield item
+            if len(items) < self.vicat.MAX_RESULTS_PER_QUERY:
+                return
+
+    def iterSuperseded(self, investigationId = None, datasetTypeId = None):
+        """
+        Asynchronous generator form of VICAT.iterSuperseded
+        """
+        return self._iterate(self.vicat.iterSuperseded(investigationId, datasetTypeId))
+
+    def iterVersions(self, investigationId = None, datasetTypeId = None):
+        """
+        Asynchronous generator form of VICAT.iterVersions
+        """
+        return self._iterate(self.vicat.iterVersions(investigationId, datasetTypeId))
+
+    def iterLatestVersions(self, investigationId = None, datasetTypeId = None, versionsOnly = False):
+        """
+        Asynchronous generator form of VICAT.iterLatestVersions
+        """
+        return self._iterate(self.vicat.iterLatestVersions(investigationId, datasetTypeId, versionsOnly))
+
+    async def changesSince(self, cursor = None, limit = None):
+        """
+        Return the changes after the cursor, and a new cursor; see VICAT.changesSince
+        """
+        return await self._run(self.vicat.changesSince, cursor, limit)
+
+    async def latestCursor(self):
+        """
+        Return the cursor of the most recent change; see VICAT.latestCursor
+        """
+        return await self._run(self.vicat.latestCursor)
+
+    async def followChanges(self, cursor = None, interval = 1.0, maxInterval = 60.0, stop = None):
+        """
+        Asynchronous generator form of VICAT.followChanges; stop, if given, is an asyncio.Event
+        """
+        wait = interval
+        while stop is None or not stop.is_set():
+            (changes, cursor) = await self.changesSince(cursor)
+            if len(changes) != 0:
+                yield (changes, cursor)
+                wait = interval
+                continue
+            if stop is None:
+                await asyncio.sleep(wait)
+            else:
+                try:
+                    await asyncio.wait_for(stop.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+            wait = min(wait * 2, maxInterval)
+
+    def cacheStats(self):
+        """
+        Return the cache's hit and miss counts and size as a dict, or None if there is no cache
+        """
+        return self.vicat.cacheStats()
@@ -0,0 +1,233 @@
+'''
+A thread-pool version of the VICAT client, for versioning large batches of datasets.
+
+ParallelVICAT spreads createVersion calls and lookups over a bounded pool of worker
+threads, each using its own ICAT session from a SessionPool.
+'''
+import contextlib
+import copy
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from vicat import VICAT
+
+
+class SessionPool(object):
+    '''
+    A pool of ICAT sessions. Sessions are created on demand (up to size of them) by calling login,
+    which must return a new, logged-in session; a session that has expired can be replaced by a new one.
+    '''
+
+    def __init__(self, login, size):
+        self.login = login
+        self.size = size
+        self._idle = []
+        self._count = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        '''
+        Return an idle session, creating one if there are fewer than size, or waiting for one to be released
+        '''
+        with self._condition:
+            while len(self._idle) == 0 and self._count >= self.size:
+                self._condition.wait()
+            if len(self._idle) != 0:
+                return self._idle.pop()
+            self._count += 1
+        try:
+            return self.login()
+        except Exception:
+            with self._condition:
+                self._count -= 1
+                self._condition.notify()
+            raise
+
+    def release(self, session):
+        '''
+        Return a session to the pool
+        '''
+        with self._condition:
+            self._idle.append(session)
+            self._condition.notify()
+
+    def replace(self, session):
+        '''
+        Return a new session to use instead of the given (expired) one. If a new session cannot be created,
+        the expired one is dropped from the pool.
+        '''
+        try:
+            return self.login()
+        except Exception:
+            with self._condition:
+                self._count -= 1
+                self._condition.notify()
+            raise
+
+
+class _CloneTracker(object):
+    """
+    A proxy for an ICAT session that records the id of the last entity it cloned (None until one is cloned)
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.cloned = None
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    def cloneEntity(self, name, entityId, keys):
+        self.cloned = self.session.cloneEntity(name, entityId, keys)
+        return self.cloned
+
+
+class ParallelVICAT(object):
+    '''
+    Runs VICAT operations for many datasets on a pool of worker threads.
+    Results are returned in the order the items were submitted; an item that fails
+    yields its exception rather than stopping the others.
+    '''
+
+    # Number of locks used to serialise versioning of the same dataset
+    LOCK_STRIPES = 256
+
+    def __init__(self, login, facilityId = None, branching = False, cache = None, server = None, workers = 4, instrumentation = None):
+        '''
+        Constructor; takes a callable that returns a new, logged-in ICAT session, the VICAT arguments
+        (see VICAT) and the number of worker threads. Each worker uses its own session, taken from a
+        SessionPool; if a call fails because its session has expired, it is retried once with a new session
+        (a createVersion call that had already cloned its dataset is completed rather than repeated).
+        If a cache or an Instrumentation is given, it is shared by all the workers.
+        '''
+        self.workers = workers
+        self.pool = SessionPool(login, workers)
+        session = self.pool.acquire()
+        try:
+            # The workers share the ParameterType ids found by this instance
+            self.vicat = VICAT(session, facilityId, branching, cache, server, instrumentation)
+        finally:
+            self.pool.release(session)
+        self._executor = ThreadPoolExecutor(workers)
+        self._locks = [threading.Lock() for i in range(self.LOCK_STRIPES)]
+
+    def close(self):
+        '''
+        Shut down the worker threads
+        '''
+        self._executor.shutdown(wait=True)
+
+    def _call(self, fn, item, retry = None, guard = None):
+        """
+        Call fn(vicat, item), where vicat is a VICAT that uses a session from the pool. If that fails because
+        the session has expired, call retry(failed, vicat, item) with the VICAT that failed and one that uses
+        a new session; by default, fn(vicat, item) is called again. If guard is given, the context manager
+        guard(vicat, item) is held over both calls.
+        """
+        session = self.pool.acquire()
+        try:
+            failed = self._bind(session)
+            with guard(failed, item) if guard is not None else contextlib.nullcontext():
+                try:
+                    return fn(failed, item)
+                except Exception as e:
+                    if not self._sessionExpired(e):
+                        raise
+                    expired = session
+                    session = None
+                    session = self.pool.replace(expired)
+                    if retry is None:
+                        return fn(self._bind(session), item)
+                    return retry(failed, self._bind(session), item)
+        finally:
+            if session is not None:
+                self.pool.release(session)
+
+    def _bind(self, session):
+        """
+        Return a copy of the shared VICAT that uses the given session
+        """
+        vicat = copy.copy(self.vicat)
+        if vicat.instrumentation is not None:
+            session = vicat.instrumentation.wrap(session)
+        vicat.session = session
+        return vicat
+
+    def _sessionExpired(self, e):
+        getType = getattr(e, "getType", None)
+        return getType is not None and getType() == "SESSION"
+
+    def _map(self, fn, items, retry = None, guard = None):
+        """
+        Run _call(fn, item, retry, guard) for each item on the pool; return the list of results (or exceptions) in item order
+        """
+        futures = [self._executor.submit(self._call, fn, item, retry, guard) for item in items]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def _lock(self, datasetId):
+        return self._locks[hash(int(datasetId)) % self.LOCK_STRIPES]
+
+    def _versionGuard(self, vicat, version):
+        """
+        Return the lock for the dataset if branching is not allowed, so that two workers cannot both create
+        a version of it (including the retry of an attempt whose session expired)
+        """
+        if vicat.branching:
+            return contextlib.nullcontext()
+        return self._lock(version[0])
+
+    def _createVersion(self, vicat, version):
+        """
+        Create a version, recording the clone (if any) that is made
+        """
+        datasetId, newName = version[0], version[1]
+        versionComment = version[2] if len(version) > 2 else None
+        vicat.session = _CloneTracker(vicat.session)
+        return vicat.createVersion(datasetId, newName, versionComment)
+
+    def _retryVersion(self, failed, vicat, version):
+        """
+        Retry a createVersion call whose session expired. createVersion cannot simply be repeated once it has
+        cloned the dataset, as that would leave the first clone behind, so in that case the clone is made a version
+        (unless another client has made a version of the dataset meanwhile and branching is not allowed, in
+        which case the versioning parameters copied into the clone are removed, so that it is not taken for one).
+        It is called with the lock for the dataset still held.
+        """
+        newdsid = failed.session.cloned
+        if newdsid is None:
+            return self._createVersion(vicat, version)
+        datasetId = version[0]
+        versionComment = version[2] if len(version) > 2 else None
+        params = vicat._findParamValues([datasetId], [vicat.supersededPT, vicat.supersedesPT, vicat.originPT])[int(datasetId)]
+        superseded = params.get(vicat.supersededPT)
+        error = vicat._branchingError(datasetId, superseded is not None and int(superseded) != int(newdsid))
+        if error is not None:
+            vicat._deleteVersionParameters([newdsid])
+            raise error
+        origin = vicat._lineageOrigin(datasetId, params)
+        vicat._completeVersions([(newdsid, datasetId, versionComment, origin)], vicat._supersededIds({datasetId : params}))
+        return newdsid
+
+    def createVersions(self, versions):
+        '''
+        Create new versions of many datasets in parallel.
+        versions is a list of (datasetId, newName, versionComment) tuples; versionComment may be omitted.
+        Returns a list with one element for each tuple: either the id of the new dataset, or the exception
+        that prevented it being created.
+        If branching is not allowed, only one of several tuples for the same dataset will succeed.
+        '''
+        return self._map(self._createVersion, versions, self._retryVersion, self._versionGuard)
+
+    def lookup(self, methodName, datasetIds):
+        '''
+        Call the named single-dataset VICAT method (such as "ancestors" or "supersedes") for each of the
+        given datasetIds in parallel. Returns a list with one element for each datasetId: either the
+        method's result or the exception that it raised.
+        '''
+        return self._map(lambda vicat, datasetId: getattr(vicat, methodName)(datasetId), datasetIds)
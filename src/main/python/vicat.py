@@ -3,6 +3,12 @@ Created on 7 Sep 2016
 
 @author: br54
 '''
+from array import array
+from collections import OrderedDict, deque, namedtuple
+import functools
+import threading
+import time
+
 from icat import ICAT
 
 class VicatException(Exception):
@@ -16,6 +22,10 @@ class VicatException(Exception):
     BRANCHING_NOT_PERMITTED = "BRANCHING_NOT_PERMITTED"
     # Attempt to use a non-branching operation when branching is in effect
     BRANCHING_PERMITTED = "BRANCHING_PERMITTED"
+    # Attempt to compare a dataset with the version it supersedes when it is not a version
+    NOT_A_VERSION = "NOT_A_VERSION"
+    # Attempt to version a dataset that does not exist
+    NO_SUCH_DATASET = "NO_SUCH_DATASET"
     
     def __init__(self, code, message, offset=-1):
         """
@@ -46,6 +56,290 @@ class VicatException(Exception):
         """
         return self.offset
 
+def timestampLiteral(modTime):
+    """
+    Convert a date/time returned by ICAT (such as "2016-10-04T16:10:20.000+01:00")
+    into a literal for use in a query, truncated to the second: {ts 2016-10-04 16:10:20}
+    """
+    return "{ts " + modTime[:19].replace("T", " ") + "}"
+
+class VersionTree(namedtuple("VersionTree", ["ids", "parents"])):
+    """
+    A tree of versions, held as two parallel arrays: ids[i] is a dataset id, and parents[i] is the
+    index in ids of the dataset that ids[i] (directly) supersedes. ids[0] is the root of the tree,
+    and parents[0] is -1. Each dataset appears after the dataset it supersedes.
+    """
+    __slots__ = ()
+
+    def children(self, index):
+        """
+        Return the indexes of the direct versions of the dataset at the given index
+        """
+        return [i for (i, parent) in enumerate(self.parents) if parent == index]
+
+    def leaves(self):
+        """
+        Return the ids of the datasets in the tree that have no versions
+        """
+        hasChildren = set(self.parents)
+        return [dsid for (i, dsid) in enumerate(self.ids) if i not in hasChildren]
+
+class VersionDiff(namedtuple("VersionDiff", ["addedDatafiles", "removedDatafiles", "changedDatafiles",
+                                               "addedParameters", "removedParameters", "changedParameters"])):
+    """
+    The differences between two datasets, as found by VICAT.diffVersions. Each field is a set:
+    of Datafile names for the datafiles, and of ParameterType names for the DatasetParameters.
+    A Datafile has changed if its location, checksum or fileSize differs; a parameter, if its value does.
+    """
+    __slots__ = ()
+
+class Change(namedtuple("Change", ["paramId", "datasetId", "name", "value", "modTime"])):
+    """
+    A supersedes or superseded parameter created or modified, as returned by VICAT.changesSince:
+    name is VICAT.SUPERSEDES or VICAT.SUPERSEDED, and value is the dataset id it holds (0 for a
+    superseded parameter written when branching was permitted).
+    """
+    __slots__ = ()
+
+class VersionCache(object):
+    """
+    A bounded cache of versioning parameter lookups, for use by one or more VICAT instances.
+    Holds up to maxSize entries, evicting the least recently used; if ttl is not None,
+    entries expire ttl seconds after they were stored.
+    hits and misses count the lookups that were (or were not) answered from the cache.
+    """
+
+    # Distinguishes "not cached" from a cached None
+    _MISSING = object()
+
+    def __init__(self, maxSize=10000, ttl=None):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return a (found, value) pair for the key
+        """
+        with self._lock:
+            entry = self._entries.pop(key, self._MISSING)
+            if entry is not self._MISSING and (self.ttl is None or entry[1] > time.time()):
+                # Re-insert as most recently used
+                self._entries[key] = entry
+                self.hits += 1
+                return (True, entry[0])
+            self.misses += 1
+            return (False, None)
+
+    def put(self, key, value):
+        """
+        Store the value for the key, evicting the least recently used entry if the cache is full
+        """
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires)
+            while len(self._entries) > self.maxSize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Return a dict of the hit and miss counts and the current number of entries
+        """
+        with self._lock:
+            return {"hits" : self.hits, "misses" : self.misses, "size" : len(self._entries)}
+
+class Span(namedtuple("Span", ["method", "operation", "query", "start", "duration", "roundTrips", "error"])):
+    """
+    A timed call recorded by Instrumentation. For a call to a public VICAT method, operation and query
+    are None and roundTrips is the number of ICAT calls it made; for an ICAT call, operation is the session
+    method ("search", "write", "delete" or "cloneEntity"), query describes its argument, roundTrips is 1,
+    and method is the public VICAT method that made it (or None). start is a time.time() value, duration
+    is in seconds, and error is the exception raised, if any.
+    """
+    __slots__ = ()
+
+class Instrumentation(object):
+    """
+    Records the ICAT calls made by one or more VICAT instances, grouped by the public VICAT method that made them.
+    Each hook is called with a Span for every method call and every ICAT call, for exporting to a metrics system.
+    The most recent ICAT calls (up to maxQueries) are kept with their query text; see recentQueries().
+    Setting enabled to False stops recording.
+    """
+
+    def __init__(self, hooks=None, maxQueries=100):
+        self.hooks = list(hooks or [])
+        self.enabled = True
+        self._methods = {}
+        self._queries = deque(maxlen=maxQueries)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def addHook(self, hook):
+        self.hooks.append(hook)
+
+    def wrap(self, session):
+        """
+        Return a proxy for the ICAT session that records its calls
+        """
+        return InstrumentedSession(session, self)
+
+    def call(self, method, fn, args, kwargs):
+        """
+        Call fn(*args, **kwargs) on behalf of the named VICAT method, recording it.
+        A method called by another one is not recorded separately: its ICAT calls count towards the outer method.
+        """
+        local = self._local
+        if not self.enabled or getattr(local, "method", None) is not None:
+            return fn(*args, **kwargs)
+        local.method = method
+        local.roundTrips = 0
+        start = time.time()
+        error = None
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            duration = time.time() - start
+            local.method = None
+            self._record(Span(method, None, None, start, duration, local.roundTrips, error))
+
+    def icatCall(self, operation, query, fn, *args):
+        """
+        Make the ICAT call fn(*args), recording it against the VICAT method in progress in this thread
+        """
+        if not self.enabled:
+            return fn(*args)
+        local = self._local
+        method = getattr(local, "method", None)
+        start = time.time()
+        error = None
+        try:
+            return fn(*args)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            duration = time.time() - start
+            if method is not None:
+                local.roundTrips += 1
+            self._record(Span(method, operation, query, start, duration, 1, error))
+
+    def _record(self, span):
+        with self._lock:
+            stats = self._methods.get(span.method)
+            if stats is None:
+                stats = self._methods[span.method] = {"calls" : 0, "errors" : 0, "time" : 0.0, "roundTrips" : 0, "icatTime" : 0.0, "operations" : {}}
+            if span.operation is None:
+                stats["calls"] += 1
+                stats["time"] += span.duration
+                if span.error is not None:
+                    stats["errors"] += 1
+            else:
+                stats["roundTrips"] += 1
+                stats["icatTime"] += span.duration
+                stats["operations"][span.operation] = stats["operations"].get(span.operation, 0) + 1
+                self._queries.append(span)
+        for hook in self.hooks:
+            hook(span)
+
+    def stats(self):
+        """
+        Return a snapshot, as a dict keyed by VICAT method name, of the number of calls to each method,
+        how many raised an exception, their total time, and the number of ICAT calls they made
+        (roundTrips; also by operation) and the total time spent in them (icatTime).
+        ICAT calls made outside any public VICAT method are recorded under None.
+        """
+        with self._lock:
+            return dict((method, dict(stats, operations=dict(stats["operations"]))) for (method, stats) in self._methods.items())
+
+    def recentQueries(self):
+        """
+        Return a list of Spans for the most recent ICAT calls, oldest first
+        """
+        with self._lock:
+            return list(self._queries)
+
+    def reset(self):
+        with self._lock:
+            self._methods.clear()
+            self._queries.clear()
+
+class InstrumentedSession(object):
+    """
+    A proxy for an ICAT session that records search, write, delete and cloneEntity calls in an Instrumentation.
+    Other attributes are those of the session.
+    """
+
+    def __init__(self, session, instrumentation):
+        self.session = session
+        self.instrumentation = instrumentation
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    def _describe(self, entities):
+        # Describe the entities written or deleted, as counts of each entity type
+        if isinstance(entities, dict):
+            entities = [entities]
+        counts = OrderedDict()
+        for entity in entities:
+            for name in entity:
+                counts[name] = counts.get(name, 0) + 1
+        return ", ".join(str(count) + " " + name for (name, count) in counts.items())
+
+    def search(self, query):
+        return self.instrumentation.icatCall("search", query, self.session.search, query)
+
+    def write(self, entities):
+        return self.instrumentation.icatCall("write", self._describe(entities), self.session.write, entities)
+
+    def delete(self, entities):
+        return self.instrumentation.icatCall("delete", self._describe(entities), self.session.delete, entities)
+
+    def cloneEntity(self, name, entityId, keys):
+        return self.instrumentation.icatCall("cloneEntity", name + " " + str(entityId), self.session.cloneEntity, name, entityId, keys)
+
+def instrumented(method):
+    """
+    Decorator for the public methods of VICAT: if the instance has an Instrumentation, record the call in it
+    """
+    name = method.__name__
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.instrumentation is None:
+            return method(self, *args, **kwargs)
+        return self.instrumentation.call(name, method, (self,) + args, kwargs)
+    return wrapper
+
+# Ids looked up by VICAT constructors, shared by all instances in the process:
+# the ids of the versioning ParameterTypes, keyed by (server, facilityId),
+# and the id of the default (LSF) Facility, keyed by server.
+_parameterTypeRegistry = {}
+_facilityRegistry = {}
+_registryLock = threading.Lock()
+
+def clearRegistry():
+    """
+    Forget all the ids recorded by VICAT constructors, so that new instances look them up again.
+    """
+    with _registryLock:
+        _parameterTypeRegistry.clear()
+        _facilityRegistry.clear()
+
 class VICAT(object):
     '''
     An ICAT client that supports versioning of datasets.
@@ -55,8 +349,36 @@ class VICAT(object):
     SUPERSEDED = "vicat:superseded"
     SUPERSEDES = "vicat:supersedes"
     COMMENT = "vicat:comment"
+    ORIGIN = "vicat:origin"
+    COPY_OF = "vicat:copyOf"
 
-    def __init__(self, session, facilityId = None, branching = False):
+    # For each versioning ParameterType: its name, the attribute that holds its id, its valueType and its description
+    _PARAMETER_TYPES = [
+        (SUPERSEDED, "supersededPT", "NUMERIC", "indicates there are newer versions of this dataset; if branching is disabled, will contain the id of the superseding dataset"),
+        (SUPERSEDES, "supersedesPT", "NUMERIC", "indicates this dataset is a newer version of the given datasetId"),
+        (COMMENT, "commentPT", "STRING", "documents reason for creation of this version of the given datasetId"),
+        (ORIGIN, "originPT", "NUMERIC", "the id of the original dataset from which this version was (ultimately) created"),
+        (COPY_OF, "copyOfPT", "NUMERIC", "marks an unfinished copy of the given datasetId, made by createLargeVersion"),
+    ]
+
+    # Page size used for searches that may return many results
+    MAX_RESULTS_PER_QUERY = 10000
+    # Maximum number of ids in the IN (...) clause of a single search, to keep queries to a reasonable length
+    MAX_IDS_PER_QUERY = 500
+    # Maximum number of entities in a single write or delete
+    MAX_ENTITIES_PER_WRITE = 1000
+    # Maximum number of clones made by createVersions before their versioning parameters are written
+    MAX_VERSIONS_PER_BATCH = 100
+
+    # Fields copied by createLargeVersion
+    _DATASET_FIELDS = ["description", "location", "doi", "startDate", "endDate", "complete"]
+    _DATAFILE_FIELDS = ["name", "description", "location", "fileSize", "checksum", "doi", "datafileCreateTime", "datafileModTime"]
+    _PARAMETER_FIELDS = ["numericValue", "stringValue", "dateTimeValue", "error", "rangeBottom", "rangeTop"]
+
+    # Set by the constructor if an Instrumentation is given
+    instrumentation = None
+
+    def __init__(self, session, facilityId = None, branching = False, cache = None, server = None, instrumentation = None):
         '''
         Constructor; takes an ICAT session, an optional Facility ID and an optional branching flag.
         If the facilityId is not specified, look for a Facility called LSF
@@ -74,13 +396,36 @@ class VICAT(object):
         has been True.)
         The consequences of creating a VICAT instance with branching=False on 
         a Facility where branching has been True previously are unpredictable.
-        Versioning uses three dataset parameters, "vicat:superseded", "vicat:supersedes" and "vicat:comment";
-        these will be created on the Facility if they do not already exist.
+        Versioning uses five dataset parameters, "vicat:superseded", "vicat:supersedes", "vicat:comment",
+        "vicat:origin" and "vicat:copyOf"; these will be created on the Facility if they do not already exist.
+        If a VersionCache is given as cache, the results of supersedes/superseded/comment lookups are
+        kept in it; createVersion updates the entries it affects, so results within the process are not stale.
+        If server is given (any value that identifies the ICAT server, such as its URL), the ids that
+        the constructor looks up are recorded in a registry shared by all instances in the process,
+        so that later instances for the same server and Facility need not look them up again.
+        If an Instrumentation is given, the ICAT calls made by the instance are recorded in it,
+        grouped by the public method that made them (the constructor's are recorded as "__init__").
         '''
         self.session = session
         self.branching = branching
+        self.cache = cache
+        self.server = server
+        if instrumentation is None:
+            self._connect(facilityId)
+        else:
+            self.instrumentation = instrumentation
+            self.session = instrumentation.wrap(session)
+            instrumentation.call("__init__", self._connect, (facilityId,), {})
+
+    def _connect(self, facilityId):
+        """
+        Find the Facility (if facilityId is not given) and the versioning ParameterTypes
+        """
+        server = self.server
         if facilityId:
             self.fid = facilityId
+        elif server is not None and server in _facilityRegistry:
+            self.fid = _facilityRegistry[server]
         else:
             # Legacy: look for the LSF facility if no id is specified
             fids = self.session.search("SELECT f.id FROM Facility f WHERE f.name = 'LSF'")
@@ -88,47 +433,60 @@ class VICAT(object):
                 self.fid = fids[0]
             else:
                 raise VicatException(VicatException.NO_FACILITY,"No Facility specified and can't find a Facility called LSF")
+            if server is not None:
+                with _registryLock:
+                    _facilityRegistry[server] = self.fid
         self._setupDatasetParameters()
 
-    def _setupDatasetParameters(self):
-        pts = self.session.search("SELECT pt.id FROM ParameterType pt WHERE pt.facility.id = " + str(self.fid) + " AND pt.name = '" + self.SUPERSEDED + "'")
-        if pts and len(pts) > 0:
-            self.supersededPT = pts[0]
-        else:
-            sdParamType = {"name" : self.SUPERSEDED,
-                "facility" : {"id" : self.fid},
-                "valueType" : "NUMERIC",
-                "description" : "indicates there are newer versions of this dataset; if branching is disabled, will contain the id of the superseding dataset",
-                "applicableToDataset" : True,
-                "units" : "N/A"}
-            entity = {"ParameterType" : sdParamType }
-            self.supersededPT = self.session.write(entity)[0]
-        
-        pts = self.session.search("SELECT pt.id FROM ParameterType pt WHERE pt.facility.id = " + str(self.fid) + " AND pt.name = '" + self.SUPERSEDES + "'")
-        if pts and len(pts) > 0:
-            self.supersedesPT = pts[0]
-        else:
-            ssParamType = {"name" : self.SUPERSEDES,
-                "facility" : {"id" : self.fid},
-                "valueType" : "NUMERIC",
-                "description" : "indicates this dataset is a newer version of the given datasetId",
-                "applicableToDataset" : True,
-                "units" : "N/A"}
-            entity = {"ParameterType" : ssParamType }
-            self.supersedesPT = self.session.write(entity)[0]
-        
-        pts = self.session.search("SELECT pt.id FROM ParameterType pt WHERE pt.facility.id = " + str(self.fid) + " AND pt.name = '" + self.COMMENT + "'")
-        if pts and len(pts) > 0:
-            self.commentPT = pts[0]
-        else:
-            commentParamType = {"name" : self.COMMENT,
-                "facility" : {"id" : self.fid},
-                "valueType" : "STRING",
-                "description" : "documents reason for creation of this version of the given datasetId",
-                "applicableToDataset" : True,
-                "units" : "N/A"}
-            entity = {"ParameterType" : commentParamType }
-            self.commentPT = self.session.write(entity)[0]
+    def _setupDatasetParameters(self, refresh=False):
+        """
+        Set the ids of the versioning ParameterTypes, from the registry if possible (and refresh is False);
+        otherwise find them with one search, creating any that do not exist with one write.
+        """
+        key = (self.server, self.fid)
+        ptIds = None
+        if self.server is not None and not refresh:
+            ptIds = _parameterTypeRegistry.get(key)
+        if ptIds is None:
+            ptIds = self._findParameterTypes()
+            if self.server is not None:
+                with _registryLock:
+                    _parameterTypeRegistry[key] = ptIds
+        for (name, attribute, valueType, description) in self._PARAMETER_TYPES:
+            setattr(self, attribute, ptIds[name])
+
+    @instrumented
+    def refreshParameterTypes(self):
+        """
+        Look up the ids of the versioning ParameterTypes again (creating any that no longer exist),
+        and update the shared registry. Use this if the ParameterTypes may have been changed in ICAT
+        since the registry entry was made.
+        """
+        self._setupDatasetParameters(refresh=True)
+
+    def _findParameterTypes(self):
+        """
+        Return a dict mapping the name of each versioning ParameterType to its id,
+        creating any that do not yet exist on the Facility.
+        """
+        names = ",".join("'" + name + "'" for (name, attribute, valueType, description) in self._PARAMETER_TYPES)
+        ptIds = {}
+        for (ptid, name) in self.session.search("SELECT pt.id, pt.name FROM ParameterType pt WHERE pt.facility.id = " + str(self.fid) + " AND pt.name IN (" + names + ") ORDER BY pt.id"):
+            ptIds.setdefault(name, ptid)
+        missing = [(name, valueType, description) for (name, attribute, valueType, description) in self._PARAMETER_TYPES if name not in ptIds]
+        if len(missing) != 0:
+            entities = []
+            for (name, valueType, description) in missing:
+                paramType = {"name" : name,
+                    "facility" : {"id" : self.fid},
+                    "valueType" : valueType,
+                    "description" : description,
+                    "applicableToDataset" : True,
+                    "units" : "N/A"}
+                entities.append({"ParameterType" : paramType })
+            for ((name, valueType, description), ptid) in zip(missing, self.session.write(entities)):
+                ptIds[name] = ptid
+        return ptIds
 
     def _findParam(self, datasetId, paramTypeId, valueTypeField=None):
         """
@@ -141,67 +499,745 @@ class VICAT(object):
             selectors += ", dp." + valueTypeField
         return self.session.search("SELECT " + selectors + " FROM DatasetParameter dp WHERE dp.dataset.id="+str(datasetId)+" AND dp.type.id="+str(paramTypeId))
     
-    def _addOrUpdateParameter(self, datasetId, paramTypeId, paramValue=None, valueTypeField="numericValue"):
-        """
-        If the given dataset already has an instance of the paramType, delete it first.
-        Create an instance of paramType for the given dataset with the given value.
-        If paramValue is None, then any existing parameter will be deleted, but no
-        new value will be created.
-        The valueTypeField must match that expected for the given paramType.
-        """
-        params = self._findParam(datasetId, paramTypeId)
-        if len(params) != 0:
-            paramId = params[0]
-            entity = {"DatasetParameter" : {"id" : paramId}}
-            self.session.delete(entity)
-        if paramValue is not None:
-            newParam = {"dataset" : {"id" : datasetId}, "type" : {"id" : paramTypeId}, valueTypeField : paramValue}
-            entity = {"DatasetParameter" : newParam}
-            self.session.write(entity)
+    def _findParamMany(self, datasetIds, paramTypeId, valueTypeField=None):
+        """
+        Batch form of _findParam: return a dict mapping each of the given dataset ids (as ints) to the list of
+        ids of its (Dataset)Parameters of the given type (or, if valueTypeField is not None, to a list
+        of [id, value] lists). The ids are searched for in chunks of MAX_IDS_PER_QUERY.
+        """
+        selectors = "dp.dataset.id, dp.id"
+        if valueTypeField is not None:
+            selectors += ", dp." + valueTypeField
+        found = {}
+        for dsid in datasetIds:
+            found[int(dsid)] = []
+        for chunk in self._chunks(list(found)):
+            idList = ",".join(str(dsid) for dsid in chunk)
+            rows = self._searchAll("SELECT " + selectors + " FROM DatasetParameter dp WHERE dp.type.id=" + str(paramTypeId)
+                                   + " AND dp.dataset.id IN (" + idList + ") ORDER BY dp.id")
+            for row in rows:
+                if valueTypeField is None:
+                    found[row[0]].append(row[1])
+                else:
+                    found[row[0]].append(row[1:])
+        return found
 
+    def _findParamValues(self, datasetIds, paramTypeIds):
+        """
+        Return a dict mapping each of the given dataset ids (as ints) to a dict of the numeric values of its
+        (Dataset)Parameters of the given types, keyed by type id; types of which the dataset has no
+        parameter are omitted. Uses one search for each chunk of MAX_IDS_PER_QUERY datasets.
+        """
+        typeIds = ",".join(str(ptid) for ptid in paramTypeIds)
+        found = {}
+        for dsid in datasetIds:
+            found[int(dsid)] = {}
+        for chunk in self._chunks(list(found)):
+            idList = ",".join(str(dsid) for dsid in chunk)
+            rows = self._searchAll("SELECT dp.dataset.id, dp.type.id, dp.numericValue FROM DatasetParameter dp WHERE dp.type.id IN (" + typeIds
+                                   + ") AND dp.dataset.id IN (" + idList + ") ORDER BY dp.id")
+            for (dsid, ptid, value) in rows:
+                found[dsid].setdefault(ptid, value)
+        return found
+
+    def _paramValue(self, datasetId, paramTypeId, valueTypeField):
+        """
+        Return the value of the named field of the given dataset's parameter of the given type,
+        or None if it has no such parameter, using the cache (if any).
+        """
+        if self.cache is not None:
+            found, value = self.cache.get((paramTypeId, int(datasetId)))
+            if found:
+                return value
+        params = self._findParam(datasetId, paramTypeId, valueTypeField)
+        value = params[0][1] if len(params) != 0 else None
+        if self.cache is not None:
+            self.cache.put((paramTypeId, int(datasetId)), value)
+        return value
+
+    def _paramValues(self, datasetIds, paramTypeId, valueTypeField):
+        """
+        Batch form of _paramValue: return a dict mapping each of the given dataset ids to the value
+        of its parameter of the given type (or None). Only ids that are not cached are searched for.
+        """
+        values = {}
+        missing = []
+        for dsid in datasetIds:
+            found = False
+            if self.cache is not None:
+                found, value = self.cache.get((paramTypeId, int(dsid)))
+            if found:
+                values[dsid] = value
+            else:
+                missing.append(dsid)
+        found = self._findParamMany(missing, paramTypeId, valueTypeField)
+        for dsid in missing:
+            params = found[int(dsid)]
+            value = params[0][1] if len(params) != 0 else None
+            values[dsid] = value
+            if self.cache is not None:
+                self.cache.put((paramTypeId, int(dsid)), value)
+        return values
+
+    def _cacheVersions(self, versions, supersededValues):
+        """
+        Record the parameters of newly-created versions in the cache (if any).
+        versions is a list of (newdsid, datasetId, versionComment, origin) tuples; supersededValues maps
+        original datasetIds to the value of any superseded parameter that was added to them.
+        """
+        if self.cache is None:
+            return
+        for (datasetId, supersededValue) in supersededValues.items():
+            self.cache.put((self.supersededPT, int(datasetId)), supersededValue)
+        for (newdsid, datasetId, versionComment, origin) in versions:
+            newdsid = int(newdsid)
+            self.cache.put((self.supersededPT, newdsid), None)
+            self.cache.put((self.supersedesPT, newdsid), int(datasetId))
+            self.cache.put((self.commentPT, newdsid), versionComment)
+            self.cache.put((self.originPT, newdsid), origin)
+
+    def cacheStats(self):
+        """
+        Return the cache's hit and miss counts and size as a dict, or None if there is no cache
+        """
+        if self.cache is None:
+            return None
+        return self.cache.stats()
+
+    def _chunks(self, ids):
+        """
+        Split the list of ids into lists of no more than MAX_IDS_PER_QUERY ids
+        """
+        return [ids[i:i + self.MAX_IDS_PER_QUERY] for i in range(0, len(ids), self.MAX_IDS_PER_QUERY)]
+
+    def _searchAll(self, query):
+        """
+        Run the query in pages of MAX_RESULTS_PER_QUERY results and return the concatenated results.
+        The query must impose an ORDER BY so that the pages are consistent.
+        """
+        results = []
+        offset = 0
+        while True:
+            page = self.session.search(query + " LIMIT " + str(offset) + ", " + str(self.MAX_RESULTS_PER_QUERY))
+            results.extend(page)
+            if len(page) < self.MAX_RESULTS_PER_QUERY:
+                return results
+            offset += len(page)
+
+    def _lineageParams(self, origin, paramTypeId):
+        """
+        Return a dict mapping the id of each version that records the given origin to the value of its (numeric)
+        parameter of the given type, or to None if it has none, using one (paged) search
+        """
+        rows = self._searchAll("SELECT dp.dataset.id, dp.type.id, dp.numericValue FROM DatasetParameter dp JOIN dp.dataset ds JOIN ds.parameters o"
+                               + " WHERE dp.type.id IN (" + str(paramTypeId) + ", " + str(self.originPT) + ") AND o.type.id=" + str(self.originPT)
+                               + " AND o.numericValue=" + str(origin) + " ORDER BY dp.id")
+        values = {}
+        for (dsid, ptid, value) in rows:
+            if ptid == paramTypeId:
+                values[dsid] = value
+            else:
+                values.setdefault(dsid, None)
+        return values
+
+    def _investigationParams(self, datasetId, paramTypeId):
+        """
+        Return a dict mapping the id of each dataset in the Investigation of the given dataset that has a (numeric)
+        parameter of the given type to the value of that parameter, using one (paged) search
+        """
+        rows = self._searchAll("SELECT dp.dataset.id, dp.numericValue FROM DatasetParameter dp JOIN dp.dataset ds JOIN ds.investigation inv JOIN inv.datasets member"
+                               + " WHERE member.id=" + str(int(datasetId)) + " AND dp.type.id=" + str(paramTypeId) + " ORDER BY dp.id")
+        values = {}
+        for (dsid, value) in rows:
+            values.setdefault(dsid, value)
+        return values
+
+    def _chain(self, datasetId, paramTypeId):
+        """
+        Follow the chain of datasets linked by (numeric) parameters of the given type, starting from datasetId.
+        Returns a list of (datasetId, value) pairs, one for each link followed. The chain stops at a dataset
+        with no such parameter, or at a value of 0 (which is included as the last pair).
+        The first dataset is looked up on its own, which also finds the origin of its lineage; the parameters
+        of the rest of the lineage are then retrieved with one search. If the chain leaves the datasets that record
+        that origin (as in histories created before origins were recorded), the parameters of the whole Investigation
+        are retrieved with one more search instead, as versions are made within an Investigation. The number of searches
+        therefore does not depend on the length of the chain. Links found in the cache (if any) need no searches at all.
+        """
+        values = {}
+        loaded = set()
+        origin = None
+        investigationLoaded = False
+        links = []
+        current = int(datasetId)
+        seen = set([current])
+        while True:
+            found = False
+            if self.cache is not None:
+                found, value = self.cache.get((paramTypeId, current))
+            if not found:
+                if current not in values and origin is not None and origin not in loaded:
+                    loaded.add(origin)
+                    values.update(self._lineageParams(origin, paramTypeId))
+                if current in values:
+                    value = values[current]
+                elif investigationLoaded:
+                    value = None
+                elif len(links) != 0:
+                    investigationLoaded = True
+                    values.update(self._investigationParams(current, paramTypeId))
+                    value = values.get(current)
+                else:
+                    params = self._findParamValues([current], [paramTypeId, self.supersedesPT, self.originPT])[int(current)]
+                    value = params.get(paramTypeId)
+                    if self.originPT in params:
+                        origin = params[self.originPT]
+                    elif self.supersedesPT not in params:
+                        origin = current
+                    if origin is not None and paramTypeId == self.supersedesPT:
+                        # The origin is not a version
+                        values[origin] = None
+                if self.cache is not None:
+                    self.cache.put((paramTypeId, current), value)
+            if value is None:
+                return links
+            links.append((current, value))
+            if value == 0 or value in seen:
+                return links
+            seen.add(value)
+            current = value
+
+    @instrumented
     def createVersion(self, datasetId, newName, versionComment=None):
         """
         Create a new version of the given dataset, using the new name.
         Returns the id of the new dataset.
         versionComment can be used to document the reason for the new version.
         """
-        # Check whether the dataset already has a newer version
-        sdParams = self._findParam(datasetId, self.supersededPT)
-        if len(sdParams) != 0 and not self.branching:
-            raise VicatException(VicatException.BRANCHING_NOT_PERMITTED,"Attempt to create second version of dataset " + str(datasetId) + " when branching is not allowed.")
+        datasetId = int(datasetId)
+        # Check whether the dataset already has a newer version, and find the origin of its lineage
+        # (always asking ICAT, as another client may have created a version since it was cached)
+        params = self._findParamValues([datasetId], [self.supersededPT, self.supersedesPT, self.originPT])[datasetId]
+        error = self._branchingError(datasetId, self.supersededPT in params)
+        if error is not None:
+            raise error
+        origin = self._lineageOrigin(datasetId, params)
         
         newdsid = self.session.cloneEntity("Dataset", datasetId, {"name": newName })
         
-        # Add 'superseded' parameter to original dataset,
-        # if it's not there already
-        if len(sdParams) == 0:
-            if self.branching:
-                supersededValue = 0
-            else:
-                supersededValue = newdsid
-            supersededParam = {"dataset" : {"id" : datasetId}, "type" : {"id" : self.supersededPT}, "numericValue" : supersededValue}
-            entity = {"DatasetParameter" : supersededParam}
-            self.session.write(entity)
+        self._completeVersions([(newdsid, datasetId, versionComment, origin)], self._supersededIds({datasetId : params}))
+        return newdsid
+
+    def _branchingError(self, datasetId, superseded):
+        """
+        Return the exception for an attempt to create a new version of the given dataset, if it has
+        been superseded and branching is not allowed; otherwise return None
+        """
+        if superseded and not self.branching:
+            return VicatException(VicatException.BRANCHING_NOT_PERMITTED,"Attempt to create second version of dataset " + str(datasetId) + " when branching is not allowed.")
+        return None
+
+    def _supersededIds(self, params):
+        """
+        Return the set of the ids (as ints) of the datasets that have a superseded parameter,
+        given a dict of parameter values as returned by _findParamValues
+        """
+        return set(int(dsid) for (dsid, values) in params.items() if self.supersededPT in values)
+
+    def _completeVersions(self, versions, supersededIds):
+        """
+        Make new versions of the clones: versions is a list of (newdsid, datasetId, versionComment, origin) tuples,
+        as for _setVersionParameters. A superseded parameter is written for each original dataset that is not in
+        the set supersededIds, which is updated once the parameters have been written; the cache is then updated.
+        """
+        entities = []
+        supersededValues = {}
+        for (newdsid, datasetId, versionComment, origin) in versions:
+            # Add 'superseded' parameter to original dataset,
+            # if it's not there already (or about to be written)
+            if int(datasetId) not in supersededIds and datasetId not in supersededValues:
+                if self.branching:
+                    supersededValue = 0
+                else:
+                    supersededValue = newdsid
+                supersededParam = {"dataset" : {"id" : datasetId}, "type" : {"id" : self.supersededPT}, "numericValue" : supersededValue}
+                entities.append({"DatasetParameter" : supersededParam})
+                supersededValues[datasetId] = supersededValue
+        self._setVersionParameters(versions, entities)
+        supersededIds.update(int(datasetId) for datasetId in supersededValues)
+        self._cacheVersions(versions, supersededValues)
+
+    def _setVersionParameters(self, versions, entities):
+        """
+        versions is a list of (newdsid, datasetId, versionComment, origin) tuples, where newdsid is a clone of datasetId
+        and origin is the origin of its lineage.
+        Replace the versioning parameters that each clone has inherited with those of a new version of datasetId,
+        using batched searches, deletes and writes. The new parameters are written together with the given list
+        of entities.
+        """
+        # Each clone has copies of any versioning parameters of the original:
+        # - if branching is allowed, after the first version there will be a 'superseded' parameter, which must be removed
+        # - the 'supersedes' parameter must be replaced (if the original was already a version dataset)
+        # - any comment left over from the original must be replaced or removed
+        # - the 'origin' parameter must be added (if the original was not a version) or replaced
+        self._deleteVersionParameters([version[0] for version in versions])
         
-        # Subtle point: if branching is allowed, after the first version there will be a 'superseded' parameter in this clone,
-        # which must be removed
-        self._addOrUpdateParameter(newdsid, self.supersededPT)
+        for (newdsid, datasetId, versionComment, origin) in versions:
+            supersedesParam = {"dataset" : {"id" : newdsid}, "type" : {"id" : self.supersedesPT}, "numericValue" : datasetId}
+            entities.append({"DatasetParameter" : supersedesParam})
+            originParam = {"dataset" : {"id" : newdsid}, "type" : {"id" : self.originPT}, "numericValue" : origin}
+            entities.append({"DatasetParameter" : originParam})
+            if versionComment is not None:
+                commentParam = {"dataset" : {"id" : newdsid}, "type" : {"id" : self.commentPT}, "stringValue" : versionComment}
+                entities.append({"DatasetParameter" : commentParam})
+        self._writeAll(entities)
+
+    def _deleteVersionParameters(self, datasetIds):
+        """
+        Delete the superseded, supersedes, comment and origin parameters of the given datasets
+        """
+        typeIds = ",".join(str(pt) for pt in [self.supersededPT, self.supersedesPT, self.commentPT, self.originPT])
+        paramIds = []
+        for chunk in self._chunks(datasetIds):
+            idList = ",".join(str(dsid) for dsid in chunk)
+            paramIds.extend(self._searchAll("SELECT dp.id FROM DatasetParameter dp WHERE dp.dataset.id IN (" + idList + ") AND dp.type.id IN (" + typeIds + ") ORDER BY dp.id"))
+        self._deleteAll([{"DatasetParameter" : {"id" : paramId}} for paramId in paramIds])
+
+    def _writeAll(self, entities):
+        """
+        Write the entities, in batches of at most MAX_ENTITIES_PER_WRITE
+        """
+        for i in range(0, len(entities), self.MAX_ENTITIES_PER_WRITE):
+            self.session.write(entities[i:i + self.MAX_ENTITIES_PER_WRITE])
+
+    def _deleteAll(self, entities):
+        """
+        Delete the entities, in batches of at most MAX_ENTITIES_PER_WRITE
+        """
+        for i in range(0, len(entities), self.MAX_ENTITIES_PER_WRITE):
+            self.session.delete(entities[i:i + self.MAX_ENTITIES_PER_WRITE])
+
+    @instrumented
+    def createVersions(self, versions):
+        """
+        Create new versions of many datasets in one call.
+        versions is a list of (datasetId, newName, versionComment) tuples; versionComment may be omitted.
+        Returns a list with one element for each tuple: either the id of the new dataset, or the exception
+        that prevented it being created (a VicatException if it would branch when branching is not allowed).
+        A failure for one tuple does not prevent the others from being created.
+        The superseded status of all the datasets is checked in bulk, and the parameters of the new versions
+        are written in batches as the clones are made, every MAX_VERSIONS_PER_BATCH clones. If the parameters
+        of a batch cannot be written, those of its versions are written one at a time, so that only the tuples
+        that fail get the exception; a clone whose parameters could not be written is left as a dataset that is
+        not a version.
+        """
+        results = [None] * len(versions)
+        params = self._findParamValues([version[0] for version in versions], [self.supersededPT, self.supersedesPT, self.originPT])
+        supersededIds = self._supersededIds(params)
+        # Datasets that are superseded, or of which a version has been cloned
+        claimed = set(supersededIds)
+        origins = {}
         
-        # Add 'supersedes' dataset parameter, or replace it (if the original was already a version dataset)
-        self._addOrUpdateParameter(newdsid, self.supersedesPT, datasetId)
+        pending = []
+        for i, version in enumerate(versions):
+            datasetId, newName = int(version[0]), version[1]
+            versionComment = version[2] if len(version) > 2 else None
+            error = self._branchingError(datasetId, datasetId in claimed)
+            if error is not None:
+                results[i] = error
+                continue
+            try:
+                if datasetId not in origins:
+                    origins[datasetId] = self._lineageOrigin(datasetId, params[datasetId])
+                newdsid = self.session.cloneEntity("Dataset", datasetId, {"name": newName })
+            except Exception as e:
+                results[i] = e
+                continue
+            claimed.add(datasetId)
+            pending.append((i, (newdsid, datasetId, versionComment, origins[datasetId])))
+            results[i] = newdsid
+            if len(pending) == self.MAX_VERSIONS_PER_BATCH:
+                self._completeBatch(pending, results, supersededIds)
+                pending = []
         
-        # Add the version comment (or remove any comment left over from the original clone
-        self._addOrUpdateParameter(newdsid, self.commentPT, versionComment, "stringValue")
+        if len(pending) != 0:
+            self._completeBatch(pending, results, supersededIds)
+        return results
+
+    def _completeBatch(self, pending, results, supersededIds):
+        """
+        Complete the versions in pending, a list of (index, version) pairs, where version is as for _completeVersions.
+        If that fails, complete them one at a time, setting results[index] to the exception for each that fails.
+        """
+        try:
+            self._completeVersions([version for (i, version) in pending], supersededIds)
+            return
+        except Exception as e:
+            if len(pending) == 1:
+                results[pending[0][0]] = e
+                return
+        for (i, version) in pending:
+            try:
+                self._completeVersions([version], supersededIds)
+            except Exception as e:
+                results[i] = e
 
+    @instrumented
+    def createLargeVersion(self, datasetId, newName, versionComment=None, batchSize=1000, progress=None):
+        """
+        Create a new version of the given dataset, using the new name, without relying on a single
+        server-side clone; intended for datasets with very many datafiles. Returns the id of the new dataset.
+        The new dataset is created empty, then the Datafiles (with their DatafileParameters) are copied in
+        batches of batchSize, in order of id, followed by the DatasetParameters (except for the versioning ones).
+        The versioning parameters are only written once the copy is complete, so an unfinished copy is not
+        a version. If progress is given, it is called as progress(newdsid, datafilesCopied) after each batch.
+        The new dataset carries a "vicat:copyOf" parameter until the copy is complete. If a previous call with
+        the same datasetId and newName was interrupted, calling again resumes the copy into the dataset that
+        carries it; if the version was completed, its id is returned. Any other dataset with the new name is
+        left alone, and the call fails as createVersion would.
+        """
+        datasetId = int(datasetId)
+        datasets = self.session.search("SELECT ds FROM Dataset ds WHERE ds.id=" + str(datasetId) + " INCLUDE ds.investigation, ds.type, ds.sample")
+        if len(datasets) == 0:
+            raise VicatException(VicatException.NO_SUCH_DATASET,"Attempt to create a version of dataset " + str(datasetId) + ", which does not exist")
+        dataset = datasets[0]["Dataset"]
+        investigationId = dataset["investigation"]["id"]
+        
+        # Look for the dataset left by an earlier call
+        resuming = False
+        newdsids = self.session.search("SELECT ds.id FROM Dataset ds WHERE ds.investigation.id=" + str(investigationId) + " AND ds.name=" + self._quote(newName))
+        if len(newdsids) != 0:
+            newdsid = newdsids[0]
+            newParams = self._findParamValues([newdsid], [self.supersedesPT, self.copyOfPT])[int(newdsid)]
+            if newParams.get(self.supersedesPT) == datasetId:
+                self._deleteCopyMarker(newdsid)
+                return newdsid
+            resuming = newParams.get(self.copyOfPT) == datasetId
+        
+        params = self._findParamValues([datasetId], [self.supersededPT, self.supersedesPT, self.originPT])[int(datasetId)]
+        error = self._branchingError(datasetId, self.supersededPT in params)
+        if error is not None:
+            raise error
+        origin = self._lineageOrigin(datasetId, params)
+        
+        if not resuming:
+            newDataset = {"name" : newName, "investigation" : {"id" : investigationId}, "type" : {"id" : dataset["type"]["id"]}}
+            if "sample" in dataset:
+                newDataset["sample"] = {"id" : dataset["sample"]["id"]}
+            self._copyFields(dataset, newDataset, self._DATASET_FIELDS)
+            # The marker is written with the dataset, so that a copy cannot be left without one
+            newDataset["parameters"] = [{"type" : {"id" : self.copyOfPT}, "numericValue" : datasetId}]
+            newdsid = self.session.write({"Dataset" : newDataset})[0]
+        
+        copied = 0
+        lastId = 0
+        while True:
+            page = self.session.search("SELECT df FROM Datafile df WHERE df.dataset.id=" + str(datasetId) + " AND df.id > " + str(lastId)
+                                       + " ORDER BY df.id INCLUDE df.datafileFormat LIMIT 0, " + str(batchSize))
+            if len(page) == 0:
+                break
+            datafiles = [entity["Datafile"] for entity in page]
+            lastId = datafiles[-1]["id"]
+            if resuming:
+                # Batches are written in order, so once a batch has not been copied at all, neither have the rest
+                existing = self._existingDatafiles(newdsid, [datafile["name"] for datafile in datafiles])
+                resuming = len(existing) != 0
+                copied += len(existing)
+                datafiles = [datafile for datafile in datafiles if datafile["name"] not in existing]
+            if len(datafiles) != 0:
+                self._copyDatafiles(datafiles, newdsid)
+                copied += len(datafiles)
+            if progress is not None:
+                progress(newdsid, copied)
+            if len(page) < batchSize:
+                break
+        
+        typeIds = ",".join(str(getattr(self, attribute)) for (name, attribute, valueType, description) in self._PARAMETER_TYPES)
+        copiedTypes = set(self.session.search("SELECT dp.type.id FROM DatasetParameter dp WHERE dp.dataset.id=" + str(newdsid)))
+        entities = []
+        for row in self._searchAll("SELECT dp.type.id, dp." + ", dp.".join(self._PARAMETER_FIELDS) + " FROM DatasetParameter dp WHERE dp.dataset.id="
+                                   + str(datasetId) + " AND dp.type.id NOT IN (" + typeIds + ") ORDER BY dp.id"):
+            if row[0] not in copiedTypes:
+                entities.append({"DatasetParameter" : self._parameter(row, "dataset", newdsid)})
+        self._writeAll(entities)
+        
+        # The copy is complete: make it a version
+        self._completeVersions([(newdsid, datasetId, versionComment, origin)], self._supersededIds({datasetId : params}))
+        self._deleteCopyMarker(newdsid)
         return newdsid
 
+    def _deleteCopyMarker(self, newdsid):
+        """
+        Delete the "vicat:copyOf" parameter of a dataset made by createLargeVersion, if it has one
+        """
+        self._deleteAll([{"DatasetParameter" : {"id" : pid}} for pid in self._findParam(newdsid, self.copyOfPT)])
+
+    def _copyDatafiles(self, datafiles, newdsid):
+        """
+        Write copies of the given Datafile entities (and their DatafileParameters) in the dataset newdsid
+        """
+        copies = {}
+        for datafile in datafiles:
+            copy = {"dataset" : {"id" : newdsid}, "parameters" : []}
+            if "datafileFormat" in datafile:
+                copy["datafileFormat"] = {"id" : datafile["datafileFormat"]["id"]}
+            self._copyFields(datafile, copy, self._DATAFILE_FIELDS)
+            copies[datafile["id"]] = copy
+        for chunk in self._chunks(list(copies)):
+            idList = ",".join(str(dfid) for dfid in chunk)
+            for row in self._searchAll("SELECT p.datafile.id, p.type.id, p." + ", p.".join(self._PARAMETER_FIELDS) + " FROM DatafileParameter p WHERE p.datafile.id IN ("
+                                       + idList + ") ORDER BY p.id"):
+                copies[row[0]]["parameters"].append(self._parameter(row[1:]))
+        self._writeAll([{"Datafile" : copies[datafile["id"]]} for datafile in datafiles])
+
+    def _existingDatafiles(self, datasetId, names):
+        """
+        Return the set of the given names that are names of Datafiles of the given dataset
+        """
+        existing = set()
+        for chunk in self._chunks(names):
+            existing.update(self.session.search("SELECT df.name FROM Datafile df WHERE df.dataset.id=" + str(datasetId)
+                                                + " AND df.name IN (" + ",".join(self._quote(name) for name in chunk) + ")"))
+        return existing
+
+    def _parameter(self, row, owner=None, ownerId=None):
+        """
+        Build a parameter from a [typeId, value fields...] row (see _PARAMETER_FIELDS), optionally owned by the given entity
+        """
+        param = {"type" : {"id" : row[0]}}
+        for (field, value) in zip(self._PARAMETER_FIELDS, row[1:]):
+            if value is not None:
+                param[field] = value
+        if owner is not None:
+            param[owner] = {"id" : ownerId}
+        return param
+
+    def _copyFields(self, source, target, fields):
+        for field in fields:
+            if source.get(field) is not None:
+                target[field] = source[field]
+
+    def _quote(self, value):
+        return "'" + value.replace("'", "''") + "'"
+
+    def _lineageOrigin(self, datasetId, params):
+        """
+        Return the origin of the lineage of datasetId, given a dict of the values of its
+        supersedes and origin parameters (as returned by _findParamValues)
+        """
+        if self.originPT in params:
+            return params[self.originPT]
+        if self.supersedesPT not in params:
+            # Not a version, so this is the original
+            return datasetId
+        # A version created before origins were recorded (see backfillOrigins)
+        return self.ancestors(datasetId)[0]
+
+    def _lineageChildren(self, datasetId):
+        """
+        Return the origin of the lineage of the given dataset, and a dict mapping each dataset in the lineage
+        that has versions to the list of its direct versions, in order of creation.
+        The versions that record the origin are found with one (paged) search. If that misses part of the lineage
+        (versions created before origins were recorded, which may have later versions that do record it), as shown
+        by a superseded dataset with no versions found, or by the given dataset not being found, the lineage is
+        found a level at a time from the origin instead, with one search for each level.
+        """
+        params = self._findParamValues([datasetId], [self.supersededPT, self.supersedesPT, self.originPT])[int(datasetId)]
+        origin = self._lineageOrigin(datasetId, params)
+        superseded = set()
+        if self.supersededPT in params:
+            superseded.add(int(datasetId))
+        children = {}
+        rows = self._searchAll("SELECT dp.dataset.id, dp.type.id, dp.numericValue FROM DatasetParameter dp JOIN dp.dataset ds JOIN ds.parameters o"
+                               + " WHERE dp.type.id IN (" + str(self.supersedesPT) + ", " + str(self.supersededPT) + ") AND o.type.id=" + str(self.originPT)
+                               + " AND o.numericValue=" + str(origin) + " ORDER BY dp.id")
+        for (dsid, ptid, value) in rows:
+            if ptid == self.supersedesPT:
+                children.setdefault(int(value), []).append(dsid)
+            else:
+                superseded.add(dsid)
+        
+        # Check that nothing is missing
+        reached = set([int(origin)])
+        frontier = [int(origin)]
+        complete = True
+        while complete and len(frontier) != 0:
+            current = frontier.pop()
+            versions = children.get(current, [])
+            complete = len(versions) != 0 or current not in superseded
+            for child in versions:
+                if child not in reached:
+                    reached.add(child)
+                    frontier.append(child)
+        if complete and int(datasetId) in reached:
+            return (origin, children)
+        
+        children = {}
+        reached = set([int(origin)])
+        frontier = [int(origin)]
+        while len(frontier) != 0:
+            nextFrontier = []
+            for (child, parent) in self._childrenOf(frontier):
+                if child not in reached:
+                    reached.add(child)
+                    children.setdefault(int(parent), []).append(child)
+                    nextFrontier.append(child)
+            frontier = nextFrontier
+        return (origin, children)
+
+    @instrumented
+    def origin(self, datasetId):
+        """
+        Return the id of the original dataset from which the given dataset was (ultimately) versioned.
+        A dataset that is not a version is its own origin.
+        """
+        params = self._findParamValues([datasetId], [self.supersedesPT, self.originPT])[int(datasetId)]
+        return self._lineageOrigin(datasetId, params)
+
+    @instrumented
+    def lineage(self, datasetId):
+        """
+        Return a list of all the datasets in the version history of the given dataset: its origin,
+        followed by every version created from it, directly or indirectly, each after the dataset it supersedes.
+        """
+        (origin, children) = self._lineageChildren(datasetId)
+        lineage = [origin]
+        seen = set([int(origin)])
+        i = 0
+        while i < len(lineage):
+            for child in children.get(int(lineage[i]), []):
+                if child not in seen:
+                    seen.add(child)
+                    lineage.append(child)
+            i += 1
+        return lineage
+
+    @instrumented
+    def latest(self, datasetId):
+        """
+        Return the latest version of the given dataset (the dataset itself, if it has not been superseded).
+        If branching is permitted, return a list of all the latest versions (the leaves of the tree of
+        versions created from the dataset) instead. If branching is not permitted, but the dataset's history
+        has branched, this raises an exception.
+        """
+        (origin, children) = self._lineageChildren(datasetId)
+        leaves = []
+        frontier = [int(datasetId)]
+        seen = set(frontier)
+        while len(frontier) != 0:
+            current = frontier.pop()
+            versions = [child for child in children.get(current, []) if child not in seen]
+            if len(versions) == 0:
+                leaves.append(current)
+            elif len(versions) > 1 and not self.branching:
+                raise VicatException(VicatException.BRANCHING_PERMITTED,"Attempt to obtain single latest version of dataset " + str(datasetId) + " whose history has branched")
+            seen.update(versions)
+            frontier.extend(versions)
+        if self.branching:
+            return sorted(leaves)
+        return leaves[0]
+
+    @instrumented
+    def backfillOrigins(self):
+        """
+        Record the origin parameter of every version on the Facility that does not have a correct one
+        (for example, versions created before origins were recorded), and remove origin parameters from
+        datasets that are not versions. Returns the number of datasets whose origin was written.
+        All the supersedes and origin parameters of the Facility are read, in pages, and the
+        changes are made in batches.
+        """
+        parents = {}
+        for (dsid, parent) in self._searchAll("SELECT dp.dataset.id, dp.numericValue FROM DatasetParameter dp WHERE dp.type.id=" + str(self.supersedesPT) + " ORDER BY dp.id"):
+            parents.setdefault(dsid, parent)
+        existing = {}
+        for (dsid, paramId, origin) in self._searchAll("SELECT dp.dataset.id, dp.id, dp.numericValue FROM DatasetParameter dp WHERE dp.type.id=" + str(self.originPT) + " ORDER BY dp.id"):
+            existing.setdefault(dsid, []).append((paramId, origin))
+        
+        # Find the origin of each version without recursion, remembering the origins found on the way
+        origins = {}
+        for dsid in parents:
+            path = []
+            onPath = set()
+            current = dsid
+            while current in parents and current not in origins and current not in onPath:
+                path.append(current)
+                onPath.add(current)
+                current = parents[current]
+            origin = origins.get(current, current)
+            for node in path:
+                origins[node] = origin
+        
+        deletes = []
+        writes = []
+        for (dsid, params) in existing.items():
+            if dsid not in origins:
+                deletes.extend(params)
+                if self.cache is not None:
+                    self.cache.invalidate((self.originPT, int(dsid)))
+        for (dsid, origin) in origins.items():
+            params = existing.get(dsid, [])
+            if len(params) == 1 and params[0][1] == origin:
+                continue
+            deletes.extend(params)
+            originParam = {"dataset" : {"id" : dsid}, "type" : {"id" : self.originPT}, "numericValue" : origin}
+            writes.append({"DatasetParameter" : originParam})
+            if self.cache is not None:
+                self.cache.invalidate((self.originPT, int(dsid)))
+        self._deleteAll([{"DatasetParameter" : {"id" : paramId}} for (paramId, origin) in deletes])
+        self._writeAll(writes)
+        return len(writes)
+
+    def _childrenOf(self, datasetIds):
+        """
+        Return a list of [childId, parentId] lists for the direct versions of any of the given datasets,
+        in order of parent, then child, using one search for each chunk of MAX_IDS_PER_QUERY datasets
+        """
+        children = []
+        for chunk in self._chunks(list(datasetIds)):
+            idList = ",".join(str(int(dsid)) for dsid in chunk)
+            children.extend(self._searchAll("SELECT dp.dataset.id, dp.numericValue FROM DatasetParameter dp WHERE dp.type.id=" + str(self.supersedesPT)
+                                            + " AND dp.numericValue IN (" + idList + ") ORDER BY dp.numericValue, dp.dataset.id"))
+        return children
+
+    @instrumented
+    def children(self, datasetId):
+        """
+        Return a list of the ids of the datasets that are direct versions of the given dataset.
+        Unlike superseded, this is permitted when branching is in effect.
+        """
+        return [child for (child, parent) in self._childrenOf([datasetId])]
+
+    @instrumented
+    def descendantTree(self, datasetId):
+        """
+        Return a VersionTree of the given dataset and all the versions created from it, directly or indirectly.
+        Unlike descendants, this is permitted when branching is in effect.
+        The tree is found a level at a time, with one search (per chunk of MAX_IDS_PER_QUERY datasets) for each level.
+        """
+        datasetId = int(datasetId)
+        ids = array("q", [datasetId])
+        parents = array("q", [-1])
+        index = {datasetId : 0}
+        frontier = [datasetId]
+        while len(frontier) != 0:
+            nextFrontier = []
+            for (child, parent) in self._childrenOf(frontier):
+                if child in index:
+                    continue
+                index[child] = len(ids)
+                ids.append(child)
+                parents.append(index[parent])
+                nextFrontier.append(child)
+            frontier = nextFrontier
+        return VersionTree(ids, parents)
+
+    @instrumented
     def isSuperseded(self, datasetId):
         '''
         True if one or more new versions have been created from this Dataset
         '''
-        sdParams = self._findParam(datasetId, self.supersededPT)
-        return len(sdParams) > 0
+        return self._paramValue(datasetId, self.supersededPT, "numericValue") is not None
     
+    @instrumented
     def superseded(self, datasetId):
         """
         Return the dataset id of the dataset, if any, that is the next newest version of the given dataset.
@@ -211,11 +1247,10 @@ class VICAT(object):
         if self.branching:
             raise VicatException(VicatException.BRANCHING_PERMITTED,"Attempt to obtain single descendant from dataset " + str(datasetId) + " when branching is permitted")
 
-        sdParams = self._findParam(datasetId, self.supersededPT, "numericValue")
-        if len(sdParams) == 0:
+        sdVal = self._paramValue(datasetId, self.supersededPT, "numericValue")
+        if sdVal is None:
             return None
         else:
-            sdVal = sdParams[0][1]
             # Secondary guard: this instance may not believe branching is permitted,
             # but it may have been allowed in the past - note different error message!
             if sdVal == 0:
@@ -223,27 +1258,24 @@ class VICAT(object):
             else:
                 return sdVal
     
+    @instrumented
     def supersedes(self, datasetId):
         '''
         If this dataset is a new version, return the datasetId of the dataset it (immediately) supersedes.
         If it is not a version, return None
         '''
-        ssParams = self._findParam(datasetId, self.supersedesPT, "numericValue")
-        if len(ssParams) == 0:
-            return None
-        else:
-            return ssParams[0][1]
+        return self._paramValue(datasetId, self.supersedesPT, "numericValue")
 
+    @instrumented
     def ancestors(self, datasetId):
         """
         Returns a list of ancestors (previous versions) of the given datasetId.
         """
-        parent = self.supersedes(datasetId)
-        if parent is not None:
-            return self.ancestors(parent) + [parent]
-        else:
-            return []
+        ancestors = [parent for (child, parent) in self._chain(datasetId, self.supersedesPT)]
+        ancestors.reverse()
+        return ancestors
     
+    @instrumented
     def descendants(self, datasetId):
         """
         Returns a list of descendants (newer versions) of the given datasetId.
@@ -251,20 +1283,253 @@ class VICAT(object):
         """
         if self.branching:
             raise VicatException(VicatException.BRANCHING_PERMITTED,"Attempt to obtain descendants from dataset " + str(datasetId) + " when branching is permitted")
-        child = self.superseded(datasetId)
-        if child is not None:
-            return [child] + self.descendants(child)
-        else:
-            return []
+        descendants = []
+        for (parent, child) in self._chain(datasetId, self.supersededPT):
+            # Same guard as in superseded()
+            if child == 0:
+                raise VicatException(VicatException.BRANCHING_PERMITTED,"Attempt to obtain single descendant from dataset " + str(parent) + " that was superseded when branching was permitted")
+            descendants.append(child)
+        return descendants
 
+    @instrumented
+    def isSupersededMany(self, datasetIds):
+        """
+        Batch form of isSuperseded: return a dict mapping each of the given datasetIds to True
+        if one or more new versions have been created from it
+        """
+        sdVals = self._paramValues(datasetIds, self.supersededPT, "numericValue")
+        return dict((dsid, sdVal is not None) for (dsid, sdVal) in sdVals.items())
+
+    @instrumented
+    def supersededMany(self, datasetIds):
+        """
+        Batch form of superseded: return a dict mapping each of the given datasetIds to the dataset id
+        of its next newest version, or to None if it has none.
+        Raises the same exceptions as superseded, for the first offending datasetId.
+        """
+        if self.branching:
+            raise VicatException(VicatException.BRANCHING_PERMITTED,"Attempt to obtain single descendants from datasets when branching is permitted")
+
+        sdVals = self._paramValues(datasetIds, self.supersededPT, "numericValue")
+        for dsid in datasetIds:
+            if sdVals[dsid] == 0:
+                raise VicatException(VicatException.BRANCHING_PERMITTED,"Attempt to obtain single descendant from dataset " + str(dsid) + " that was superseded when branching was permitted")
+        return sdVals
+
+    @instrumented
+    def supersedesMany(self, datasetIds):
+        """
+        Batch form of supersedes: return a dict mapping each of the given datasetIds to the datasetId
+        of the dataset it (immediately) supersedes, or to None if it is not a version
+        """
+        return self._paramValues(datasetIds, self.supersedesPT, "numericValue")
+
+    @instrumented
+    def versionCommentMany(self, datasetIds):
+        """
+        Batch form of versionComment: return a dict mapping each of the given datasetIds
+        to its version comment, or to None if it does not have one
+        """
+        return self._paramValues(datasetIds, self.commentPT, "stringValue")
+
+    @instrumented
     def versionComment(self,datasetId):
         """
         Return the version comment for the given datasetId, if it has one
         """
-        sdParams = self._findParam(datasetId, self.commentPT, "stringValue")
-        if len(sdParams) == 0:
-            return None
-        else:
-            return sdParams[0][1]
+        return self._paramValue(datasetId, self.commentPT, "stringValue")
         
 
+    def _searchPages(self, idPath, selectors, entity, condition=""):
+        """
+        Generate the pages of results of "SELECT idPath[, selectors] FROM entity WHERE condition", in order of
+        idPath, with up to MAX_RESULTS_PER_QUERY results in each. Each page is fetched with LIMIT 0, n after the
+        last id of the one before, rather than at an increasing offset, so that later pages cost no more than the
+        first. If there are no selectors, the results are ids; otherwise they are lists starting with the id.
+        """
+        lastId = 0
+        select = idPath if len(selectors) == 0 else idPath + ", " + ", ".join(selectors)
+        while True:
+            page = self.session.search("SELECT " + select + " FROM " + entity + " WHERE " + idPath + " > " + str(lastId) + condition
+                                       + " ORDER BY " + idPath + " LIMIT 0, " + str(self.MAX_RESULTS_PER_QUERY))
+            if len(page) != 0:
+                yield page
+            if len(page) < self.MAX_RESULTS_PER_QUERY:
+                return
+            lastId = page[-1] if len(selectors) == 0 else page[-1][0]
+
+    def _datasetConditions(self, datasetPath, investigationId, datasetTypeId):
+        """
+        Return the conditions restricting the datasets at datasetPath to the given Investigation and DatasetType (if not None)
+        """
+        condition = ""
+        if investigationId is not None:
+            condition += " AND " + datasetPath + ".investigation.id=" + str(investigationId)
+        if datasetTypeId is not None:
+            condition += " AND " + datasetPath + ".type.id=" + str(datasetTypeId)
+        return condition
+
+    def iterSuperseded(self, investigationId=None, datasetTypeId=None):
+        """
+        Generate the ids of all the datasets of the Facility that have been superseded, in order of the creation
+        of their first version, optionally only those in the given Investigation and/or of the given DatasetType.
+        The parameters are fetched a page at a time, so memory use does not grow with the number of datasets.
+        """
+        condition = " AND dp.type.id=" + str(self.supersededPT) + self._datasetConditions("dp.dataset", investigationId, datasetTypeId)
+        for page in self._searchPages("dp.id", ["dp.dataset.id"], "DatasetParameter dp", condition):
+            for (paramId, dsid) in page:
+                yield dsid
+
+    def iterVersions(self, investigationId=None, datasetTypeId=None):
+        """
+        Generate a (datasetId, supersedesId) pair for every dataset of the Facility that is a version of another,
+        in order of creation, optionally only those in the given Investigation and/or of the given DatasetType.
+        The parameters are fetched a page at a time, so memory use does not grow with the number of datasets.
+        """
+        condition = " AND dp.type.id=" + str(self.supersedesPT) + self._datasetConditions("dp.dataset", investigationId, datasetTypeId)
+        for page in self._searchPages("dp.id", ["dp.dataset.id", "dp.numericValue"], "DatasetParameter dp", condition):
+            for (paramId, dsid, supersedes) in page:
+                yield (dsid, int(supersedes))
+
+    def iterLatestVersions(self, investigationId=None, datasetTypeId=None, versionsOnly=False):
+        """
+        Generate the ids of all the datasets of the Facility that have not been superseded, in order of id,
+        optionally only those in the given Investigation and/or of the given DatasetType.
+        If versionsOnly is True, datasets that have never been versioned (which are their own latest version)
+        are left out, so only the latest versions of version histories are generated.
+        The datasets are fetched a page at a time, each with one more search for the versioning parameters
+        of the datasets in the page, so memory use does not grow with the number of datasets.
+        """
+        datasetCondition = self._datasetConditions("ds", investigationId, datasetTypeId)
+        paramCondition = self._datasetConditions("dp.dataset", investigationId, datasetTypeId)
+        typeIds = str(self.supersededPT) + ", " + str(self.supersedesPT) if versionsOnly else str(self.supersededPT)
+        for page in self._searchPages("ds.id", [], "Dataset ds", " AND ds.investigation.facility.id=" + str(self.fid) + datasetCondition):
+            # The page holds every matching dataset in its range of ids, so the parameters of the page can be found by range
+            params = self._searchAll("SELECT dp.dataset.id, dp.type.id FROM DatasetParameter dp WHERE dp.type.id IN (" + typeIds + ")"
+                                     + " AND dp.dataset.id >= " + str(page[0]) + " AND dp.dataset.id <= " + str(page[-1]) + paramCondition
+                                     + " ORDER BY dp.id")
+            superseded = set(dsid for (dsid, ptid) in params if ptid == self.supersededPT)
+            versions = set(dsid for (dsid, ptid) in params if ptid == self.supersedesPT)
+            for dsid in page:
+                if dsid not in superseded and (not versionsOnly or dsid in versions):
+                    yield dsid
+
+    def _datafileKeys(self, datasetId):
+        """
+        Generate a (name, hash of location, checksum and fileSize) pair for each Datafile of the dataset, a page at a time
+        """
+        for page in self._searchPages("df.id", ["df.name", "df.location", "df.checksum", "df.fileSize"], "Datafile df", " AND df.dataset.id=" + str(datasetId)):
+            for (dfid, name, location, checksum, fileSize) in page:
+                yield (name, hash((location, checksum, fileSize)))
+
+    def _parameterKeys(self, datasetId):
+        """
+        Generate a (type name, hash of value) pair for each DatasetParameter of the dataset, except for the versioning ones
+        """
+        typeIds = ",".join(str(getattr(self, attribute)) for (name, attribute, valueType, description) in self._PARAMETER_TYPES)
+        selectors = ["dp.type.name", "dp.numericValue", "dp.stringValue", "dp.dateTimeValue", "dp.error", "dp.rangeBottom", "dp.rangeTop"]
+        for page in self._searchPages("dp.id", selectors, "DatasetParameter dp", " AND dp.dataset.id=" + str(datasetId) + " AND dp.type.id NOT IN (" + typeIds + ")"):
+            for row in page:
+                yield (row[1], hash(tuple(row[2:])))
+
+    def _diffKeys(self, oldKeys, newKeys):
+        """
+        Compare two streams of (key, hash) pairs; return the sets of added, removed and changed keys.
+        Only the old keys are held in memory.
+        """
+        old = dict(oldKeys)
+        added = set()
+        changed = set()
+        for (key, keyHash) in newKeys:
+            oldHash = old.pop(key, None)
+            if oldHash is None:
+                added.add(key)
+            elif oldHash != keyHash:
+                changed.add(key)
+        return (added, set(old), changed)
+
+    @instrumented
+    def diffVersions(self, datasetId, otherId=None):
+        """
+        Return a VersionDiff describing what changed from the dataset datasetId to the dataset otherId
+        (which need not be related to it). If otherId is None, describe what changed from the version that
+        datasetId supersedes to datasetId itself.
+        The Datafiles and parameters of both datasets are fetched a page at a time and matched by name;
+        only the names and a hash of the fields of the first dataset's are held in memory.
+        """
+        if otherId is None:
+            parentId = self.supersedes(datasetId)
+            if parentId is None:
+                raise VicatException(VicatException.NOT_A_VERSION,"Attempt to compare dataset " + str(datasetId) + " with the version it supersedes when it is not a version")
+            datasetId, otherId = int(parentId), datasetId
+        (addedDatafiles, removedDatafiles, changedDatafiles) = self._diffKeys(self._datafileKeys(datasetId), self._datafileKeys(otherId))
+        (addedParameters, removedParameters, changedParameters) = self._diffKeys(self._parameterKeys(datasetId), self._parameterKeys(otherId))
+        return VersionDiff(addedDatafiles, removedDatafiles, changedDatafiles, addedParameters, removedParameters, changedParameters)
+
+    def _changeNames(self):
+        return {self.supersedesPT : self.SUPERSEDES, self.supersededPT : self.SUPERSEDED}
+
+    @instrumented
+    def changesSince(self, cursor=None, limit=None):
+        """
+        Return a list of up to limit (default MAX_RESULTS_PER_QUERY) Changes: the supersedes and superseded
+        parameters of the Facility created or modified after the cursor, in order of modTime then id, and the
+        cursor to pass to the next call. A cursor is a (modTime, paramId) pair; None means the beginning.
+        When there are no more changes, the list is empty and the cursor is returned unchanged.
+        Deleted parameters are not reported.
+        """
+        if limit is None:
+            limit = self.MAX_RESULTS_PER_QUERY
+        names = self._changeNames()
+        query = ("SELECT dp.id, dp.dataset.id, dp.type.id, dp.numericValue, dp.modTime FROM DatasetParameter dp WHERE dp.type.id IN ("
+                 + str(self.supersedesPT) + ", " + str(self.supersededPT) + ")")
+        if cursor is not None:
+            # Timestamp literals are truncated to the second, so changes earlier in the cursor's second are skipped here
+            query += " AND dp.modTime >= " + timestampLiteral(cursor[0])
+        query += " ORDER BY dp.modTime, dp.id"
+        changes = []
+        offset = 0
+        while True:
+            rows = self.session.search(query + " LIMIT " + str(offset) + ", " + str(limit))
+            for (paramId, dsid, ptid, value, modTime) in rows:
+                if cursor is not None and (modTime, paramId) <= tuple(cursor):
+                    continue
+                changes.append(Change(paramId, dsid, names[ptid], int(value), modTime))
+                if len(changes) == limit:
+                    break
+            # Only if a whole page was skipped (all in the cursor's second) is another search needed
+            if len(changes) != 0 or len(rows) < limit:
+                break
+            offset += len(rows)
+        if len(changes) != 0:
+            cursor = (changes[-1].modTime, changes[-1].paramId)
+        return (changes, cursor)
+
+    @instrumented
+    def latestCursor(self):
+        """
+        Return the cursor of the most recent change, so that changesSince(latestCursor()) reports only later changes
+        """
+        rows = self.session.search("SELECT dp.modTime, dp.id FROM DatasetParameter dp WHERE dp.type.id IN (" + str(self.supersedesPT) + ", "
+                                   + str(self.supersededPT) + ") ORDER BY dp.modTime DESC, dp.id DESC LIMIT 0, 1")
+        return tuple(rows[0]) if len(rows) != 0 else None
+
+    def followChanges(self, cursor=None, interval=1.0, maxInterval=60.0, stop=None):
+        """
+        Poll for changes, generating a (changes, cursor) pair for each non-empty page returned by changesSince.
+        After a poll that finds nothing, wait before polling again, doubling the wait each time up to maxInterval,
+        and going back to interval once changes are found. If stop (such as a threading.Event) is given, waits
+        use stop.wait, and the generator finishes once stop.is_set() is true.
+        """
+        wait = interval
+        while stop is None or not stop.is_set():
+            (changes, cursor) = self.changesSince(cursor)
+            if len(changes) != 0:
+                yield (changes, cursor)
+                wait = interval
+                continue
+            if stop is None:
+                time.sleep(wait)
+            else:
+                stop.wait(wait)
+            wait = min(wait * 2, maxInterval)
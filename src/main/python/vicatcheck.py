@@ -0,0 +1,284 @@
+'''
+A consistency checker for the versioning parameters of a Facility.
+
+VersionChecker reads every versioning DatasetParameter of a Facility (one thread per ParameterType),
+builds the version graph in compact arrays, and reports the problems it finds: versions whose history
+loops or refers to datasets that no longer exist, duplicate parameters, parameters left behind by
+interrupted createVersion calls, superseded parameters that do not match the versions of a dataset,
+and histories that do not match the branching setting. Most problems can be repaired, in batches.
+'''
+import copy
+from array import array
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Problem(namedtuple("Problem", ["kind", "datasetId", "message", "deletes", "writes"])):
+    '''
+    A problem found by VersionChecker: its kind (one of the VersionChecker constants), the dataset concerned,
+    a description, and the repair: a tuple of the ids of DatasetParameters to delete, and a tuple of
+    (ParameterType id, numericValue) pairs for the DatasetParameters of the dataset to write.
+    A problem with no deletes or writes can only be reported.
+    '''
+    __slots__ = ()
+
+    def fixable(self):
+        return len(self.deletes) != 0 or len(self.writes) != 0
+
+
+class VersionChecker(object):
+    '''
+    Checks (and repairs) the versioning parameters of the Facility of a VICAT instance.
+    '''
+
+    # A dataset has more than one parameter of the same versioning type
+    DUPLICATE = "DUPLICATE"
+    # A version supersedes a dataset that does not exist
+    DANGLING = "DANGLING"
+    # Following the supersedes parameters from a dataset leads back to it
+    CYCLE = "CYCLE"
+    # A dataset that is not a version has a comment or origin parameter (such as one copied into an unfinished clone)
+    ORPHAN = "ORPHAN"
+    # A dataset has a superseded parameter, but no versions
+    STALE_SUPERSEDED = "STALE_SUPERSEDED"
+    # A dataset has versions, but no superseded parameter
+    MISSING_SUPERSEDED = "MISSING_SUPERSEDED"
+    # A dataset's superseded parameter does not name its version
+    WRONG_SUPERSEDED = "WRONG_SUPERSEDED"
+    # A superseded parameter written with the wrong branching setting, such as 0 in a linear history
+    BRANCHING_MISMATCH = "BRANCHING_MISMATCH"
+    # A dataset has several versions although branching is not permitted
+    BRANCHED = "BRANCHED"
+    # A version has no origin parameter, or one that is not the first dataset of its history
+    WRONG_ORIGIN = "WRONG_ORIGIN"
+
+    def __init__(self, vicat, login = None):
+        '''
+        Constructor; takes the VICAT whose Facility, ParameterTypes and branching setting are used, and
+        optionally a callable that returns a new, logged-in ICAT session. If login is given, the parameters
+        of the different types are read at the same time, each on its own session; otherwise they are read
+        one type at a time on the VICAT's session. Repairs are always made with the VICAT's session.
+        '''
+        self.vicat = vicat
+        self.login = login
+
+    def _readType(self, paramTypeId):
+        """
+        Return parallel arrays of the dataset ids, parameter ids and numeric values (0 if null)
+        of all the parameters of the given type, in order of parameter id
+        """
+        vicat = self.vicat
+        if self.login is not None:
+            vicat = copy.copy(vicat)
+            vicat.session = self.login()
+        datasetIds = array("q")
+        paramIds = array("q")
+        values = array("q")
+        for page in vicat._searchPages("dp.id", ["dp.dataset.id", "dp.numericValue"], "DatasetParameter dp", " AND dp.type.id=" + str(paramTypeId)):
+            for (paramId, dsid, value) in page:
+                paramIds.append(paramId)
+                datasetIds.append(dsid)
+                values.append(int(value) if value is not None else 0)
+        return (datasetIds, paramIds, values)
+
+    def _load(self):
+        vicat = self.vicat
+        typeIds = [vicat.supersededPT, vicat.supersedesPT, vicat.commentPT, vicat.originPT]
+        with ThreadPoolExecutor(len(typeIds) if self.login is not None else 1) as executor:
+            return dict(zip(typeIds, executor.map(self._readType, typeIds)))
+
+    def check(self):
+        '''
+        Read all the versioning parameters of the Facility and return a list of the Problems found
+        '''
+        vicat = self.vicat
+        columns = self._load()
+        problems = []
+
+        # Number the datasets; for each node (dataset), the arrays hold the id of its parameter of each type (0 if none)
+        # and the value of its superseded and origin parameters
+        nodes = {}
+        ids = array("q")
+        def node(dsid):
+            index = nodes.get(dsid)
+            if index is None:
+                index = nodes[dsid] = len(ids)
+                ids.append(dsid)
+            return index
+        for (datasetIds, paramIds, values) in columns.values():
+            for dsid in datasetIds:
+                node(dsid)
+        known = len(ids)
+        paramOf = {}
+        valueOf = {}
+        for (typeId, (datasetIds, paramIds, values)) in columns.items():
+            params = paramOf[typeId] = array("q", [0]) * known
+            nodeValues = valueOf[typeId] = array("q", [0]) * known
+            for i in range(len(datasetIds)):
+                index = nodes[datasetIds[i]]
+                if params[index] != 0:
+                    problems.append(Problem(self.DUPLICATE, datasetIds[i], "Dataset " + str(datasetIds[i]) + " has more than one parameter of type " + str(typeId),
+                                            (paramIds[i],), ()))
+                    continue
+                params[index] = paramIds[i]
+                nodeValues[index] = values[i]
+        columns = None
+
+        # The version graph: parent[i] is the node that node i supersedes, or -1
+        parent = array("q", [-1]) * known
+        childCount = array("l", [0]) * known
+        onlyChild = array("q", [-1]) * known
+        supersedesParams = paramOf[vicat.supersedesPT]
+        for index in range(known):
+            if supersedesParams[index] != 0:
+                parentIndex = node(valueOf[vicat.supersedesPT][index])
+                if parentIndex == len(childCount):
+                    # Datasets without parameters are only found as the targets of supersedes
+                    childCount.append(0)
+                    onlyChild.append(-1)
+                parent[index] = parentIndex
+                childCount[parentIndex] += 1
+                onlyChild[parentIndex] = index
+        exists = self._existing([ids[index] for index in range(known, len(ids))])
+
+        problems.extend(self._checkHistories(ids, known, parent, exists, paramOf, valueOf))
+        problems.extend(self._checkSuperseded(ids, known, childCount, onlyChild, exists, paramOf, valueOf))
+        for index in range(known):
+            if supersedesParams[index] == 0:
+                stale = tuple(paramOf[ptid][index] for ptid in (vicat.commentPT, vicat.originPT) if paramOf[ptid][index] != 0)
+                if len(stale) != 0:
+                    problems.append(Problem(self.ORPHAN, ids[index], "Dataset " + str(ids[index]) + " is not a version, but has comment or origin parameters", stale, ()))
+        return problems
+
+    def _existing(self, datasetIds):
+        """
+        Return the set of those of the given dataset ids that exist
+        """
+        found = set()
+        for chunk in self.vicat._chunks(datasetIds):
+            found.update(self.vicat._searchAll("SELECT ds.id FROM Dataset ds WHERE ds.id IN (" + ",".join(str(dsid) for dsid in chunk) + ") ORDER BY ds.id"))
+        return found
+
+    def _checkHistories(self, ids, known, parent, exists, paramOf, valueOf):
+        """
+        Follow the supersedes parameters from every version without recursion, finding cycles and missing
+        datasets, and check the origin of each version against the first dataset of its history
+        """
+        vicat = self.vicat
+        problems = []
+        # root[i] is the node index of the first dataset in the history of node i, -1 if not yet known,
+        # or -2 if the history is broken (by a cycle or a missing dataset)
+        root = array("q", [-1]) * len(ids)
+        state = array("b", [0]) * len(ids)
+        for start in range(known):
+            if parent[start] == -1 or root[start] != -1:
+                continue
+            path = []
+            current = start
+            while current < known and parent[current] != -1 and root[current] == -1 and state[current] == 0:
+                state[current] = 1
+                path.append(current)
+                current = parent[current]
+            if current < len(ids) and state[current] == 1:
+                cycle = path[path.index(current):]
+                problems.append(Problem(self.CYCLE, ids[current], "The history of dataset " + str(ids[current]) + " is a cycle: "
+                                        + " <- ".join(str(ids[index]) for index in cycle), (), ()))
+                found = -2
+            elif current >= known and ids[current] not in exists:
+                problems.append(Problem(self.DANGLING, ids[path[-1]], "Dataset " + str(ids[path[-1]]) + " supersedes dataset " + str(ids[current])
+                                        + ", which does not exist", (), ()))
+                found = -2
+            elif root[current] != -1:
+                found = root[current]
+            else:
+                found = current
+            for index in path:
+                root[index] = found
+                state[index] = 2
+
+        originParams = paramOf[vicat.originPT]
+        for index in range(known):
+            if root[index] < 0:
+                continue
+            origin = ids[root[index]]
+            if originParams[index] == 0 or valueOf[vicat.originPT][index] != origin:
+                deletes = (originParams[index],) if originParams[index] != 0 else ()
+                problems.append(Problem(self.WRONG_ORIGIN, ids[index], "The origin of dataset " + str(ids[index]) + " should be " + str(origin),
+                                        deletes, ((vicat.originPT, origin),)))
+        return problems
+
+    def _checkSuperseded(self, ids, known, childCount, onlyChild, exists, paramOf, valueOf):
+        """
+        Check the superseded parameter of every dataset against its versions and the branching setting
+        """
+        vicat = self.vicat
+        problems = []
+        supersededParams = paramOf[vicat.supersededPT]
+        supersededValues = valueOf[vicat.supersededPT]
+        for index in range(len(ids)):
+            dsid = ids[index]
+            param = supersededParams[index] if index < known else 0
+            value = supersededValues[index] if index < known else 0
+            count = childCount[index]
+            child = ids[onlyChild[index]] if count == 1 else None
+            # The value the parameter should have, or None if it cannot be decided
+            expected = 0 if vicat.branching or count > 1 else child
+            deletes = (param,) if param != 0 else ()
+            if count == 0:
+                if param != 0:
+                    problems.append(Problem(self.STALE_SUPERSEDED, dsid, "Dataset " + str(dsid) + " has a superseded parameter, but no versions", deletes, ()))
+                continue
+            if count > 1 and not vicat.branching:
+                problems.append(Problem(self.BRANCHED, dsid, "Dataset " + str(dsid) + " has " + str(count) + " versions, but branching is not permitted", (), ()))
+                continue
+            if index >= known and dsid not in exists:
+                # Reported as DANGLING
+                continue
+            if param == 0:
+                problems.append(Problem(self.MISSING_SUPERSEDED, dsid, "Dataset " + str(dsid) + " has versions, but no superseded parameter", (),
+                                        ((vicat.supersededPT, expected),)))
+                continue
+            # With branching permitted, a dataset with one version may also have been superseded by a
+            # non-branching client, so either 0 or the id of that version is consistent
+            if value == expected or (vicat.branching and value == child):
+                continue
+            if value == 0 or count > 1:
+                kind = self.BRANCHING_MISMATCH
+            else:
+                kind = self.WRONG_SUPERSEDED
+                expected = child
+            problems.append(Problem(kind, dsid, "The superseded parameter of dataset " + str(dsid) + " is " + str(value) + " but should be " + str(expected),
+                                    deletes, ((vicat.supersededPT, expected),)))
+        return problems
+
+    def repair(self, problems, dryRun = False):
+        '''
+        Repair the given problems (those that can be repaired), deleting and then writing DatasetParameters
+        in batches. Returns a dict of the numbers of problems repaired, parameters deleted and parameters written;
+        if dryRun is True, nothing is changed, and the dict describes what would have been done.
+        If a repair is interrupted, checking again finds what remains to be done.
+        '''
+        vicat = self.vicat
+        fixable = [problem for problem in problems if problem.fixable()]
+        deletes = []
+        writes = []
+        for problem in fixable:
+            for paramId in problem.deletes:
+                deletes.append({"DatasetParameter" : {"id" : paramId}})
+            for (paramTypeId, value) in problem.writes:
+                writes.append({"DatasetParameter" : {"dataset" : {"id" : problem.datasetId}, "type" : {"id" : paramTypeId}, "numericValue" : value}})
+        if not dryRun:
+            vicat._deleteAll(deletes)
+            vicat._writeAll(writes)
+            if vicat.cache is not None:
+                vicat.cache.clear()
+        return {"repaired" : len(fixable), "deleted" : len(deletes), "written" : len(writes)}
+
+    def summary(self, problems):
+        '''
+        Return a dict of the number of problems of each kind
+        '''
+        counts = {}
+        for problem in problems:
+            counts[problem.kind] = counts.get(problem.kind, 0) + 1
+        return counts
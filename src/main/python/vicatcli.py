@@ -0,0 +1,308 @@
+'''
+A command-line tool for versioning and inspecting datasets in bulk.
+
+    python vicatcli.py --url URL --username NAME create < versions.jsonl > results.jsonl
+    python vicatcli.py --url URL --username NAME status ids.csv
+    python vicatcli.py --url URL --username NAME check --repair
+
+create, lineage and status read records from a file (or stdin): JSONL, with one dataset id or one
+{"id": ..., "name": ..., "comment": ...} object per line, or CSV, with id, name and comment columns
+(a header row is skipped). One JSON object is written to stdout for each record, in input order;
+a record that cannot be read gives {"error": ..., "line": ...} rather than stopping the run.
+Records are processed in batches; with --checkpoint, the number of records done is saved after each
+batch, and a later run with the same checkpoint file skips them.
+'''
+import argparse
+import csv
+import getpass
+import json
+import os
+import sys
+
+from vicat import VICAT
+from vicatcheck import VersionChecker
+
+
+def _int(value):
+    return int(value) if value is not None else None
+
+
+class InvalidRecord(object):
+    '''
+    An input record that could not be read: the number of its line, and the reason
+    '''
+
+    def __init__(self, line, error):
+        self.line = line
+        self.error = error
+
+    def result(self):
+        return {"error" : "Invalid record: " + str(self.error), "line" : self.line}
+
+
+def _jsonRecord(line):
+    record = json.loads(line)
+    if not isinstance(record, dict):
+        return (int(record), None, None)
+    if "id" not in record:
+        raise ValueError("no id")
+    return (int(record["id"]), record.get("name"), record.get("comment"))
+
+
+def readRecords(stream, format = "jsonl"):
+    '''
+    Generate (datasetId, name, comment) tuples from JSONL or CSV input; name and comment may be None.
+    An InvalidRecord is generated in place of each record that cannot be read.
+    '''
+    if format == "csv":
+        reader = csv.reader(stream)
+        for row in reader:
+            if len(row) == 0 or row[0].strip().lower() == "id":
+                continue
+            row = row + [None] * (3 - len(row))
+            try:
+                yield (int(row[0]), row[1] or None, row[2] or None)
+            except ValueError as e:
+                yield InvalidRecord(reader.line_num, e)
+        return
+    for (number, line) in enumerate(stream, 1):
+        line = line.strip()
+        if len(line) == 0:
+            continue
+        try:
+            record = _jsonRecord(line)
+        except (ValueError, TypeError) as e:
+            record = InvalidRecord(number, e)
+        yield record
+
+
+def _valid(batch):
+    return [record for record in batch if not isinstance(record, InvalidRecord)]
+
+
+def _batches(records, size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if len(batch) != 0:
+        yield batch
+
+
+class Checkpoint(object):
+    '''
+    Records how many input records of a command have been done, in a small JSON file
+    '''
+
+    def __init__(self, path, command):
+        self.path = path
+        self.command = command
+        self.done = 0
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            if state.get("command") == command:
+                self.done = state["done"]
+
+    def save(self, done):
+        self.done = done
+        if self.path is None:
+            return
+        # Replace the file in one step, so that it is never left half-written
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump({"command" : self.command, "done" : done}, f)
+        os.replace(temporary, self.path)
+
+
+class Runner(object):
+    '''
+    Runs the commands on batches of records, writing one JSON result per record
+    '''
+
+    def __init__(self, login, facilityId = None, branching = False, concurrency = 1, out = sys.stdout):
+        self.login = login
+        self.concurrency = concurrency
+        self.out = out
+        self.vicat = VICAT(login(), facilityId, branching)
+        self.parallel = None
+        if concurrency > 1:
+            from parallelvicat import ParallelVICAT
+            self.parallel = ParallelVICAT(login, self.vicat.fid, branching, workers=concurrency)
+
+    def close(self):
+        if self.parallel is not None:
+            self.parallel.close()
+
+    def _write(self, result):
+        self.out.write(json.dumps(result) + "\n")
+
+    def _error(self, datasetId, e):
+        return {"id" : datasetId, "error" : str(e)}
+
+    def create(self, batch):
+        versions = [record for record in _valid(batch) if record[1] is not None]
+        if self.parallel is not None:
+            results = self.parallel.createVersions(versions)
+        else:
+            results = self.vicat.createVersions(versions)
+        results = iter(results)
+        for record in batch:
+            if isinstance(record, InvalidRecord):
+                self._write(record.result())
+                continue
+            (datasetId, name, comment) = record
+            if name is None:
+                self._write(self._error(datasetId, "No name given for the new version"))
+                continue
+            result = next(results)
+            if isinstance(result, Exception):
+                self._write(self._error(datasetId, result))
+            else:
+                self._write({"id" : datasetId, "name" : name, "newId" : result})
+
+    def status(self, batch):
+        datasetIds = [record[0] for record in _valid(batch)]
+        superseded = self.vicat.isSupersededMany(datasetIds)
+        supersedes = self.vicat.supersedesMany(datasetIds)
+        comments = self.vicat.versionCommentMany(datasetIds)
+        for record in batch:
+            if isinstance(record, InvalidRecord):
+                self._write(record.result())
+                continue
+            datasetId = record[0]
+            self._write({"id" : datasetId, "superseded" : superseded[datasetId], "supersedes" : _int(supersedes[datasetId]),
+                         "comment" : comments[datasetId]})
+
+    def lineage(self, batch):
+        datasetIds = [record[0] for record in _valid(batch)]
+        if self.parallel is not None:
+            results = self.parallel.lookup("lineage", datasetIds)
+        else:
+            results = []
+            for datasetId in datasetIds:
+                try:
+                    results.append(self.vicat.lineage(datasetId))
+                except Exception as e:
+                    results.append(e)
+        results = iter(results)
+        for record in batch:
+            if isinstance(record, InvalidRecord):
+                self._write(record.result())
+                continue
+            datasetId = record[0]
+            result = next(results)
+            if isinstance(result, Exception):
+                self._write(self._error(datasetId, result))
+            else:
+                self._write({"id" : datasetId, "origin" : _int(result[0]), "lineage" : [_int(dsid) for dsid in result]})
+
+    def run(self, command, records, batchSize, checkpoint):
+        '''
+        Run the command on the records in batches, skipping those done according to the checkpoint
+        '''
+        fn = getattr(self, command)
+        done = 0
+        for batch in _batches(records, batchSize):
+            if done + len(batch) <= checkpoint.done:
+                done += len(batch)
+                continue
+            if done < checkpoint.done:
+                batch = batch[checkpoint.done - done:]
+                done = checkpoint.done
+            try:
+                fn(batch)
+            except Exception as e:
+                for record in batch:
+                    if isinstance(record, InvalidRecord):
+                        self._write(record.result())
+                    else:
+                        self._write(self._error(record[0], e))
+            done += len(batch)
+            self.out.flush()
+            checkpoint.save(done)
+        return done
+
+    def check(self, repair = False, dryRun = False):
+        '''
+        Check the Facility, writing each problem found; if repair is True, repair them (or report what would be done)
+        '''
+        checker = VersionChecker(self.vicat, self.login if self.concurrency > 1 else None)
+        problems = checker.check()
+        for problem in problems:
+            self._write({"kind" : problem.kind, "id" : problem.datasetId, "message" : problem.message, "fixable" : problem.fixable()})
+        summary = {"problems" : checker.summary(problems)}
+        if repair or dryRun:
+            summary["repair"] = checker.repair(problems, dryRun)
+            summary["dryRun"] = dryRun
+        return summary
+
+
+def _parser():
+    parser = argparse.ArgumentParser(description="Version and inspect ICAT datasets in bulk")
+    parser.add_argument("--url", help="URL of the ICAT server")
+    parser.add_argument("--cert", help="certificate file for the ICAT server")
+    parser.add_argument("--plugin", default="simple", help="authentication plugin (default simple)")
+    parser.add_argument("--username", help="user name")
+    parser.add_argument("--password", help="password (default: the VICAT_PASSWORD environment variable, or prompt)")
+    parser.add_argument("--facility", type=int, help="Facility id (default: the Facility called LSF)")
+    parser.add_argument("--branching", action="store_true", help="permit branching")
+    parser.add_argument("--concurrency", type=int, default=1, help="number of ICAT sessions to use at once (default 1)")
+    parser.add_argument("--output", help="write results to this file instead of stdout")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+    for (name, description) in [("create", "create new versions of datasets"), ("lineage", "show the history of datasets"),
+                                ("status", "show the versioning parameters of datasets")]:
+        command = commands.add_parser(name, help=description)
+        command.add_argument("input", nargs="?", help="JSONL or CSV file of records (default stdin)")
+        command.add_argument("--format", choices=["jsonl", "csv"], help="input format (default: csv if the file name ends in .csv, otherwise jsonl)")
+        command.add_argument("--batch-size", type=int, default=500, help="number of records per batch (default 500)")
+        command.add_argument("--checkpoint", help="file recording progress, for resuming an interrupted run")
+    check = commands.add_parser("check", help="check (and repair) the version metadata of the Facility")
+    check.add_argument("--repair", action="store_true", help="repair the problems found")
+    check.add_argument("--dry-run", action="store_true", help="report the repairs that would be made, without making them")
+    return parser
+
+
+def main(argv = None, login = None):
+    '''
+    Run the tool with the given arguments (default sys.argv). login, if given, is used instead of
+    logging in to the server named by the arguments; it must return a new, logged-in ICAT session.
+    Returns the exit status.
+    '''
+    args = _parser().parse_args(argv)
+    if login is None:
+        if args.url is None or args.username is None:
+            sys.stderr.write("--url and --username are required\n")
+            return 2
+        from icat import ICAT
+        password = args.password or os.environ.get("VICAT_PASSWORD") or getpass.getpass()
+        icat = ICAT(args.url, args.cert)
+        login = lambda: icat.login(args.plugin, {"username" : args.username, "password" : password})
+
+    out = open(args.output, "a") if args.output else sys.stdout
+    runner = Runner(login, args.facility, args.branching, args.concurrency, out)
+    try:
+        if args.command == "check":
+            summary = runner.check(args.repair, args.dry_run)
+            sys.stderr.write(json.dumps(summary) + "\n")
+            return 1 if len(summary["problems"]) != 0 and not args.repair else 0
+        format = args.format or ("csv" if args.input and args.input.endswith(".csv") else "jsonl")
+        stream = open(args.input) if args.input else sys.stdin
+        try:
+            done = runner.run(args.command, readRecords(stream, format), args.batch_size, Checkpoint(args.checkpoint, args.command))
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+        sys.stderr.write(str(done) + " records done\n")
+        return 0
+    finally:
+        runner.close()
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,250 @@
+'''
+Export of the version graph of a Facility to compact arrays, for offline analysis.
+
+exportGraph writes the supersedes edges and version comments of a Facility to a directory of NumPy
+.npy files; VersionGraph loads them (memory-mapped, so loading does not read the arrays) and answers
+lineage questions for many datasets at once with vectorised operations.
+
+Requires NumPy, which is not needed by the rest of vicat.
+'''
+import json
+import os
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Version of the layout written by exportGraph
+FORMAT_VERSION = 1
+
+# Files in an export directory
+_META = "meta.json"
+_CHILD = "child.npy"
+_PARENT = "parent.npy"
+_COMMENTS = "comments.npy"
+_COMMENT_OFFSETS = "commentOffsets.npy"
+
+
+def _requireNumpy():
+    if numpy is None:
+        raise ImportError("vicatgraph requires NumPy; install it with: pip install numpy")
+
+
+def exportGraph(vicat, path):
+    '''
+    Write the version graph of the Facility of the given VICAT to the directory path (created if necessary),
+    and return the number of edges (versions) written. The supersedes and comment parameters are read in pages.
+    The directory holds child.npy and parent.npy, int64 arrays in which child[i] supersedes parent[i], sorted by child;
+    comments.npy, the UTF-8 bytes of the comments of the children, one after another; commentOffsets.npy, in which the
+    comment of child[i] is comments[commentOffsets[i]:commentOffsets[i + 1]]; and meta.json.
+    .npy files (unlike .npz archives) can be memory-mapped.
+    '''
+    _requireNumpy()
+    children = array("q")
+    parents = array("q")
+    for page in vicat._searchPages("dp.id", ["dp.dataset.id", "dp.numericValue"], "DatasetParameter dp", " AND dp.type.id=" + str(vicat.supersedesPT)):
+        for (paramId, dsid, parent) in page:
+            children.append(dsid)
+            parents.append(int(parent))
+    child = numpy.frombuffer(children, dtype=numpy.int64)
+    parent = numpy.frombuffer(parents, dtype=numpy.int64)
+    order = numpy.argsort(child, kind="stable")
+    child = child[order]
+    parent = parent[order]
+
+    # Comments, placed in the order of the children they belong to
+    commentIds = array("q")
+    commentTexts = []
+    for page in vicat._searchPages("dp.id", ["dp.dataset.id", "dp.stringValue"], "DatasetParameter dp", " AND dp.type.id=" + str(vicat.commentPT)):
+        for (paramId, dsid, text) in page:
+            commentIds.append(dsid)
+            commentTexts.append((text or "").encode("utf-8"))
+    lengths = numpy.zeros(len(child), dtype=numpy.int64)
+    texts = [b""] * len(child)
+    if len(commentIds) != 0 and len(child) != 0:
+        commentIds = numpy.frombuffer(commentIds, dtype=numpy.int64)
+        positions = numpy.minimum(numpy.searchsorted(child, commentIds), len(child) - 1)
+        for (i, position) in enumerate(positions.tolist()):
+            if child[position] == commentIds[i]:
+                texts[position] = commentTexts[i]
+                lengths[position] = len(commentTexts[i])
+    commentOffsets = numpy.zeros(len(child) + 1, dtype=numpy.int64)
+    numpy.cumsum(lengths, out=commentOffsets[1:])
+    comments = numpy.frombuffer(b"".join(texts), dtype=numpy.uint8)
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    numpy.save(os.path.join(path, _CHILD), child)
+    numpy.save(os.path.join(path, _PARENT), parent)
+    numpy.save(os.path.join(path, _COMMENTS), comments)
+    numpy.save(os.path.join(path, _COMMENT_OFFSETS), commentOffsets)
+    with open(os.path.join(path, _META), "w") as f:
+        json.dump({"format" : FORMAT_VERSION, "facilityId" : vicat.fid, "branching" : vicat.branching, "edges" : len(child)}, f)
+    return len(child)
+
+
+class VersionGraph(object):
+    '''
+    The version graph written by exportGraph. child and parent are the edge arrays, sorted by child;
+    the methods that take an array of dataset ids return an array of results, one for each.
+    '''
+
+    def __init__(self, child, parent, comments, commentOffsets, meta = None):
+        _requireNumpy()
+        self.child = child
+        self.parent = parent
+        self.comments = comments
+        self.commentOffsets = commentOffsets
+        self.meta = meta or {}
+        self._byParent = None
+
+    @classmethod
+    def load(cls, path, mmap = True):
+        '''
+        Load the graph exported to the directory path; if mmap is True (the default), the arrays are memory-mapped
+        rather than read, so loading takes the same time whatever the size of the graph
+        '''
+        _requireNumpy()
+        with open(os.path.join(path, _META)) as f:
+            meta = json.load(f)
+        if meta.get("format") != FORMAT_VERSION:
+            raise ValueError("Unsupported version graph format: " + str(meta.get("format")))
+        mode = "r" if mmap else None
+        arrays = [numpy.load(os.path.join(path, name), mmap_mode=mode) for name in (_CHILD, _PARENT, _COMMENTS, _COMMENT_OFFSETS)]
+        return cls(*arrays, meta=meta)
+
+    def __len__(self):
+        return len(self.child)
+
+    def _index(self, datasetIds):
+        """
+        Return the positions of the datasetIds in child, and a mask of those that are there
+        """
+        datasetIds = numpy.asarray(datasetIds, dtype=numpy.int64)
+        if len(self.child) == 0:
+            return (numpy.zeros(datasetIds.shape, dtype=numpy.int64), numpy.zeros(datasetIds.shape, dtype=bool))
+        positions = numpy.minimum(numpy.searchsorted(self.child, datasetIds), len(self.child) - 1)
+        return (positions, numpy.asarray(self.child)[positions] == datasetIds)
+
+    def supersedes(self, datasetIds):
+        '''
+        Return the id of the dataset that each dataset supersedes, or -1 if it is not a version
+        '''
+        positions, found = self._index(datasetIds)
+        if len(self.child) == 0:
+            return numpy.full(found.shape, -1, dtype=numpy.int64)
+        return numpy.where(found, numpy.asarray(self.parent)[positions], -1)
+
+    def _walk(self, datasetIds):
+        """
+        Follow the supersedes edges from all the datasetIds at once; return the first dataset of each
+        history and the number of steps taken. A cycle is followed no more than len(self) times.
+        """
+        current = numpy.array(datasetIds, dtype=numpy.int64)
+        steps = numpy.zeros(current.shape, dtype=numpy.int64)
+        active = numpy.ones(current.shape, dtype=bool)
+        for i in range(len(self) + 1):
+            parents = self.supersedes(current[active])
+            moved = parents >= 0
+            if not moved.any():
+                break
+            indexes = numpy.flatnonzero(active)
+            current[indexes[moved]] = parents[moved]
+            steps[indexes[moved]] += 1
+            active[indexes[~moved]] = False
+        return (current, steps)
+
+    def origin(self, datasetIds):
+        '''
+        Return the first dataset in the history of each dataset (the dataset itself if it is not a version)
+        '''
+        return self._walk(datasetIds)[0]
+
+    def depth(self, datasetIds = None):
+        '''
+        Return the number of ancestors of each dataset (by default, of each version in the graph)
+        '''
+        if datasetIds is None:
+            datasetIds = self.child
+        return self._walk(datasetIds)[1]
+
+    def ancestors(self, datasetId):
+        '''
+        Return an array of the ancestors of the dataset, oldest first
+        '''
+        ancestors = []
+        current = self.supersedes([datasetId])[0]
+        while current >= 0 and len(ancestors) <= len(self):
+            ancestors.append(current)
+            current = self.supersedes([current])[0]
+        return numpy.array(ancestors[::-1], dtype=numpy.int64)
+
+    def _parentIndex(self):
+        """
+        Return the parents in order, and the children in the same order (so that the versions of each
+        dataset are adjacent, in order of id); computed on first use
+        """
+        if self._byParent is None:
+            order = numpy.argsort(self.parent, kind="stable")
+            self._byParent = (numpy.asarray(self.parent)[order], numpy.asarray(self.child)[order])
+        return self._byParent
+
+    def fanout(self, datasetIds = None):
+        '''
+        Return the number of direct versions of each dataset; if no datasetIds are given, return the ids
+        of the datasets that have versions and the number of versions of each
+        '''
+        parents, children = self._parentIndex()
+        if datasetIds is None:
+            return numpy.unique(parents, return_counts=True)
+        datasetIds = numpy.asarray(datasetIds, dtype=numpy.int64)
+        return numpy.searchsorted(parents, datasetIds, side="right") - numpy.searchsorted(parents, datasetIds, side="left")
+
+    def latest(self, datasetIds):
+        '''
+        Return the latest version of each dataset (the dataset itself if it has not been superseded).
+        Where a history branches, the most recent (highest id) version is followed.
+        '''
+        parents, children = self._parentIndex()
+        current = numpy.array(datasetIds, dtype=numpy.int64)
+        active = numpy.ones(current.shape, dtype=bool)
+        for i in range(len(self) + 1):
+            if len(parents) == 0:
+                break
+            indexes = numpy.flatnonzero(active)
+            # The last version of each dataset is just before the end of its run in parents
+            ends = numpy.searchsorted(parents, current[indexes], side="right")
+            moved = (ends > 0) & (parents[numpy.maximum(ends - 1, 0)] == current[indexes])
+            if not moved.any():
+                break
+            current[indexes[moved]] = children[ends[moved] - 1]
+            active[indexes[~moved]] = False
+        return current
+
+    def leaves(self):
+        '''
+        Return the ids of the versions that have not been superseded
+        '''
+        parents, children = self._parentIndex()
+        return numpy.asarray(self.child)[~numpy.isin(self.child, parents)]
+
+    def roots(self):
+        '''
+        Return the ids of the datasets that have versions but are not versions themselves
+        '''
+        parents, children = self._parentIndex()
+        return numpy.setdiff1d(parents, self.child)
+
+    def versionComment(self, datasetId):
+        '''
+        Return the version comment of the dataset, or None if it is not a version or has no comment
+        '''
+        positions, found = self._index([datasetId])
+        if not found[0] or self.commentOffsets[positions[0]] == self.commentOffsets[positions[0] + 1]:
+            return None
+        start = self.commentOffsets[positions[0]]
+        end = self.commentOffsets[positions[0] + 1]
+        return bytes(self.comments[start:end]).decode("utf-8")
@@ -0,0 +1,244 @@
+'''
+A local, persistent index of the version graph of a Facility.
+
+VersionIndex keeps a copy of the versioning DatasetParameters of a Facility in an SQLite
+file, so that lineage questions can be answered locally instead of by searching ICAT.
+The index is filled by a full scan of the parameters and then kept up to date by
+incremental syncs, which only fetch parameters created or modified since the last sync;
+a sync that finds that parameters have been deleted falls back to a full scan.
+'''
+import sqlite3
+
+from vicat import VicatException, timestampLiteral
+
+
+class VersionIndex(object):
+    '''
+    An SQLite index of the versioning parameters of the Facility of a VICAT instance.
+    The lookup methods answer from the index, as of the last sync().
+    '''
+
+    # Number of parameters to fetch in each search during a sync
+    PAGE_SIZE = 10000
+
+    def __init__(self, vicat, path):
+        '''
+        Constructor; takes the VICAT whose session, Facility and ParameterTypes are used for syncing,
+        and the path of the SQLite file (which is created if it does not exist; ":memory:" may be
+        used for an index that is not persistent).
+        The index is not synced by the constructor.
+        '''
+        self.vicat = vicat
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS param (
+                id INTEGER PRIMARY KEY,
+                dataset INTEGER NOT NULL,
+                type INTEGER NOT NULL,
+                numericValue REAL,
+                stringValue TEXT,
+                modTime TEXT);
+            CREATE INDEX IF NOT EXISTS param_dataset ON param (dataset, type);
+            CREATE INDEX IF NOT EXISTS param_value ON param (type, numericValue);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT);
+        """)
+
+    def close(self):
+        self.connection.close()
+
+    def _typeIds(self):
+        return [getattr(self.vicat, attribute) for (name, attribute, valueType, description) in self.vicat._PARAMETER_TYPES]
+
+    def _getMeta(self, key):
+        row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def _setMeta(self, key, value):
+        self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def _signature(self):
+        # Identifies the Facility and ParameterTypes that the index was built from
+        return str(self.vicat.fid) + ":" + ",".join(str(ptid) for ptid in self._typeIds())
+
+    def _fetch(self, condition):
+        """
+        Generate pages of [id, datasetId, typeId, numericValue, stringValue, modTime] lists for the
+        versioning parameters that satisfy the extra condition, in order of id
+        """
+        typeIds = ",".join(str(ptid) for ptid in self._typeIds())
+        lastId = 0
+        while True:
+            page = self.vicat.session.search("SELECT dp.id, dp.dataset.id, dp.type.id, dp.numericValue, dp.stringValue, dp.modTime FROM DatasetParameter dp"
+                                             + " WHERE dp.type.id IN (" + typeIds + ") AND dp.id > " + str(lastId) + condition
+                                             + " ORDER BY dp.id LIMIT 0, " + str(self.PAGE_SIZE))
+            if len(page) != 0:
+                yield page
+            if len(page) < self.PAGE_SIZE:
+                return
+            lastId = page[-1][0]
+
+    def _insert(self, rows):
+        self.connection.executemany("INSERT OR REPLACE INTO param (id, dataset, type, numericValue, stringValue, modTime) VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def _recordHighWater(self, rows):
+        maxId = int(self._getMeta("maxId") or 0)
+        maxModTime = self._getMeta("maxModTime") or ""
+        for row in rows:
+            maxId = max(maxId, row[0])
+            if row[5] is not None and row[5] > maxModTime:
+                maxModTime = row[5]
+        self._setMeta("maxId", str(maxId))
+        self._setMeta("maxModTime", maxModTime)
+
+    def _fullSync(self):
+        """
+        Replace the contents of the index with all the versioning parameters of the Facility; return the number fetched
+        """
+        fetched = 0
+        self.connection.execute("DELETE FROM param")
+        self.connection.execute("DELETE FROM meta")
+        self._setMeta("signature", self._signature())
+        for page in self._fetch(""):
+            self._insert(page)
+            self._recordHighWater(page)
+            fetched += len(page)
+        return fetched
+
+    def _deleted(self):
+        """
+        True if ICAT holds fewer versioning parameters, up to the highest id seen, than the index does,
+        so that some have been deleted since they were indexed
+        """
+        maxId = int(self._getMeta("maxId") or 0)
+        typeIds = ",".join(str(ptid) for ptid in self._typeIds())
+        (remote,) = self.vicat.session.search("SELECT COUNT(dp) FROM DatasetParameter dp WHERE dp.type.id IN (" + typeIds + ") AND dp.id <= " + str(maxId))
+        (local,) = self.connection.execute("SELECT COUNT(*) FROM param WHERE id <= ?", (maxId,)).fetchone()
+        return remote != local
+
+    def sync(self, full = False):
+        '''
+        Bring the index up to date, and return the number of parameters fetched.
+        The first sync (or one with full=True, or one after the Facility's ParameterTypes have changed)
+        scans all the versioning parameters of the Facility. Later syncs fetch only the parameters
+        created (id above the highest seen) or modified (modTime at or after the latest seen) since,
+        then refetch all the versioning parameters of the datasets concerned, so that parameters
+        deleted from those datasets (such as those copied into a clone by createVersion) are removed.
+        Deletions from other datasets (such as repairs by VersionChecker or backfillOrigins) are found
+        by comparing the number of parameters in ICAT with the number in the index; if they differ,
+        the whole index is rescanned.
+        '''
+        fetched = 0
+        with self.connection:
+            if full or self._getMeta("signature") != self._signature():
+                return self._fullSync()
+
+            maxId = int(self._getMeta("maxId") or 0)
+            maxModTime = self._getMeta("maxModTime")
+            datasetIds = set()
+            changed = []
+            for page in self._fetch(" AND dp.id > " + str(maxId)):
+                changed.extend(page)
+            if maxModTime:
+                for page in self._fetch(" AND dp.id <= " + str(maxId) + " AND dp.modTime >= " + timestampLiteral(maxModTime)):
+                    changed.extend(page)
+            for row in changed:
+                datasetIds.add(row[1])
+            fetched += len(changed)
+
+            # Replace everything held for the datasets that have changed
+            for chunk in self.vicat._chunks(sorted(datasetIds)):
+                self.connection.executemany("DELETE FROM param WHERE dataset = ?", [(dsid,) for dsid in chunk])
+                idList = ",".join(str(dsid) for dsid in chunk)
+                for page in self._fetch(" AND dp.dataset.id IN (" + idList + ")"):
+                    self._insert(page)
+                    self._recordHighWater(page)
+                    fetched += len(page)
+            self._recordHighWater(changed)
+            if self._deleted():
+                fetched += self._fullSync()
+        return fetched
+
+    def _value(self, datasetId, paramTypeId, field = "numericValue"):
+        row = self.connection.execute("SELECT " + field + " FROM param WHERE dataset = ? AND type = ? ORDER BY id LIMIT 1", (datasetId, paramTypeId)).fetchone()
+        return row[0] if row is not None else None
+
+    def _id(self, value):
+        return int(value) if value is not None else None
+
+    def isSuperseded(self, datasetId):
+        '''
+        True if one or more new versions have been created from this Dataset
+        '''
+        return self._value(datasetId, self.vicat.supersededPT) is not None
+
+    def superseded(self, datasetId):
+        """
+        Return the dataset id of the next newest version of the given dataset, or None; see VICAT.superseded
+        """
+        if self.vicat.branching:
+            raise VicatException(VicatException.BRANCHING_PERMITTED,"Attempt to obtain single descendant from dataset " + str(datasetId) + " when branching is permitted")
+        sdVal = self._value(datasetId, self.vicat.supersededPT)
+        if sdVal == 0:
+            raise VicatException(VicatException.BRANCHING_PERMITTED,"Attempt to obtain single descendant from dataset " + str(datasetId) + " that was superseded when branching was permitted")
+        return self._id(sdVal)
+
+    def supersedes(self, datasetId):
+        '''
+        Return the datasetId of the dataset this dataset (immediately) supersedes, or None if it is not a version
+        '''
+        return self._id(self._value(datasetId, self.vicat.supersedesPT))
+
+    def versionComment(self, datasetId):
+        """
+        Return the version comment for the given datasetId, if it has one
+        """
+        return self._value(datasetId, self.vicat.commentPT, "stringValue")
+
+    def ancestors(self, datasetId):
+        """
+        Returns a list of ancestors (previous versions) of the given datasetId.
+        """
+        ancestors = []
+        seen = set([datasetId])
+        parent = self.supersedes(datasetId)
+        while parent is not None and parent not in seen:
+            ancestors.append(parent)
+            seen.add(parent)
+            parent = self.supersedes(parent)
+        ancestors.reverse()
+        return ancestors
+
+    def descendants(self, datasetId):
+        """
+        Returns a list of descendants (newer versions) of the given datasetId.
+        This operation is not permitted when branching is in effect.
+        """
+        if self.vicat.branching:
+            raise VicatException(VicatException.BRANCHING_PERMITTED,"Attempt to obtain descendants from dataset " + str(datasetId) + " when branching is permitted")
+        descendants = []
+        seen = set([datasetId])
+        child = self.superseded(datasetId)
+        while child is not None and child not in seen:
+            descendants.append(child)
+            seen.add(child)
+            child = self.superseded(child)
+        return descendants
+
+    def latest(self, datasetId):
+        """
+        Return the latest version of the given dataset (which is the dataset itself if it has not been superseded).
+        This operation is not permitted when branching is in effect.
+        """
+        descendants = self.descendants(datasetId)
+        return descendants[-1] if len(descendants) != 0 else datasetId
+
+    def children(self, datasetId):
+        """
+        Return a list of the ids of the datasets that are direct versions of the given dataset.
+        Unlike superseded, this is also permitted when branching is in effect.
+        """
+        rows = self.connection.execute("SELECT dataset FROM param WHERE type = ? AND numericValue = ? ORDER BY dataset", (self.vicat.supersedesPT, datasetId))
+        return [row[0] for row in rows]
@@ -0,0 +1,204 @@
+'''
+Offline benchmarks for vicat, run against the in-memory FakeICAT.
+
+For each operation, reports the number of ICAT round trips, the wall time and the peak memory
+allocated while it ran, sweeping the length of version chains, the branching fan-out and the
+number of datafiles in a dataset. Results can be saved as JSON and compared with an earlier run:
+
+    python benchmark.py --latency 0.002 --output before.json
+    python benchmark.py --latency 0.002 --compare before.json
+
+src/main/python and src/test/python must be on the PYTHONPATH.
+'''
+import argparse
+import json
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from fakeicat import FakeICAT
+from vicat import VICAT, VersionCache
+
+
+def _intList(text):
+    return [int(value) for value in text.split(",")]
+
+
+class Benchmark(object):
+    '''
+    Builds version histories in a fresh FakeICAT for each scenario, and measures vicat operations on them.
+    The histories are built without latency; only the measured calls are delayed.
+    '''
+
+    def __init__(self, latency = 0.0, cache = False):
+        self.latency = latency
+        self.cache = cache
+        self.results = []
+
+    def _setUp(self, datafiles = 2):
+        """
+        Create a fresh store holding one Facility, Investigation and Dataset (with the given number of datafiles);
+        return the session used to build it
+        """
+        self.icat = FakeICAT()
+        session = self.icat.login()
+        fid = session.write({"Facility" : {"name" : "LSF"}})[0]
+        itid = session.write({"InvestigationType" : {"name" : "E", "facility" : {"id" : fid}}})[0]
+        self.investigationId = session.write({"Investigation" : {"name" : "Inv 1", "visitId" : "One", "title" : "The Inv 1",
+                                                                  "facility" : {"id" : fid}, "type" : {"id" : itid}}})[0]
+        self.datasetTypeId = session.write({"DatasetType" : {"name" : "DS Type", "facility" : {"id" : fid}}})[0]
+        self.datasetId = self._dataset(session, "ds1", datafiles)
+        return session
+
+    def _dataset(self, session, name, datafiles):
+        dataset = {"name" : name, "investigation" : {"id" : self.investigationId}, "type" : {"id" : self.datasetTypeId}}
+        dataset["datafiles"] = [{"name" : "df" + str(i), "location" : name + "/loc" + str(i)} for i in range(datafiles)]
+        return session.write({"Dataset" : dataset})[0]
+
+    def _vicat(self, session, branching = False):
+        return VICAT(session, None, branching, VersionCache() if self.cache else None)
+
+    def _chain(self, depth):
+        """
+        Build a chain of depth versions of a dataset; return the ids, oldest first
+        """
+        vicat = self._vicat(self._setUp())
+        ids = [self.datasetId]
+        for i in range(depth):
+            ids.append(vicat.createVersion(ids[-1], "ds1_v" + str(i + 2), "Version " + str(i + 2)))
+        return ids
+
+    def _tree(self, fanout):
+        """
+        Build a two-level tree of versions with fanout versions of the root and of each of those;
+        return the id of the root
+        """
+        vicat = self._vicat(self._setUp(), True)
+        for i in range(fanout):
+            child = vicat.createVersion(self.datasetId, "ds1_v2." + str(i))
+            for j in range(fanout):
+                vicat.createVersion(child, "ds1_v3." + str(i) + "." + str(j))
+        return self.datasetId
+
+    def measure(self, name, parameters, fn, branching = False):
+        """
+        Call fn(vicat) with a new VICAT on a session with the configured latency, and record
+        the round trips, wall time and peak memory of the call
+        """
+        session = self.icat.login()
+        vicat = self._vicat(session, branching)
+        session.latency = self.latency
+        session.resetCounts()
+        tracemalloc.start()
+        start = time.perf_counter()
+        fn(vicat)
+        wallTime = time.perf_counter() - start
+        peakMemory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        result = {"name" : name, "parameters" : parameters, "roundTrips" : session.roundTrips(),
+                  "calls" : dict(session.calls), "wallTime" : wallTime, "peakMemory" : peakMemory}
+        self.results.append(result)
+        return result
+
+    def runDatasetSize(self, datafiles):
+        parameters = {"datafiles" : datafiles}
+        self._setUp(datafiles)
+        self.measure("createVersion", parameters, lambda vicat: vicat.createVersion(self.datasetId, "ds1_v2"))
+        self._setUp(datafiles)
+        self.measure("createLargeVersion", parameters, lambda vicat: vicat.createLargeVersion(self.datasetId, "ds1_v2"))
+
+    def runDepth(self, depth):
+        parameters = {"depth" : depth}
+        ids = self._chain(depth)
+        self.measure("ancestors", parameters, lambda vicat: vicat.ancestors(ids[-1]))
+        self.measure("descendants", parameters, lambda vicat: vicat.descendants(ids[0]))
+        self.measure("latest", parameters, lambda vicat: vicat.latest(ids[0]))
+        self.measure("lineage", parameters, lambda vicat: vicat.lineage(ids[depth // 2]))
+        self.measure("createVersion", parameters, lambda vicat: vicat.createVersion(ids[-1], "ds1_next"))
+        self.measure("isSupersededMany", parameters, lambda vicat: vicat.isSupersededMany(ids))
+        self.measure("supersedesMany", parameters, lambda vicat: vicat.supersedesMany(ids))
+        self.measure("versionCommentMany", parameters, lambda vicat: vicat.versionCommentMany(ids))
+
+    def runFanout(self, fanout):
+        parameters = {"fanout" : fanout}
+        root = self._tree(fanout)
+        self.measure("children", parameters, lambda vicat: vicat.children(root), True)
+        self.measure("descendantTree", parameters, lambda vicat: vicat.descendantTree(root), True)
+        self.measure("latest", parameters, lambda vicat: vicat.latest(root), True)
+        self.measure("createVersion", parameters, lambda vicat: vicat.createVersion(root, "ds1_branch"), True)
+
+        # fanout separate datasets, versioned one at a time and in one batch
+        session = self._setUp()
+        ids = [self._dataset(session, "ds" + str(i + 2), 2) for i in range(fanout)]
+        self.measure("createVersion x n", parameters, lambda vicat: [vicat.createVersion(dsid, str(dsid) + "_v2") for dsid in ids])
+        self.measure("createVersions", parameters, lambda vicat: vicat.createVersions([(dsid, str(dsid) + "_v3") for dsid in ids]), True)
+
+    def run(self, depths, fanouts, datafiles):
+        for depth in depths:
+            self.runDepth(depth)
+        for fanout in fanouts:
+            self.runFanout(fanout)
+        for count in datafiles:
+            self.runDatasetSize(count)
+        return self.results
+
+
+def _key(result):
+    return result["name"] + " " + json.dumps(result["parameters"], sort_keys=True)
+
+
+def _commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _ratio(new, old):
+    return "%7.2f" % (float(new) / old) if old else "      -"
+
+
+def report(results, previous = None, out = sys.stdout):
+    '''
+    Print a table of the results; if previous results are given, add the ratio of each measurement to the earlier one
+    '''
+    previous = dict((_key(result), result) for result in previous or [])
+    header = "%-40s %10s %12s %12s" % ("benchmark", "roundTrips", "wallTime(s)", "peakMem(KB)")
+    if previous:
+        header += "   %7s %7s %7s" % ("trips", "time", "memory")
+    out.write(header + "\n")
+    for result in results:
+        line = "%-40s %10d %12.4f %12.1f" % (_key(result), result["roundTrips"], result["wallTime"], result["peakMemory"] / 1024.0)
+        old = previous.get(_key(result))
+        if old is not None:
+            line += "   " + " ".join([_ratio(result["roundTrips"], old["roundTrips"]), _ratio(result["wallTime"], old["wallTime"]),
+                                      _ratio(result["peakMemory"], old["peakMemory"])])
+        out.write(line + "\n")
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description="Benchmark vicat against an in-memory ICAT")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds to delay each ICAT call (default 0)")
+    parser.add_argument("--depths", type=_intList, default=[1, 10, 100], help="version chain lengths (default 1,10,100)")
+    parser.add_argument("--fanouts", type=_intList, default=[2, 8, 32], help="branching fan-outs (default 2,8,32)")
+    parser.add_argument("--datafiles", type=_intList, default=[10, 100, 1000], help="datafiles per dataset (default 10,100,1000)")
+    parser.add_argument("--cache", action="store_true", help="give each VICAT a VersionCache")
+    parser.add_argument("--output", help="save the results to this JSON file")
+    parser.add_argument("--compare", help="compare with the results in this JSON file")
+    args = parser.parse_args(argv)
+
+    results = Benchmark(args.latency, args.cache).run(args.depths, args.fanouts, args.datafiles)
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)["results"]
+    report(results, previous)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"commit" : _commit(), "time" : time.strftime("%Y-%m-%dT%H:%M:%S"), "latency" : args.latency,
+                       "cache" : args.cache, "results" : results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,701 @@
+'''
+An in-memory stand-in for an ICAT session.
+
+Implements the subset of the ICAT JSON client session API that vicat uses
+(search, write, delete and cloneEntity), including enough of the ICAT query
+language for the queries that vicat builds. Each call can be delayed by a
+configurable latency to simulate a remote server, and every call is counted.
+
+Not intended to be a faithful ICAT implementation: there is no authorization,
+and only the entities and relationships that vicat touches are modelled.
+'''
+import copy
+import re
+import threading
+import time
+
+
+class FakeIcatException(Exception):
+    """
+    Mimics the exceptions raised by the ICAT client.
+    """
+
+    def __init__(self, code, message, offset=-1):
+        self.code = code
+        self.message = message
+        self.offset = offset
+
+    def __str__(self):
+        return self.code + ": " + self.message
+
+    def getMessage(self):
+        return self.message
+
+    def getType(self):
+        return self.code
+
+    def getOffset(self):
+        return self.offset
+
+
+# Many-to-one relationships: entity -> {field : target entity}
+MANY_TO_ONE = {
+    "Facility": {},
+    "InvestigationType": {"facility": "Facility"},
+    "Investigation": {"facility": "Facility", "type": "InvestigationType"},
+    "DatasetType": {"facility": "Facility"},
+    "DatafileFormat": {"facility": "Facility"},
+    "Sample": {"investigation": "Investigation"},
+    "ParameterType": {"facility": "Facility"},
+    "Dataset": {"investigation": "Investigation", "type": "DatasetType", "sample": "Sample"},
+    "Datafile": {"dataset": "Dataset", "datafileFormat": "DatafileFormat"},
+    "DatasetParameter": {"dataset": "Dataset", "type": "ParameterType"},
+    "DatafileParameter": {"datafile": "Datafile", "type": "ParameterType"},
+}
+
+# One-to-many relationships: (entity, field) -> (child entity, child's many-to-one field)
+ONE_TO_MANY = {
+    ("Facility", "investigations"): ("Investigation", "facility"),
+    ("Facility", "parameterTypes"): ("ParameterType", "facility"),
+    ("Investigation", "datasets"): ("Dataset", "investigation"),
+    ("Dataset", "datafiles"): ("Datafile", "dataset"),
+    ("Dataset", "parameters"): ("DatasetParameter", "dataset"),
+    ("Datafile", "parameters"): ("DatafileParameter", "datafile"),
+}
+
+# Uniqueness constraints
+UNIQUE = {
+    "Facility": ("name",),
+    "Investigation": ("facility", "name", "visitId"),
+    "Dataset": ("investigation", "name"),
+    "Datafile": ("dataset", "name"),
+    "ParameterType": ("facility", "name", "units"),
+    "DatasetParameter": ("dataset", "type"),
+    "DatafileParameter": ("datafile", "type"),
+}
+
+_TOKEN = re.compile(r"\s*(\{ts [^}]*\}|'(?:[^']|'')*'|<>|!=|<=|>=|[(),=<>]|[A-Za-z_][A-Za-z0-9_.]*|-?\d+(?:\.\d+)?)")
+_KEYWORDS = set(["SELECT", "DISTINCT", "FROM", "JOIN", "WHERE", "AND", "OR", "NOT", "IN", "IS", "NULL",
+                 "ORDER", "BY", "ASC", "DESC", "INCLUDE", "LIMIT", "COUNT", "MAX", "MIN"])
+
+
+def _timestamp(text):
+    # Normalise an ICAT date string or a {ts ...} literal to a comparable string
+    if text.startswith("{ts "):
+        text = text[4:-1]
+    text = text.replace("T", " ")
+    if len(text) == 19:
+        text += ".000"
+    return text[:23]
+
+
+class _Missing(object):
+    pass
+
+MISSING = _Missing()
+
+
+class FakeICAT(object):
+    """
+    The shared in-memory store; sessions obtained from login() all see the same data.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.entities = {}
+        for name in MANY_TO_ONE:
+            self.entities[name] = {}
+        # entity -> field -> target id -> set of ids
+        self.index = {}
+        for name, rels in MANY_TO_ONE.items():
+            self.index[name] = dict((field, {}) for field in rels)
+        # entity -> unique key values -> id, and entity -> id -> unique key values
+        self.unique = dict((name, {}) for name in UNIQUE)
+        self.uniqueKeys = dict((name, {}) for name in UNIQUE)
+        self.nextId = 1
+        self.clock = 1476000000000
+        self.lock = threading.RLock()
+        self.url = "fake://icat"
+
+    def login(self, plugin=None, credentials=None):
+        return FakeSession(self)
+
+    def _now(self):
+        self.clock += 1
+        seconds, millis = divmod(self.clock, 1000)
+        return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(seconds)) + ".%03d+00:00" % millis
+
+
+class FakeSession(object):
+    """
+    Implements search, write, delete and cloneEntity against a FakeICAT store.
+    calls counts the calls made, by operation name; latency (seconds) is slept
+    before every call.
+    """
+
+    def __init__(self, icat=None, latency=None):
+        if icat is None:
+            icat = FakeICAT()
+        self.icat = icat
+        self.url = icat.url
+        self.latency = icat.latency if latency is None else latency
+        self.calls = {"search": 0, "write": 0, "delete": 0, "cloneEntity": 0}
+        self.queries = []
+
+    def resetCounts(self):
+        for op in self.calls:
+            self.calls[op] = 0
+        del self.queries[:]
+
+    def roundTrips(self):
+        return sum(self.calls.values())
+
+    def _call(self, op):
+        self.calls[op] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+    def write(self, entities):
+        self._call("write")
+        if isinstance(entities, dict):
+            entities = [entities]
+        with self.icat.lock:
+            created = []
+            ids = []
+            try:
+                for entity in entities:
+                    (name, fields), = entity.items()
+                    newId = self._writeOne(name, fields, created)
+                    if newId is not None:
+                        ids.append(newId)
+            except Exception:
+                for name, eid in reversed(created):
+                    self._remove(name, eid)
+                raise
+            return ids
+
+    def _writeOne(self, name, fields, created, parent=None):
+        store = self.icat.entities[name]
+        if "id" in fields and fields["id"] in store:
+            entity = store[fields["id"]]
+            for key, value in fields.items():
+                if key == "id":
+                    continue
+                if (name, key) in ONE_TO_MANY:
+                    childName, childField = ONE_TO_MANY[(name, key)]
+                    for child in value:
+                        self._writeOne(childName, child, created, (childField, entity["id"]))
+                else:
+                    self._set(name, entity, key, value)
+            entity["modTime"] = self.icat._now()
+            self._checkUnique(name, entity)
+            return None
+        entity = {}
+        eid = self.icat.nextId
+        self.icat.nextId += 1
+        entity["id"] = eid
+        entity["createTime"] = entity["modTime"] = self.icat._now()
+        for rel in MANY_TO_ONE[name]:
+            entity[rel] = None
+        store[eid] = entity
+        created.append((name, eid))
+        children = []
+        for key, value in fields.items():
+            if key == "id":
+                continue
+            if (name, key) in ONE_TO_MANY:
+                children.append((key, value))
+            else:
+                self._set(name, entity, key, value)
+        if parent is not None:
+            self._set(name, entity, parent[0], {"id": parent[1]})
+        for rel, target in MANY_TO_ONE[name].items():
+            if entity[rel] is not None and entity[rel] not in self.icat.entities[target]:
+                raise FakeIcatException("NO_SUCH_OBJECT_FOUND", target + " " + str(entity[rel]) + " does not exist")
+        self._checkUnique(name, entity)
+        for key, value in children:
+            childName, childField = ONE_TO_MANY[(name, key)]
+            for child in value:
+                self._writeOne(childName, child, created, (childField, eid))
+        return eid
+
+    def _set(self, name, entity, key, value):
+        if key in MANY_TO_ONE[name]:
+            index = self.icat.index[name][key]
+            old = entity.get(key)
+            if old is not None:
+                index[old].discard(entity["id"])
+            target = value["id"] if value is not None else None
+            entity[key] = target
+            if target is not None:
+                index.setdefault(target, set()).add(entity["id"])
+        elif key == "numericValue" and value is not None:
+            # ICAT holds numeric values as doubles
+            entity[key] = float(value)
+        else:
+            entity[key] = value
+
+    def _checkUnique(self, name, entity):
+        keys = UNIQUE.get(name)
+        if not keys:
+            return
+        values = tuple(entity.get(k) for k in keys)
+        unique = self.icat.unique[name]
+        other = unique.get(values)
+        if other is not None and other != entity["id"]:
+            raise FakeIcatException("OBJECT_ALREADY_EXISTS", name + " exists with " + str(values))
+        old = self.icat.uniqueKeys[name].get(entity["id"])
+        if old is not None and old != values:
+            del unique[old]
+        unique[values] = entity["id"]
+        self.icat.uniqueKeys[name][entity["id"]] = values
+
+    def delete(self, entities):
+        self._call("delete")
+        if isinstance(entities, dict):
+            entities = [entities]
+        with self.icat.lock:
+            for entity in entities:
+                (name, fields), = entity.items()
+                if fields["id"] not in self.icat.entities[name]:
+                    raise FakeIcatException("NO_SUCH_OBJECT_FOUND", name + " " + str(fields["id"]) + " does not exist")
+            for entity in entities:
+                (name, fields), = entity.items()
+                self._remove(name, fields["id"])
+
+    def _remove(self, name, eid):
+        store = self.icat.entities[name]
+        if eid not in store:
+            return
+        # cascade to everything that refers to this entity
+        for child, rels in MANY_TO_ONE.items():
+            for rel, target in rels.items():
+                if target == name:
+                    for cid in list(self.icat.index[child][rel].get(eid, ())):
+                        self._remove(child, cid)
+        entity = store.pop(eid)
+        if name in UNIQUE:
+            values = self.icat.uniqueKeys[name].pop(eid, None)
+            if values is not None:
+                del self.icat.unique[name][values]
+        for rel in MANY_TO_ONE[name]:
+            if entity.get(rel) is not None:
+                self.icat.index[name][rel][entity[rel]].discard(eid)
+
+
+    def cloneEntity(self, name, eid, keys):
+        self._call("cloneEntity")
+        if name != "Dataset":
+            raise FakeIcatException("BAD_PARAMETER", "Only Datasets can be cloned by this fake")
+        with self.icat.lock:
+            store = self.icat.entities
+            if eid not in store["Dataset"]:
+                raise FakeIcatException("NO_SUCH_OBJECT_FOUND", "Dataset " + str(eid) + " does not exist")
+            created = []
+            try:
+                fields = self._asFields("Dataset", store["Dataset"][eid])
+                fields.update(keys)
+                newId = self._writeOne("Dataset", fields, created)
+                for dpid in sorted(self.icat.index["DatasetParameter"]["dataset"].get(eid, ())):
+                    fields = self._asFields("DatasetParameter", store["DatasetParameter"][dpid])
+                    fields["dataset"] = {"id": newId}
+                    self._writeOne("DatasetParameter", fields, created)
+                for dfid in sorted(self.icat.index["Datafile"]["dataset"].get(eid, ())):
+                    fields = self._asFields("Datafile", store["Datafile"][dfid])
+                    fields["dataset"] = {"id": newId}
+                    newDf = self._writeOne("Datafile", fields, created)
+                    for pid in sorted(self.icat.index["DatafileParameter"]["datafile"].get(dfid, ())):
+                        fields = self._asFields("DatafileParameter", store["DatafileParameter"][pid])
+                        fields["datafile"] = {"id": newDf}
+                        self._writeOne("DatafileParameter", fields, created)
+            except Exception:
+                for n, i in reversed(created):
+                    self._remove(n, i)
+                raise
+            return newId
+
+    def _asFields(self, name, entity):
+        fields = {}
+        for key, value in entity.items():
+            if key in ("id", "createTime", "modTime"):
+                continue
+            if key in MANY_TO_ONE[name]:
+                fields[key] = {"id": value} if value is not None else None
+            else:
+                fields[key] = value
+        return fields
+
+
+    def search(self, query):
+        self._call("search")
+        self.queries.append(query)
+        with self.icat.lock:
+            return _Query(self.icat, query).run()
+
+
+class _Query(object):
+
+    def __init__(self, icat, text):
+        self.icat = icat
+        self.text = text
+        self.tokens = [t for t in _TOKEN.findall(text)]
+        self.pos = 0
+
+    # token helpers
+    def _peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def _peekKw(self, *words):
+        token = self._peek()
+        return token is not None and token.upper() in words
+
+    def _next(self):
+        token = self._peek()
+        if token is None:
+            raise FakeIcatException("BAD_PARAMETER", "Unexpected end of query: " + self.text)
+        self.pos += 1
+        return token
+
+    def _expect(self, word):
+        token = self._next()
+        if token.upper() != word:
+            raise FakeIcatException("BAD_PARAMETER", "Expected " + word + " but found " + token + " in " + self.text)
+
+    # parsing
+    def run(self):
+        self._expect("SELECT")
+        distinct = False
+        if self._peekKw("DISTINCT"):
+            self._next()
+            distinct = True
+        selectors = [self._selector()]
+        while self._peek() == ",":
+            self._next()
+            selectors.append(self._selector())
+        self._expect("FROM")
+        rootName = self._next()
+        rootAlias = self._next()
+        aliases = [(rootAlias, rootName, None)]
+        while self._peekKw("JOIN"):
+            self._next()
+            path = self._next()
+            alias = self._next()
+            aliases.append((alias, None, path))
+        condition = None
+        if self._peekKw("WHERE"):
+            self._next()
+            condition = self._or()
+        order = []
+        if self._peekKw("ORDER"):
+            self._next()
+            self._expect("BY")
+            while True:
+                path = self._next()
+                descending = False
+                if self._peekKw("ASC", "DESC"):
+                    descending = self._next().upper() == "DESC"
+                order.append((path, descending))
+                if self._peek() != ",":
+                    break
+                self._next()
+        includes = []
+        if self._peekKw("INCLUDE"):
+            self._next()
+            includes.append(self._next())
+            while self._peek() == ",":
+                self._next()
+                includes.append(self._next())
+        limit = None
+        if self._peekKw("LIMIT"):
+            self._next()
+            offset = int(self._next())
+            self._expect(",")
+            limit = (offset, int(self._next()))
+        if self._peek() is not None:
+            raise FakeIcatException("BAD_PARAMETER", "Unexpected " + self._peek() + " in " + self.text)
+
+        rows = self._rows(aliases, condition)
+        if condition is not None:
+            rows = [row for row in rows if self._eval(condition, row) is True]
+        aggregate = [s for s in selectors if s[0] != "path"]
+        if aggregate:
+            values = []
+            for kind, path in selectors:
+                vals = [self._resolve(path, row) for row in rows]
+                vals = [v for v in vals if v is not MISSING and v is not None]
+                if kind == "COUNT":
+                    values.append(len(vals))
+                elif kind == "MAX":
+                    values.append(max(vals) if vals else None)
+                else:
+                    values.append(min(vals) if vals else None)
+            return [values[0]] if len(values) == 1 else [values]
+        for path, descending in reversed(order):
+            rows.sort(key=lambda row: self._sortKey(self._resolve(path, row)), reverse=descending)
+        results = []
+        seen = set()
+        for row in rows:
+            values = []
+            for kind, path in selectors:
+                values.append(self._value(path, row, includes))
+            if any(v is MISSING for v in values):
+                continue
+            if distinct:
+                key = repr(values)
+                if key in seen:
+                    continue
+                seen.add(key)
+            results.append(values[0] if len(values) == 1 else values)
+        if limit is not None:
+            results = results[limit[0]:limit[0] + limit[1]]
+        return results
+
+    def _sortKey(self, value):
+        if value is MISSING or value is None:
+            return (0, 0)
+        return (1, value)
+
+    def _selector(self):
+        token = self._next()
+        if token.upper() in ("COUNT", "MAX", "MIN") and self._peek() == "(":
+            self._next()
+            path = self._next()
+            self._expect(")")
+            return (token.upper(), path)
+        return ("path", token)
+
+    def _or(self):
+        node = self._and()
+        while self._peekKw("OR"):
+            self._next()
+            node = ("or", node, self._and())
+        return node
+
+    def _and(self):
+        node = self._not()
+        while self._peekKw("AND"):
+            self._next()
+            node = ("and", node, self._not())
+        return node
+
+    def _not(self):
+        if self._peekKw("NOT"):
+            self._next()
+            return ("not", self._not())
+        if self._peek() == "(":
+            self._next()
+            node = self._or()
+            self._expect(")")
+            return node
+        return self._comparison()
+
+    def _comparison(self):
+        left = self._operand()
+        token = self._next()
+        upper = token.upper()
+        if upper == "IS":
+            negate = False
+            if self._peekKw("NOT"):
+                self._next()
+                negate = True
+            self._expect("NULL")
+            return ("isnull", left, negate)
+        if upper == "NOT":
+            self._expect("IN")
+            return ("not", ("in", left, self._list()))
+        if upper == "IN":
+            return ("in", left, self._list())
+        if token in ("=", "!=", "<>", "<", ">", "<=", ">="):
+            return ("cmp", token, left, self._operand())
+        raise FakeIcatException("BAD_PARAMETER", "Unexpected " + token + " in " + self.text)
+
+    def _list(self):
+        self._expect("(")
+        values = [self._operand()]
+        while self._peek() == ",":
+            self._next()
+            values.append(self._operand())
+        self._expect(")")
+        return values
+
+    def _operand(self):
+        token = self._next()
+        if token.startswith("{ts "):
+            return ("lit", _timestamp(token))
+        if token.startswith("'"):
+            return ("lit", token[1:-1].replace("''", "'"))
+        if re.match(r"-?\d", token):
+            return ("lit", float(token) if "." in token else int(token))
+        if token.upper() in ("TRUE", "FALSE"):
+            return ("lit", token.upper() == "TRUE")
+        return ("path", token)
+
+    # evaluation
+    def _candidates(self, name, alias, condition):
+        # Use the relationship indexes for top-level "alias.rel.id = N" / "IN" conjuncts
+        store = self.icat.entities[name]
+        best = None
+        for conj in self._conjuncts(condition):
+            ids = None
+            if conj[0] == "cmp" and conj[1] == "=" and conj[2][0] == "path" and conj[3][0] == "lit":
+                path, values = conj[2][1], [conj[3][1]]
+            elif conj[0] == "in" and conj[1][0] == "path" and all(v[0] == "lit" for v in conj[2]):
+                path, values = conj[1][1], [v[1] for v in conj[2]]
+            else:
+                continue
+            parts = path.split(".")
+            if parts[0] != alias:
+                continue
+            if parts[1:] == ["id"]:
+                ids = set(v for v in values if v in store)
+            elif len(parts) == 3 and parts[2] == "id" and parts[1] in MANY_TO_ONE[name]:
+                index = self.icat.index[name][parts[1]]
+                ids = set()
+                for v in values:
+                    ids.update(index.get(v, ()))
+            if ids is not None and (best is None or len(ids) < len(best)):
+                best = ids
+        if best is None:
+            return sorted(store)
+        return sorted(best)
+
+    def _conjuncts(self, condition):
+        if condition is None:
+            return []
+        if condition[0] == "and":
+            return self._conjuncts(condition[1]) + self._conjuncts(condition[2])
+        return [condition]
+
+    def _rows(self, aliases, condition):
+        rootAlias, rootName, _ = aliases[0]
+        rows = [{rootAlias: (rootName, eid)} for eid in self._candidates(rootName, rootAlias, condition)]
+        for alias, _, path in aliases[1:]:
+            parts = path.split(".")
+            newRows = []
+            for row in rows:
+                name, eid = row[parts[0]]
+                targets = [(name, eid)]
+                for field in parts[1:]:
+                    nextTargets = []
+                    for tname, tid in targets:
+                        if field in MANY_TO_ONE[tname]:
+                            ref = self.icat.entities[tname][tid].get(field)
+                            if ref is not None:
+                                nextTargets.append((MANY_TO_ONE[tname][field], ref))
+                        elif (tname, field) in ONE_TO_MANY:
+                            childName, childField = ONE_TO_MANY[(tname, field)]
+                            for cid in sorted(self.icat.index[childName][childField].get(tid, ())):
+                                nextTargets.append((childName, cid))
+                        else:
+                            raise FakeIcatException("BAD_PARAMETER", "Cannot join " + path)
+                    targets = nextTargets
+                for target in targets:
+                    newRow = dict(row)
+                    newRow[alias] = target
+                    newRows.append(newRow)
+            rows = newRows
+        return rows
+
+    def _resolve(self, path, row):
+        parts = path.split(".")
+        if parts[0] not in row:
+            raise FakeIcatException("BAD_PARAMETER", "Unknown alias in " + path)
+        name, eid = row[parts[0]]
+        entity = self.icat.entities[name][eid]
+        for i, field in enumerate(parts[1:]):
+            last = i == len(parts) - 2
+            if field in MANY_TO_ONE[name]:
+                ref = entity.get(field)
+                if ref is None:
+                    return MISSING
+                if last:
+                    return ref
+                name = MANY_TO_ONE[name][field]
+                entity = self.icat.entities[name][ref]
+            elif last:
+                value = entity.get(field)
+                if field in ("modTime", "createTime") and value is not None:
+                    return _timestamp(value)
+                return value
+            else:
+                raise FakeIcatException("BAD_PARAMETER", "Cannot navigate " + path)
+        return ("entity", name, eid)
+
+    def _value(self, path, row, includes):
+        if "." not in path:
+            name, eid = row[path]
+            return {name: self._entityJson(name, eid, path, includes)}
+        parts = path.split(".")
+        name, eid = row[parts[0]]
+        entity = self.icat.entities[name][eid]
+        for i, field in enumerate(parts[1:]):
+            last = i == len(parts) - 2
+            if field in MANY_TO_ONE[name]:
+                ref = entity.get(field)
+                if ref is None:
+                    return MISSING
+                name = MANY_TO_ONE[name][field]
+                entity = self.icat.entities[name][ref]
+                if last:
+                    return {name: self._entityJson(name, ref, None, [])}
+            elif last:
+                return entity.get(field)
+        return MISSING
+
+    def _entityJson(self, name, eid, alias, includes):
+        entity = self.icat.entities[name][eid]
+        result = {}
+        for key, value in entity.items():
+            if key in MANY_TO_ONE[name]:
+                if alias is not None and (alias + "." + key) in includes and value is not None:
+                    target = MANY_TO_ONE[name][key]
+                    result[key] = copy.deepcopy(self.icat.entities[target][value])
+                    for rel in MANY_TO_ONE[target]:
+                        result[key].pop(rel, None)
+            elif value is not None:
+                result[key] = value
+        return result
+
+    def _operandValue(self, operand, row):
+        if operand[0] == "lit":
+            return operand[1]
+        return self._resolve(operand[1], row)
+
+    def _eval(self, node, row):
+        kind = node[0]
+        if kind == "and":
+            return self._eval(node[1], row) is True and self._eval(node[2], row) is True
+        if kind == "or":
+            return self._eval(node[1], row) is True or self._eval(node[2], row) is True
+        if kind == "not":
+            return not self._eval(node[1], row)
+        if kind == "isnull":
+            value = self._operandValue(node[1], row)
+            isNull = value is None or value is MISSING
+            return (not isNull) if node[2] else isNull
+        if kind == "in":
+            value = self._operandValue(node[1], row)
+            if value is MISSING or value is None:
+                return False
+            return any(value == self._operandValue(v, row) for v in node[2])
+        if kind == "cmp":
+            op = node[1]
+            left = self._operandValue(node[2], row)
+            right = self._operandValue(node[3], row)
+            if left is MISSING or right is MISSING or left is None or right is None:
+                return False
+            if op == "=":
+                return left == right
+            if op in ("!=", "<>"):
+                return left != right
+            if op == "<":
+                return left < right
+            if op == ">":
+                return left > right
+            if op == "<=":
+                return left <= right
+            return left >= right
+        raise FakeIcatException("INTERNAL", "Bad node " + str(node))
@@ -5,16 +5,34 @@ Created on 7 Sep 2016
 '''
 import unittest
 import os
+import asyncio
+import json
+import shutil
+import tempfile
+import threading
 
 from icat import ICAT
-from vicat import VICAT, VicatException
+from fakeicat import FakeICAT, FakeIcatException
+from vicat import VICAT, VicatException, VersionCache, Instrumentation, clearRegistry
+from asyncvicat import AsyncVICAT
+from parallelvicat import ParallelVICAT
+from vicatindex import VersionIndex
+from vicatcheck import VersionChecker
+import vicatcli
+import vicatgraph
 
 
 class Test(unittest.TestCase):
 
 
     def setUp(self):
-        self.icat = ICAT(os.environ["serverUrl"], os.environ["serverCert"])
+        if "serverUrl" in os.environ:
+            self.serverUrl = os.environ["serverUrl"]
+            self.icat = ICAT(self.serverUrl, os.environ["serverCert"])
+        else:
+            # No server given: run against an in-memory stand-in
+            self.icat = FakeICAT()
+            self.serverUrl = self.icat.url
         self.session = self.icat.login("simple", {"username":"br54", "password":"bubbleicatcar"})
         # wipe and reset ICAT
         for fid in self.session.search("SELECT f.id from Facility f"):
@@ -248,6 +266,634 @@ class Test(unittest.TestCase):
         newfiles = self.session.search("SELECT df.id, df.name, df.location FROM Datafile df WHERE df.dataset.id = " + str(newdsid))
         self.assertEqual(len(oldfiles)+1,len(newfiles))
         
+    def test15LongHistory(self):
+        self.vicat = VICAT(self.session,self.fid,False)
+        versions = [self.datasetId]
+        for i in range(2,12):
+            versions.append(self.vicat.createVersion(versions[-1],"ds1_v" + str(i)))
+        self.assertEqual(versions[:-1],self.vicat.ancestors(versions[-1]))
+        self.assertEqual(versions[1:],self.vicat.descendants(versions[0]))
+        self.assertEqual(versions[:5],self.vicat.ancestors(versions[5]))
+        self.assertEqual(versions[6:],self.vicat.descendants(versions[5]))
+        # A history created before origins were recorded is still resolved with a fixed number of searches
+        for paramId in self.session.search("SELECT dp.id FROM DatasetParameter dp WHERE dp.type.name = '" + VICAT.ORIGIN + "'"):
+            self.session.delete({"DatasetParameter" : {"id" : paramId}})
+        self.session.resetCounts()
+        self.assertEqual(versions[:-1],self.vicat.ancestors(versions[-1]))
+        self.assertEqual(2, self.session.roundTrips())
+        self.session.resetCounts()
+        self.assertEqual(versions[1:],self.vicat.descendants(versions[0]))
+        self.assertEqual(3, self.session.roundTrips())
+        self.assertEqual(versions[6:],self.vicat.descendants(versions[5]))
+
+    def test16DescendantsAfterBranching(self):
+        self.vicat = VICAT(self.session,self.fid,True)
+        newdsid = self.vicat.createVersion(self.datasetId,"ds1_v2.1")
+        # A non-branching instance must still refuse to follow a chain that was branched
+        self.vicat = VICAT(self.session,self.fid,False)
+        with self.assertRaises(VicatException) as cm:
+            self.vicat.descendants(self.datasetId)
+        self.assertEqual(VicatException.BRANCHING_PERMITTED, cm.exception.getType())
+        self.assertEqual([self.datasetId],self.vicat.ancestors(newdsid))
+
+    def test17BatchQueries(self):
+        self.vicat = VICAT(self.session,self.fid,False)
+        newdsid1 = self.vicat.createVersion(self.datasetId,"ds1_v2","Second version")
+        newdsid2 = self.vicat.createVersion(newdsid1,"ds1_v3")
+        ids = [self.datasetId, newdsid1, newdsid2]
+        self.assertEqual({self.datasetId : True, newdsid1 : True, newdsid2 : False}, self.vicat.isSupersededMany(ids))
+        self.assertEqual({self.datasetId : newdsid1, newdsid1 : newdsid2, newdsid2 : None}, self.vicat.supersededMany(ids))
+        self.assertEqual({self.datasetId : None, newdsid1 : self.datasetId, newdsid2 : newdsid1}, self.vicat.supersedesMany(ids))
+        self.assertEqual({self.datasetId : None, newdsid1 : "Second version", newdsid2 : None}, self.vicat.versionCommentMany(ids))
+        # Ids given as strings are accepted, as by the single-dataset methods
+        self.assertEqual({str(self.datasetId) : True, str(newdsid2) : False}, self.vicat.isSupersededMany([str(self.datasetId), str(newdsid2)]))
+        self.assertEqual({str(newdsid1) : newdsid2}, self.vicat.supersededMany([str(newdsid1)]))
+
+    def test18BatchQueriesBranching(self):
+        self.vicat = VICAT(self.session,self.fid,True)
+        newdsid = self.vicat.createVersion(self.datasetId,"ds1_v2.1")
+        with self.assertRaises(VicatException) as cm:
+            self.vicat.supersededMany([self.datasetId, newdsid])
+        self.assertEqual(VicatException.BRANCHING_PERMITTED, cm.exception.getType())
+        # As for superseded, a non-branching instance still detects the earlier branching
+        self.vicat = VICAT(self.session,self.fid,False)
+        with self.assertRaises(VicatException) as cm:
+            self.vicat.supersededMany([newdsid, self.datasetId])
+        self.assertEqual(VicatException.BRANCHING_PERMITTED, cm.exception.getType())
+
+    def test19VersionParameters(self):
+        self.vicat = VICAT(self.session,self.fid,True)
+        newdsid1 = self.vicat.createVersion(self.datasetId,"ds1_v2.1","First")
+        newdsid2 = self.vicat.createVersion(self.datasetId,"ds1_v2.2","Second")
+        newdsid3 = self.vicat.createVersion(newdsid1,"ds1_v3")
+        # Each version should have exactly one supersedes and origin parameter, no superseded parameter
+        # (unless it has versions of its own) and no comment copied from the original
+        for dsid, parent, comment in [(newdsid2,self.datasetId,"Second"),(newdsid3,newdsid1,None)]:
+            params = self.session.search("SELECT dp.type.name FROM DatasetParameter dp WHERE dp.dataset.id = " + str(dsid))
+            expected = [VICAT.ORIGIN, VICAT.SUPERSEDES] if comment is None else [VICAT.COMMENT, VICAT.ORIGIN, VICAT.SUPERSEDES]
+            self.assertEqual(expected, sorted(params))
+            self.assertEqual(parent, self.vicat.supersedes(dsid))
+            self.assertEqual(comment, self.vicat.versionComment(dsid))
+        self.assertTrue(self.vicat.isSuperseded(newdsid1))
+
+    def test20CreateVersions(self):
+        self.vicat = VICAT(self.session,self.fid,False)
+        newdsid = self.vicat.createVersion(self.datasetId,"ds1_v2")
+        invid = self.session.search("SELECT i.id FROM Investigation i WHERE i.facility.name = 'LSF' AND i.name = 'Inv 1'")[0]
+        dstid = self.session.search("SELECT d.id FROM DatasetType d")[0]
+        dataset = {"name" : "ds2", "investigation" : { "id" : invid}, "type": {"id":dstid}}
+        otherId = self.session.write({"Dataset" : dataset})[0]
+        results = self.vicat.createVersions([(otherId,"ds2_v2","Batch version"), (self.datasetId,"ds1_v2.2"), (newdsid,"ds1_v3")])
+        self.assertEqual(3, len(results))
+        # The second item would branch, so should fail without affecting the others
+        self.assertIsInstance(results[1], VicatException)
+        self.assertEqual(VicatException.BRANCHING_NOT_PERMITTED, results[1].getType())
+        self.assertEqual(otherId, self.vicat.supersedes(results[0]))
+        self.assertEqual(results[0], self.vicat.superseded(otherId))
+        self.assertEqual("Batch version", self.vicat.versionComment(results[0]))
+        self.assertEqual([self.datasetId, newdsid], self.vicat.ancestors(results[2]))
+        self.assertIsNone(self.vicat.versionComment(results[2]))
+        # An original deleted while its batch is being versioned only fails its own tuple
+        others = [self.session.write({"Dataset" : {"name" : "ds" + str(i), "investigation" : { "id" : invid}, "type": {"id":dstid}}})[0] for i in range(3, 6)]
+        session = self.session
+        class DeletingSession(object):
+            def __getattr__(self, name):
+                return getattr(session, name)
+            def cloneEntity(self, name, entityId, keys):
+                newId = session.cloneEntity(name, entityId, keys)
+                if entityId == others[1]:
+                    session.delete({"Dataset" : {"id" : entityId}})
+                return newId
+        self.vicat.session = DeletingSession()
+        self.vicat.MAX_VERSIONS_PER_BATCH = 2
+        results = self.vicat.createVersions([(dsid, "ds" + str(dsid) + "_v2") for dsid in others])
+        self.vicat.session = self.session
+        self.assertIsInstance(results[1], Exception)
+        self.assertEqual(others[0], self.vicat.supersedes(results[0]))
+        self.assertEqual(others[2], self.vicat.supersedes(results[2]))
+        self.assertEqual(results[2], self.vicat.superseded(others[2]))
+
+    def test21Cache(self):
+        cache = VersionCache(100)
+        self.vicat = VICAT(self.session,self.fid,False,cache)
+        self.assertFalse(self.vicat.isSuperseded(self.datasetId))
+        self.assertIsNone(self.vicat.superseded(self.datasetId))
+        self.assertEqual(1, cache.hits)
+        # createVersion must not leave stale entries behind
+        newdsid = self.vicat.createVersion(self.datasetId,"ds1_v2","Cached")
+        self.assertTrue(self.vicat.isSuperseded(self.datasetId))
+        self.assertEqual(newdsid, self.vicat.superseded(self.datasetId))
+        self.assertEqual(self.datasetId, self.vicat.supersedes(newdsid))
+        self.assertEqual("Cached", self.vicat.versionComment(newdsid))
+        self.assertEqual([newdsid], self.vicat.descendants(self.datasetId))
+        stats = self.vicat.cacheStats()
+        self.assertEqual(1, stats["misses"])
+        self.assertTrue(stats["hits"] > 1)
+        # Nor when the dataset was looked up by a string id
+        self.assertFalse(self.vicat.isSuperseded(str(newdsid)))
+        newdsid2 = self.vicat.createVersion(newdsid,"ds1_v3")
+        self.assertTrue(self.vicat.isSuperseded(str(newdsid)))
+        self.assertEqual(newdsid2, self.vicat.superseded(str(newdsid)))
+        self.assertEqual({str(newdsid) : newdsid2}, self.vicat.supersededMany([str(newdsid)]))
+        self.assertEqual([newdsid2], self.vicat.descendants(str(newdsid)))
+        self.assertEqual([self.datasetId, newdsid], self.vicat.ancestors(str(newdsid2)))
+
+    def test22CacheEviction(self):
+        cache = VersionCache(2, ttl=60)
+        self.vicat = VICAT(self.session,self.fid,False,cache)
+        newdsid = self.vicat.createVersion(self.datasetId,"ds1_v2")
+        # Only the two most recently used entries are kept
+        self.assertEqual(2, cache.stats()["size"])
+        self.assertEqual(newdsid, self.vicat.superseded(self.datasetId))
+        self.assertEqual(1, cache.misses)
+
+    def test23Registry(self):
+        # The facility ids change every time ICAT is wiped, but clear the registry to be safe
+        clearRegistry()
+        vicat1 = VICAT(self.session,None,False,server=self.serverUrl)
+        vicat2 = VICAT(self.session,None,False,server=self.serverUrl)
+        self.assertEqual(self.fid, vicat2.fid)
+        self.assertEqual((vicat1.supersededPT, vicat1.supersedesPT, vicat1.commentPT), (vicat2.supersededPT, vicat2.supersedesPT, vicat2.commentPT))
+        # If the ParameterTypes are removed, refreshing should recreate them
+        for ptid in [vicat2.supersededPT, vicat2.supersedesPT, vicat2.commentPT]:
+            self.session.delete({"ParameterType" : {"id" : ptid}})
+        vicat2.refreshParameterTypes()
+        self.assertNotEqual(vicat1.supersedesPT, vicat2.supersedesPT)
+        newdsid = vicat2.createVersion(self.datasetId,"ds1_v2")
+        self.assertEqual(self.datasetId, vicat2.supersedes(newdsid))
+        # ... and later instances should use the new ids
+        vicat3 = VICAT(self.session,None,False,server=self.serverUrl)
+        self.assertEqual(vicat2.supersedesPT, vicat3.supersedesPT)
+        clearRegistry()
+
+    def test24Async(self):
+        async def run():
+            instrumentation = Instrumentation()
+            avicat = await AsyncVICAT.create(self.session,self.fid,False,concurrency=4,instrumentation=instrumentation)
+            try:
+                newdsid1 = await avicat.createVersion(self.datasetId,"ds1_v2","Async")
+                newdsid2 = await avicat.createVersion(newdsid1,"ds1_v3")
+                with self.assertRaises(VicatException):
+                    await avicat.createVersion(self.datasetId,"ds1_v2.2")
+                self.assertEqual([self.datasetId,newdsid1], await avicat.ancestors(newdsid2))
+                self.assertEqual([newdsid1,newdsid2], await avicat.descendants(self.datasetId))
+                self.assertEqual("Async", await avicat.versionComment(newdsid1))
+                ids = [self.datasetId, newdsid1, newdsid2]
+                self.assertEqual({self.datasetId : newdsid1, newdsid1 : newdsid2, newdsid2 : None}, await avicat.supersededMany(ids))
+                self.assertEqual({self.datasetId : True, newdsid1 : True, newdsid2 : False}, await avicat.isSupersededMany(ids))
+                results = await avicat.createVersions([(newdsid2,"ds1_v4"), (newdsid1,"ds1_v3.2")])
+                self.assertEqual(newdsid2, await avicat.supersedes(results[0]))
+                self.assertIsInstance(results[1], VicatException)
+                progress = []
+                largedsid = await avicat.createLargeVersion(results[0],"ds1_v5",batchSize=1,progress=lambda dsid, copied: progress.append(copied))
+                self.assertEqual([1, 2], progress)
+                self.assertEqual(results[0], await avicat.supersedes(largedsid))
+                self.assertEqual(0, await avicat.backfillOrigins())
+                # Versioning is done by the VICAT methods, so is recorded under their names
+                stats = instrumentation.stats()
+                self.assertEqual(3, stats["createVersion"]["calls"])
+                self.assertEqual(2, stats["createVersion"]["operations"]["cloneEntity"])
+                self.assertEqual(1, stats["createVersions"]["operations"]["cloneEntity"])
+            finally:
+                avicat.close()
+        asyncio.run(run())
+
+    def test25Parallel(self):
+        login = lambda: self.icat.login("simple", {"username":"br54", "password":"bubbleicatcar"})
+        pvicat = ParallelVICAT(login,self.fid,False,workers=4)
+        try:
+            # Several workers try to version the same dataset: only one may succeed
+            results = pvicat.createVersions([(self.datasetId,"ds1_v2." + str(i)) for i in range(6)])
+            created = [result for result in results if not isinstance(result, Exception)]
+            self.assertEqual(1, len(created))
+            for result in results:
+                if isinstance(result, VicatException):
+                    self.assertEqual(VicatException.BRANCHING_NOT_PERMITTED, result.getType())
+            self.assertEqual([[self.datasetId], []], pvicat.lookup("ancestors", [created[0], self.datasetId]))
+            results = pvicat.lookup("superseded", [self.datasetId, created[0]])
+            self.assertEqual([created[0], None], results)
+        finally:
+            pvicat.close()
+        # A session that expires after the clone is made: the clone is completed, not made again
+        class ExpiringSession(object):
+            def __init__(self, session):
+                self.session = session
+                self.cloned = False
+            def __getattr__(self, name):
+                return getattr(self.session, name)
+            def cloneEntity(self, name, entityId, keys):
+                self.cloned = True
+                return self.session.cloneEntity(name, entityId, keys)
+            def write(self, entities):
+                if self.cloned:
+                    raise FakeIcatException("SESSION", "Session expired")
+                return self.session.write(entities)
+        datasets = len(self.session.search("SELECT ds.id FROM Dataset ds"))
+        pvicat = ParallelVICAT(lambda: ExpiringSession(login()),self.fid,False,workers=1)
+        try:
+            (newdsid,) = pvicat.createVersions([(created[0],"ds1_v3")])
+        finally:
+            pvicat.close()
+        self.vicat = VICAT(self.session,self.fid,False)
+        self.assertEqual(created[0], self.vicat.supersedes(newdsid))
+        self.assertEqual([newdsid], self.vicat.descendants(created[0]))
+        self.assertEqual(datasets + 1, len(self.session.search("SELECT ds.id FROM Dataset ds")))
+        # If another client versions the dataset before the retry, the clone is not left looking like a version
+        other = self.vicat
+        class RacingSession(ExpiringSession):
+            def delete(self, entities):
+                if self.cloned:
+                    self.cloned = False
+                    other.createVersion(newdsid,"ds1_v4.1")
+                    raise FakeIcatException("SESSION", "Session expired")
+                return self.session.delete(entities)
+        pvicat = ParallelVICAT(lambda: RacingSession(login()),self.fid,False,workers=1)
+        try:
+            (result,) = pvicat.createVersions([(newdsid,"ds1_v4.2")])
+        finally:
+            pvicat.close()
+        self.assertEqual(VicatException.BRANCHING_NOT_PERMITTED, result.getType())
+        (clone,) = self.session.search("SELECT ds.id FROM Dataset ds WHERE ds.name = 'ds1_v4.2'")
+        self.assertIsNone(self.vicat.supersedes(clone))
+        self.assertEqual({}, self.vicat._findParamValues([clone], [self.vicat.originPT, self.vicat.commentPT])[clone])
+        # A session that cannot be replaced is dropped from the pool, not returned to it
+        logins = []
+        def failingLogin():
+            logins.append(1)
+            if len(logins) > 1:
+                raise FakeIcatException("SESSION", "Cannot log in")
+            return ExpiringSession(login())
+        pvicat = ParallelVICAT(failingLogin,self.fid,False,workers=1)
+        try:
+            (result,) = pvicat.createVersions([(clone,"ds1_v5")])
+            self.assertIsInstance(result, FakeIcatException)
+            self.assertEqual(0, pvicat.pool._count)
+            self.assertEqual([], pvicat.pool._idle)
+        finally:
+            pvicat.close()
+
+    def test26Index(self):
+        self.vicat = VICAT(self.session,self.fid,False)
+        newdsid1 = self.vicat.createVersion(self.datasetId,"ds1_v2","Indexed")
+        tempdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempdir, "vicat.db")
+            index = VersionIndex(self.vicat, path)
+            self.assertTrue(index.sync() > 0)
+            self.assertEqual(self.datasetId, index.supersedes(newdsid1))
+            self.assertEqual("Indexed", index.versionComment(newdsid1))
+            index.close()
+            # New versions are picked up by an incremental sync of the persistent index
+            newdsid2 = self.vicat.createVersion(newdsid1,"ds1_v3")
+            index = VersionIndex(self.vicat, path)
+            self.assertIsNone(index.superseded(newdsid1))
+            index.sync()
+            self.assertEqual(newdsid2, index.superseded(newdsid1))
+            self.assertEqual([self.datasetId, newdsid1], index.ancestors(newdsid2))
+            self.assertEqual([newdsid1, newdsid2], index.descendants(self.datasetId))
+            self.assertEqual(newdsid2, index.latest(self.datasetId))
+            self.assertEqual([newdsid2], index.children(newdsid1))
+            # The comment copied into the clone should not survive
+            self.assertIsNone(index.versionComment(newdsid2))
+            self.assertFalse(index.isSuperseded(newdsid2))
+            self.assertFalse(index._deleted())
+            # A parameter deleted on its own is noticed, and the index rescanned
+            (paramId,) = self.session.search("SELECT dp.id FROM DatasetParameter dp WHERE dp.dataset.id = " + str(newdsid1) + " AND dp.type.id = " + str(self.vicat.commentPT))
+            self.session.delete({"DatasetParameter" : {"id" : paramId}})
+            self.assertTrue(index._deleted())
+            index.sync()
+            self.assertFalse(index._deleted())
+            self.assertIsNone(index.versionComment(newdsid1))
+            self.assertEqual(newdsid2, index.superseded(newdsid1))
+            index.close()
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test27Latest(self):
+        self.vicat = VICAT(self.session,self.fid,False)
+        self.assertEqual(self.datasetId, self.vicat.latest(self.datasetId))
+        self.assertEqual(self.datasetId, self.vicat.origin(self.datasetId))
+        self.assertEqual([self.datasetId], self.vicat.lineage(self.datasetId))
+        newdsid1 = self.vicat.createVersion(self.datasetId,"ds1_v2")
+        newdsid2 = self.vicat.createVersion(newdsid1,"ds1_v3")
+        for dsid in [self.datasetId, newdsid1, newdsid2]:
+            self.assertEqual(newdsid2, self.vicat.latest(dsid))
+            self.assertEqual(self.datasetId, self.vicat.origin(dsid))
+            self.assertEqual([self.datasetId, newdsid1, newdsid2], self.vicat.lineage(dsid))
+
+    def test28LatestBranching(self):
+        self.vicat = VICAT(self.session,self.fid,True)
+        newdsid1 = self.vicat.createVersion(self.datasetId,"ds1_v2.1")
+        newdsid2 = self.vicat.createVersion(self.datasetId,"ds1_v2.2")
+        newdsid3 = self.vicat.createVersion(newdsid1,"ds1_v3.1")
+        self.assertEqual(sorted([newdsid2, newdsid3]), self.vicat.latest(self.datasetId))
+        self.assertEqual([newdsid3], self.vicat.latest(newdsid1))
+        self.assertEqual(self.datasetId, self.vicat.origin(newdsid3))
+        self.assertEqual(sorted([self.datasetId, newdsid1, newdsid2, newdsid3]), sorted(self.vicat.lineage(newdsid2)))
+        # A non-branching instance cannot choose a single latest version
+        self.vicat = VICAT(self.session,self.fid,False)
+        with self.assertRaises(VicatException) as cm:
+            self.vicat.latest(self.datasetId)
+        self.assertEqual(VicatException.BRANCHING_PERMITTED, cm.exception.getType())
+
+    def test29BackfillOrigins(self):
+        self.vicat = VICAT(self.session,self.fid,False)
+        newdsid1 = self.vicat.createVersion(self.datasetId,"ds1_v2")
+        newdsid2 = self.vicat.createVersion(newdsid1,"ds1_v3")
+        # Simulate a history created before origins were recorded
+        for paramId in self.session.search("SELECT dp.id FROM DatasetParameter dp WHERE dp.type.name = '" + VICAT.ORIGIN + "'"):
+            self.session.delete({"DatasetParameter" : {"id" : paramId}})
+        # origin() still works, by following the history
+        self.assertEqual(self.datasetId, self.vicat.origin(newdsid2))
+        # A new version records its origin, so the history is mixed; lineage and latest must still find all of it
+        newdsid3 = self.vicat.createVersion(str(newdsid2),"ds1_v4")
+        self.assertEqual([newdsid1, newdsid2, newdsid3], self.vicat.descendants(self.datasetId))
+        self.assertEqual(newdsid3, self.vicat.latest(self.datasetId))
+        self.assertEqual(newdsid3, self.vicat.latest(str(newdsid1)))
+        self.assertEqual([self.datasetId, newdsid1, newdsid2, newdsid3], self.vicat.lineage(newdsid3))
+        self.assertEqual([self.datasetId, newdsid1, newdsid2, newdsid3], self.vicat.lineage(newdsid1))
+        self.assertEqual(2, self.vicat.backfillOrigins())
+        self.assertEqual(0, self.vicat.backfillOrigins())
+        self.assertEqual([self.datasetId, newdsid1, newdsid2, newdsid3], self.vicat.lineage(newdsid1))
+        self.assertEqual(newdsid3, self.vicat.latest(self.datasetId))
+
+    def test30DescendantTree(self):
+        self.vicat = VICAT(self.session,self.fid,True)
+        newdsid1 = self.vicat.createVersion(self.datasetId,"ds1_v2.1")
+        newdsid2 = self.vicat.createVersion(self.datasetId,"ds1_v2.2")
+        newdsid3 = self.vicat.createVersion(newdsid1,"ds1_v3.1")
+        self.assertEqual([newdsid1, newdsid2], self.vicat.children(self.datasetId))
+        self.assertEqual([], self.vicat.children(newdsid3))
+        tree = self.vicat.descendantTree(self.datasetId)
+        self.assertEqual([self.datasetId, newdsid1, newdsid2, newdsid3], list(tree.ids))
+        self.assertEqual([-1, 0, 0, 1], list(tree.parents))
+        self.assertEqual([1, 2], tree.children(0))
+        self.assertEqual([newdsid2, newdsid3], tree.leaves())
+        tree = self.vicat.descendantTree(newdsid1)
+        self.assertEqual([newdsid1, newdsid3], list(tree.ids))
+        self.assertEqual([-1, 0], list(tree.parents))
+
+    def test31LargeVersion(self):
+        self.vicat = VICAT(self.session,self.fid,False)
+        progress = []
+        newdsid = self.vicat.createLargeVersion(self.datasetId,"ds1_v2","Large",batchSize=1,progress=lambda dsid, copied: progress.append(copied))
+        self.assertEqual([1, 2], progress)
+        self.assertEqual(self.datasetId, self.vicat.supersedes(newdsid))
+        self.assertEqual(newdsid, self.vicat.superseded(self.datasetId))
+        self.assertEqual("Large", self.vicat.versionComment(newdsid))
+        oldfiles = self.session.search("SELECT df.name, df.location FROM Datafile df WHERE df.dataset.id = " + str(self.datasetId) + " ORDER BY df.name")
+        newfiles = self.session.search("SELECT df.name, df.location FROM Datafile df WHERE df.dataset.id = " + str(newdsid) + " ORDER BY df.name")
+        self.assertEqual(oldfiles, newfiles)
+        # Calling again for a completed version returns it
+        self.assertEqual(newdsid, self.vicat.createLargeVersion(self.datasetId,"ds1_v2"))
+        with self.assertRaises(VicatException) as cm:
+            self.vicat.createLargeVersion(self.datasetId,"ds1_v3")
+        self.assertEqual(VicatException.BRANCHING_NOT_PERMITTED, cm.exception.getType())
+
+    def test32Instrumentation(self):
+        spans = []
+        instrumentation = Instrumentation([spans.append])
+        self.vicat = VICAT(self.session,self.fid,False,instrumentation=instrumentation)
+        newdsid = self.vicat.createVersion(self.datasetId,"ds1_v2")
+        self.vicat.ancestors(newdsid)
+        with self.assertRaises(VicatException):
+            self.vicat.createVersion(self.datasetId,"ds1_v3")
+        stats = instrumentation.stats()
+        self.assertEqual(set(["__init__", "createVersion", "ancestors"]), set(stats))
+        self.assertEqual(2, stats["createVersion"]["calls"])
+        self.assertEqual(1, stats["createVersion"]["errors"])
+        self.assertEqual(1, stats["createVersion"]["operations"]["cloneEntity"])
+        self.assertEqual(sum(stats["ancestors"]["operations"].values()), stats["ancestors"]["roundTrips"])
+        # The hook sees every ICAT call, each attributed to the method that made it
+        methodSpans = [span for span in spans if span.operation is None]
+        icatSpans = [span for span in spans if span.operation is not None]
+        self.assertEqual(["__init__", "createVersion", "ancestors", "createVersion"], [span.method for span in methodSpans])
+        self.assertEqual(sum(span.roundTrips for span in methodSpans), len(icatSpans))
+        self.assertTrue(any(span.query.startswith("SELECT") for span in instrumentation.recentQueries() if span.method == "ancestors"))
+        # Nothing is recorded once disabled
+        instrumentation.enabled = False
+        self.vicat.supersedes(newdsid)
+        self.assertEqual(stats, instrumentation.stats())
+
+    def test33IterVersions(self):
+        self.vicat = VICAT(self.session,self.fid,False)
+        self.vicat.MAX_RESULTS_PER_QUERY = 2
+        invid = self.session.search("SELECT i.id FROM Investigation i WHERE i.facility.name = 'LSF' AND i.name = 'Inv 1'")[0]
+        dstid = self.session.search("SELECT d.id FROM DatasetType d")[0]
+        others = [self.session.write({"Dataset" : {"name" : "ds" + str(i), "investigation" : {"id" : invid}, "type" : {"id" : dstid}}})[0] for i in range(2, 6)]
+        newdsid1 = self.vicat.createVersion(self.datasetId,"ds1_v2")
+        newdsid2 = self.vicat.createVersion(newdsid1,"ds1_v3")
+        newdsid3 = self.vicat.createVersion(others[0],"ds2_v2")
+        self.assertEqual([self.datasetId, newdsid1, others[0]], list(self.vicat.iterSuperseded()))
+        self.assertEqual([(newdsid1, self.datasetId), (newdsid2, newdsid1), (newdsid3, others[0])], list(self.vicat.iterVersions()))
+        self.assertEqual(others[1:] + [newdsid2, newdsid3], list(self.vicat.iterLatestVersions(invid)))
+        self.assertEqual([newdsid2, newdsid3], list(self.vicat.iterLatestVersions(invid, dstid, versionsOnly=True)))
+        self.assertEqual([], list(self.vicat.iterSuperseded(datasetTypeId=-1)))
+        async def collect():
+            client = AsyncVICAT(self.vicat)
+            try:
+                return [dsid async for dsid in client.iterLatestVersions(versionsOnly=True)]
+            finally:
+                client.close()
+        self.assertEqual([newdsid2, newdsid3], asyncio.run(collect()))
+
+    def test34DiffVersions(self):
+        self.vicat = VICAT(self.session,self.fid,False)
+        newdsid = self.vicat.createVersion(self.datasetId,"ds1_v2")
+        self.assertEqual((set(),) * 6, tuple(self.vicat.diffVersions(newdsid)))
+        pt = self.session.write({"ParameterType" : {"name" : "temp", "units" : "K", "valueType" : "NUMERIC", "facility" : {"id" : self.fid}}})[0]
+        self.session.write({"DatasetParameter" : {"dataset" : {"id" : newdsid}, "type" : {"id" : pt}, "numericValue" : 3}})
+        df1 = self.session.search("SELECT df.id FROM Datafile df WHERE df.dataset.id = " + str(newdsid) + " AND df.name = 'df1'")[0]
+        df2 = self.session.search("SELECT df.id FROM Datafile df WHERE df.dataset.id = " + str(newdsid) + " AND df.name = 'df2'")[0]
+        self.session.write({"Datafile" : {"id" : df1, "location" : "loc1_v2"}})
+        self.session.delete({"Datafile" : {"id" : df2}})
+        self.session.write({"Datafile" : {"dataset" : {"id" : newdsid}, "name" : "df3", "location" : "loc3"}})
+        diff = self.vicat.diffVersions(newdsid)
+        self.assertEqual(set(["df3"]), diff.addedDatafiles)
+        self.assertEqual(set(["df2"]), diff.removedDatafiles)
+        self.assertEqual(set(["df1"]), diff.changedDatafiles)
+        self.assertEqual(set(["temp"]), diff.addedParameters)
+        diff = self.vicat.diffVersions(newdsid, self.datasetId)
+        self.assertEqual(set(["df2"]), diff.addedDatafiles)
+        self.assertEqual(set(["temp"]), diff.removedParameters)
+        with self.assertRaises(VicatException) as cm:
+            self.vicat.diffVersions(self.datasetId)
+        self.assertEqual(VicatException.NOT_A_VERSION, cm.exception.getType())
+
+    def test35Check(self):
+        self.vicat = VICAT(self.session,self.fid,False)
+        newdsid1 = self.vicat.createVersion(self.datasetId,"ds1_v2")
+        newdsid2 = self.vicat.createVersion(newdsid1,"ds1_v3")
+        checker = VersionChecker(self.vicat, lambda: self.icat.login("simple", {"username":"br54", "password":"bubbleicatcar"}))
+        self.assertEqual([], checker.check())
+        # A branching client has written 0 in the linear history, and a clone was left with a copied comment
+        paramId = self.session.search("SELECT dp.id FROM DatasetParameter dp WHERE dp.dataset.id = " + str(newdsid1) + " AND dp.type.id = " + str(self.vicat.supersededPT))[0]
+        self.session.delete({"DatasetParameter" : {"id" : paramId}})
+        self.session.write({"DatasetParameter" : {"dataset" : {"id" : newdsid1}, "type" : {"id" : self.vicat.supersededPT}, "numericValue" : 0}})
+        invid = self.session.search("SELECT i.id FROM Investigation i WHERE i.facility.name = 'LSF' AND i.name = 'Inv 1'")[0]
+        dstid = self.session.search("SELECT d.id FROM DatasetType d")[0]
+        clone = self.session.write({"Dataset" : {"name" : "ds1_v4", "investigation" : {"id" : invid}, "type" : {"id" : dstid}}})[0]
+        self.session.write({"DatasetParameter" : {"dataset" : {"id" : clone}, "type" : {"id" : self.vicat.commentPT}, "stringValue" : "Copied"}})
+        problems = checker.check()
+        self.assertEqual({VersionChecker.BRANCHING_MISMATCH : 1, VersionChecker.ORPHAN : 1}, checker.summary(problems))
+        self.assertEqual({"repaired" : 2, "deleted" : 2, "written" : 1}, checker.repair(problems, dryRun=True))
+        self.assertEqual(2, len(checker.check()))
+        checker.repair(problems)
+        self.assertEqual([], checker.check())
+        self.assertEqual(newdsid2, self.vicat.superseded(newdsid1))
+        self.assertIsNone(self.vicat.versionComment(clone))
+        # With branching permitted, the ids written by a non-branching client are consistent, but not
+        # once a dataset has several versions, nor an id that is not that of the version
+        branching = VICAT(self.session,self.fid,True)
+        checker = VersionChecker(branching)
+        self.assertEqual([], checker.check())
+        newdsid3 = branching.createVersion(newdsid1,"ds1_v3.2")
+        paramId = self.session.search("SELECT dp.id FROM DatasetParameter dp WHERE dp.dataset.id = " + str(self.datasetId) + " AND dp.type.id = " + str(self.vicat.supersededPT))[0]
+        self.session.write({"DatasetParameter" : {"id" : paramId, "numericValue" : newdsid3}})
+        problems = checker.check()
+        self.assertEqual({VersionChecker.BRANCHING_MISMATCH : 1, VersionChecker.WRONG_SUPERSEDED : 1}, checker.summary(problems))
+        checker.repair(problems)
+        self.assertEqual([], checker.check())
+        self.assertEqual([newdsid1], self.session.search("SELECT dp.numericValue FROM DatasetParameter dp WHERE dp.dataset.id = " + str(self.datasetId) + " AND dp.type.id = " + str(self.vicat.supersededPT)))
+        self.assertEqual([0], self.session.search("SELECT dp.numericValue FROM DatasetParameter dp WHERE dp.dataset.id = " + str(newdsid1) + " AND dp.type.id = " + str(self.vicat.supersededPT)))
+
+    def test36Cli(self):
+        login = lambda: self.icat.login("simple", {"username":"br54", "password":"bubbleicatcar"})
+        directory = tempfile.mkdtemp()
+        try:
+            inputPath = os.path.join(directory, "versions.jsonl")
+            outputPath = os.path.join(directory, "results.jsonl")
+            checkpointPath = os.path.join(directory, "checkpoint.json")
+            with open(inputPath, "w") as f:
+                f.write(json.dumps({"id" : self.datasetId, "name" : "ds1_v2", "comment" : "From the CLI"}) + "\n")
+                f.write(json.dumps({"id" : self.datasetId, "name" : "ds1_v3"}) + "\n")
+            args = ["--facility", str(self.fid), "--output", outputPath, "create", inputPath, "--batch-size", "1", "--checkpoint", checkpointPath]
+            self.assertEqual(0, vicatcli.main(args, login))
+            # Running again resumes after the records already done
+            self.assertEqual(0, vicatcli.main(args, login))
+            with open(outputPath) as f:
+                results = [json.loads(line) for line in f]
+            self.assertEqual(2, len(results))
+            newdsid = results[0]["newId"]
+            self.assertTrue("error" in results[1])
+            with open(inputPath, "w") as f:
+                f.write(str(newdsid) + "\n")
+            os.remove(outputPath)
+            self.assertEqual(0, vicatcli.main(["--facility", str(self.fid), "--output", outputPath, "--concurrency", "2", "lineage", inputPath], login))
+            self.assertEqual(0, vicatcli.main(["--facility", str(self.fid), "--output", outputPath, "status", inputPath], login))
+            with open(outputPath) as f:
+                results = [json.loads(line) for line in f]
+            self.assertEqual({"id" : newdsid, "origin" : self.datasetId, "lineage" : [self.datasetId, newdsid]}, results[0])
+            self.assertEqual({"id" : newdsid, "superseded" : False, "supersedes" : self.datasetId, "comment" : "From the CLI"}, results[1])
+            # Records that cannot be read are reported in place, without stopping the run
+            with open(inputPath, "w") as f:
+                f.write("abc\n" + json.dumps({"name" : "x"}) + "\n" + str(newdsid) + "\n")
+            os.remove(outputPath)
+            args = ["--facility", str(self.fid), "--output", outputPath, "status", inputPath, "--batch-size", "2", "--checkpoint", checkpointPath]
+            self.assertEqual(0, vicatcli.main(args, login))
+            with open(outputPath) as f:
+                results = [json.loads(line) for line in f]
+            self.assertEqual([1, 2], [result["line"] for result in results[:2]])
+            self.assertTrue(all("error" in result for result in results[:2]))
+            self.assertEqual(newdsid, results[2]["id"])
+            with open(checkpointPath) as f:
+                self.assertEqual(3, json.load(f)["done"])
+        finally:
+            shutil.rmtree(directory)
+
+    def test37ChangesSince(self):
+        instrumentation = Instrumentation()
+        self.vicat = VICAT(self.session,self.fid,False,instrumentation=instrumentation)
+        self.assertEqual(([], None), self.vicat.changesSince(self.vicat.latestCursor()))
+        newdsid1 = self.vicat.createVersion(self.datasetId,"ds1_v2")
+        cursor = self.vicat.latestCursor()
+        newdsid2 = self.vicat.createVersion(newdsid1,"ds1_v3")
+        (changes, cursor) = self.vicat.changesSince(cursor, limit=1)
+        self.assertEqual(1, len(changes))
+        (more, cursor) = self.vicat.changesSince(cursor)
+        changes.extend(more)
+        self.assertEqual(set([(newdsid1, VICAT.SUPERSEDED, newdsid2), (newdsid2, VICAT.SUPERSEDES, newdsid1)]),
+                         set((change.datasetId, change.name, change.value) for change in changes))
+        self.assertEqual(([], cursor), self.vicat.changesSince(cursor))
+        # From the beginning, changes come in order of modification
+        (changes, cursor) = self.vicat.changesSince(None)
+        self.assertEqual(4, len(changes))
+        self.assertEqual(sorted((change.modTime, change.paramId) for change in changes), [(change.modTime, change.paramId) for change in changes])
+        stop = threading.Event()
+        pages = []
+        for (changes, cursor) in self.vicat.followChanges(None, 0.01, stop=stop):
+            pages.append(changes)
+            stop.set()
+        self.assertEqual(4, len(pages[0]))
+        stats = instrumentation.stats()
+        self.assertEqual(2, stats["latestCursor"]["calls"])
+        self.assertEqual(stats["changesSince"]["roundTrips"], sum(stats["changesSince"]["operations"].values()))
+
+    @unittest.skipIf(vicatgraph.numpy is None, "NumPy is not installed")
+    def test38ExportGraph(self):
+        self.vicat = VICAT(self.session,self.fid,True)
+        # A Facility with no versions exports an empty graph, in which no dataset is a version
+        directory = tempfile.mkdtemp()
+        try:
+            self.assertEqual(0, vicatgraph.exportGraph(self.vicat, directory))
+            graph = vicatgraph.VersionGraph.load(directory)
+            self.assertEqual([-1], list(graph.supersedes([self.datasetId])))
+            self.assertEqual([self.datasetId], list(graph.origin([self.datasetId])))
+            self.assertEqual([0], list(graph.depth([self.datasetId])))
+            self.assertEqual([], list(graph.ancestors(self.datasetId)))
+            self.assertEqual([self.datasetId], list(graph.latest([self.datasetId])))
+            self.assertIsNone(graph.versionComment(self.datasetId))
+        finally:
+            shutil.rmtree(directory)
+        newdsid1 = self.vicat.createVersion(self.datasetId,"ds1_v2.1","First")
+        newdsid2 = self.vicat.createVersion(self.datasetId,"ds1_v2.2")
+        newdsid3 = self.vicat.createVersion(newdsid1,"ds1_v3.1")
+        directory = tempfile.mkdtemp()
+        try:
+            self.assertEqual(3, vicatgraph.exportGraph(self.vicat, directory))
+            graph = vicatgraph.VersionGraph.load(directory)
+            self.assertEqual([newdsid1, newdsid2, newdsid3], list(graph.child))
+            self.assertEqual([self.datasetId, self.datasetId, newdsid1], list(graph.parent))
+            self.assertEqual([1, 1, 2], list(graph.depth()))
+            self.assertEqual([self.datasetId] * 3, list(graph.origin([newdsid1, newdsid3, self.datasetId])))
+            self.assertEqual([self.datasetId, newdsid1], list(graph.ancestors(newdsid3)))
+            self.assertEqual([newdsid3, newdsid2], list(graph.latest([newdsid1, newdsid2])))
+            self.assertEqual([2, 1, 0], list(graph.fanout([self.datasetId, newdsid1, newdsid3])))
+            self.assertEqual([newdsid2, newdsid3], list(graph.leaves()))
+            self.assertEqual("First", graph.versionComment(newdsid1))
+            self.assertIsNone(graph.versionComment(newdsid2))
+        finally:
+            shutil.rmtree(directory)
+
+    def test39LargeVersionResume(self):
+        self.vicat = VICAT(self.session,self.fid,False)
+        def interrupt(dsid, copied):
+            raise RuntimeError("interrupted after " + str(copied))
+        with self.assertRaises(RuntimeError):
+            self.vicat.createLargeVersion(self.datasetId,"ds1_v2",batchSize=1,progress=interrupt)
+        (newdsid,) = self.session.search("SELECT ds.id FROM Dataset ds WHERE ds.name = 'ds1_v2'")
+        self.assertIsNone(self.vicat.supersedes(newdsid))
+        self.assertEqual(1, len(self.session.search("SELECT df.id FROM Datafile df WHERE df.dataset.id = " + str(newdsid))))
+        # Calling again resumes into the marked copy, without copying any datafile twice
+        self.assertEqual(newdsid, self.vicat.createLargeVersion(self.datasetId,"ds1_v2",batchSize=1))
+        oldfiles = self.session.search("SELECT df.name FROM Datafile df WHERE df.dataset.id = " + str(self.datasetId) + " ORDER BY df.name")
+        newfiles = self.session.search("SELECT df.name FROM Datafile df WHERE df.dataset.id = " + str(newdsid) + " ORDER BY df.name")
+        self.assertEqual(oldfiles, newfiles)
+        self.assertEqual(self.datasetId, self.vicat.supersedes(newdsid))
+        self.assertEqual([], self.vicat._findParam(newdsid, self.vicat.copyOfPT))
+        # A dataset with the new name that is not a marked copy is not resumed into
+        invid = self.session.search("SELECT i.id FROM Investigation i WHERE i.facility.name = 'LSF' AND i.name = 'Inv 1'")[0]
+        dstid = self.session.search("SELECT d.id FROM DatasetType d")[0]
+        otherId = self.session.write({"Dataset" : {"name" : "ds2", "investigation" : {"id" : invid}, "type" : {"id" : dstid}}})[0]
+        self.session.write({"Dataset" : {"name" : "ds2_v2", "investigation" : {"id" : invid}, "type" : {"id" : dstid}}})
+        with self.assertRaises(FakeIcatException) as cm:
+            self.vicat.createLargeVersion(otherId,"ds2_v2")
+        self.assertEqual("OBJECT_ALREADY_EXISTS", cm.exception.getType())
+        self.assertEqual([], self.session.search("SELECT df.id FROM Datafile df WHERE df.dataset.name = 'ds2_v2'"))
+        with self.assertRaises(VicatException) as cm:
+            self.vicat.createLargeVersion(-1,"missing_v2")
+        self.assertEqual(VicatException.NO_SUCH_DATASET, cm.exception.getType())
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testCreateVersion']
     unittest.main()
\ No newline at end of file